@@ -0,0 +1,154 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+
+class LRUCache:
+    """Ограниченный по размеру кэш процесса с TTL записей. Потокобезопасен,
+    при переполнении вытесняет самую давно прочитанную запись."""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class TokenCache:
+    """Снимок юзера по ключу токена. Первый уровень - LRU процесса, второй
+    - общий кэш Django с алиасом из TOKEN_CACHE_SHARED, если он задан.
+    Удаление записи сразу видно в этом процессе и в общем кэше. Другие
+    процессы узнают о нем по отметке об отзыве в общем кэше, которую
+    проверяет каждое попадание в LRU; без общего кэша запись в них живет не
+    дольше TOKEN_CACHE_LOCAL_TTL секунд."""
+
+    def __init__(self):
+        self.local = LRUCache(settings.TOKEN_CACHE_SIZE,
+                              settings.TOKEN_CACHE_LOCAL_TTL)
+
+    @property
+    def shared(self):
+        alias = settings.TOKEN_CACHE_SHARED
+        return caches[alias] if alias else None
+
+    @staticmethod
+    def shared_key(key):
+        # Сам токен в общий кэш не пишется:
+        return 'token-user:' + hashlib.sha256(key.encode()).hexdigest()
+
+    @staticmethod
+    def revoked_key(key):
+        return 'token-revoked:' + hashlib.sha256(key.encode()).hexdigest()
+
+    def get(self, key):
+        snapshot = self.local.get(key)
+        if snapshot is not None and self.shared is not None:
+            if self.shared.get(self.revoked_key(key)) is not None:
+                self.local.delete(key)
+                return None
+        if snapshot is None and self.shared is not None:
+            snapshot = self.shared.get(self.shared_key(key))
+            if snapshot is not None:
+                self.local.set(key, snapshot)
+        return snapshot
+
+    def set(self, key, snapshot):
+        self.local.set(key, snapshot)
+        if self.shared is not None:
+            self.shared.set(self.shared_key(key), snapshot,
+                            settings.TOKEN_CACHE_SHARED_TTL)
+
+    def delete(self, *keys):
+        """Удаляет снимки и отмечает токены отозванными в общем кэше на
+        время жизни записей LRU других процессов."""
+
+        for key in keys:
+            self.local.delete(key)
+        if self.shared is not None and keys:
+            self.shared.delete_many([self.shared_key(key) for key in keys])
+            self.shared.set_many(
+                {self.revoked_key(key): 1 for key in keys},
+                settings.TOKEN_CACHE_LOCAL_TTL)
+
+    def clear(self):
+        self.local.clear()
+
+
+token_cache = TokenCache()
+
+# Поля снимка - только то, что нужно для аутентификации, прав и профиля в
+# ответах. Хэш пароля в кэш не попадает, счетчики меняются без сохранения
+# юзера и в снимке устаревали бы; остальные поля догружаются при обращении.
+SNAPSHOT_FIELDS = ('id', 'email', 'username', 'first_name', 'last_name',
+                   'is_active', 'is_staff', 'is_superuser')
+
+
+def user_snapshot(user):
+    """Значения полей SNAPSHOT_FIELDS юзера."""
+
+    return {name: getattr(user, name) for name in SNAPSHOT_FIELDS}
+
+
+def user_from_snapshot(snapshot):
+    User = get_user_model()
+    # from_db ждет значения в порядке полей модели:
+    names = [field.attname for field in User._meta.concrete_fields
+             if field.attname in snapshot]
+    return User.from_db(DEFAULT_DB_ALIAS, names,
+                        [snapshot[name] for name in names])
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """TokenAuthentication, в которой юзер по токену берется из token_cache
+    и запрос к токену и юзеру выполняется только при промахе. Записи
+    удаляются при выходе, смене пароля и деактивации юзера, см.
+    api/signals.py."""
+
+    def authenticate_credentials(self, key):
+        snapshot = token_cache.get(key)
+        if snapshot is None:
+            user, token = super().authenticate_credentials(key)
+            token_cache.set(key, user_snapshot(user))
+            return user, token
+        user = user_from_snapshot(snapshot)
+        if not user.is_active:
+            raise exceptions.AuthenticationFailed(
+                _('User inactive or deleted.'))
+        return user, Token(key=key, user=user)
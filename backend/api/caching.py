@@ -0,0 +1,194 @@
+import hashlib
+import time
+
+from django.core.cache import caches
+from django.utils.cache import (get_conditional_response, patch_cache_control,
+                                patch_vary_headers)
+from django.utils.http import http_date
+from recipes.models import ChangeStamp
+from rest_framework import status
+from rest_framework.response import Response
+
+
+class ConditionalGetMixin:
+    """Условные GET-запросы для действий из conditional_actions. Версия
+    ответа считается без сериализации методом get_version(request)
+    подкласса, который возвращает пару (ETag, datetime последнего изменения
+    или None). При совпадении с If-None-Match или If-Modified-Since
+    отдается 304 Not Modified."""
+
+    conditional_actions = ('list', 'retrieve')
+    cache_control = {}
+    vary_headers = ()
+
+    def conditional(self, request, view, *args, **kwargs):
+        etag, modified = self.get_version(request)
+        last_modified = int(modified.timestamp()) if modified else None
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = view(request, *args, **kwargs)
+        if response.status_code in (200, 304):
+            response['ETag'] = etag
+            if last_modified is not None:
+                response['Last-Modified'] = http_date(last_modified)
+            patch_cache_control(response, **self.cache_control)
+            patch_vary_headers(response, self.vary_headers)
+        return response
+
+    def list(self, request, *args, **kwargs):
+        if 'list' not in self.conditional_actions:
+            return super().list(request, *args, **kwargs)
+        return self.conditional(request, super().list, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        if 'retrieve' not in self.conditional_actions:
+            return super().retrieve(request, *args, **kwargs)
+        return self.conditional(request, super().retrieve, *args, **kwargs)
+
+
+class TableVersionMixin(ConditionalGetMixin):
+    """Версия ответа - версия всей таблицы из ChangeStamp. Ответ одинаков
+    для всех юзеров, поэтому его могут кэшировать nginx и браузер."""
+
+    change_stamp = None
+    cache_control = {'public': True, 'max_age': 60}
+
+    def get_version(self, request):
+        version, modified = ChangeStamp.current(self.change_stamp)
+        return f'"{self.change_stamp}-{version}"', modified
+
+
+class RecipeFragmentCache:
+    """Кэш сериализованных рецептов без полей, зависящих от юзера. Ключ
+    содержит версию рецепта: время его изменения и версии тэгов и
+    ингредиентов, поэтому изменение рецепта, его тэгов или ингредиентов
+    просто переводит чтение на новый ключ, а старый вытесняется по TTL.
+    Бэкенд - кэш Django с алиасом alias, см. RECIPE_CACHE в settings.py."""
+
+    HITS = 'recipe-fragments:hits'
+    MISSES = 'recipe-fragments:misses'
+
+    def __init__(self, alias):
+        self.alias = alias
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    @staticmethod
+    def key(recipe):
+        """Ключ рецепта или None, если кверисет без with_versions."""
+
+        if getattr(recipe, 'tags_version', None) is None:
+            return None
+        return (f'recipe:{recipe.pk}:{recipe.modified.timestamp()}:'
+                f'{recipe.tags_version}:{recipe.ingredients_version}')
+
+    def get_many(self, recipes):
+        """Фрагменты рецептов из кэша, словарь {id рецепта: фрагмент}."""
+
+        keys = {self.key(recipe): recipe.pk for recipe in recipes}
+        keys.pop(None, None)
+        found = self.cache.get_many(keys) if keys else {}
+        self.count(len(found), len(recipes) - len(found))
+        return {keys[key]: fragment for key, fragment in found.items()}
+
+    def set_many(self, recipes, fragments):
+        items = {self.key(recipe): fragments[recipe.pk] for recipe in recipes}
+        items.pop(None, None)
+        if items:
+            self.cache.set_many(items)
+
+    def count(self, hits, misses):
+        for key, value in ((self.HITS, hits), (self.MISSES, misses)):
+            if not value:
+                continue
+            try:
+                self.cache.incr(key, value)
+            except ValueError:
+                # Счетчика еще нет или он вытеснен:
+                if not self.cache.add(key, value, timeout=None):
+                    self.cache.incr(key, value)
+
+    def stats(self):
+        counters = self.cache.get_many((self.HITS, self.MISSES))
+        return counters.get(self.HITS, 0), counters.get(self.MISSES, 0)
+
+    def reset_stats(self):
+        self.cache.delete_many((self.HITS, self.MISSES))
+
+
+recipe_fragments = RecipeFragmentCache('recipes')
+
+
+class RecipePageCache:
+    """Кэш ответов ленты рецептов для анонимов. Запись хранит поколение -
+    версии рецептов, тэгов и ингредиентов из ChangeStamp - и считается
+    свежей fresh_for секунд в пределах своего поколения. Устаревшую или
+    отсутствующую запись собирает один воркер, взявший блокировку.
+    Остальные до конца сборки отдают устаревшую страницу, а если ее нет -
+    ждут до wait_for секунд и, не дождавшись, собирают ответ без записи в
+    кэш."""
+
+    STAMPS = (ChangeStamp.RECIPES, ChangeStamp.TAGS, ChangeStamp.INGREDIENTS)
+
+    def __init__(self, alias, fresh_for=60, stale_for=600, lock_for=10,
+                 wait_for=1, poll_every=0.05):
+        self.alias = alias
+        self.fresh_for = fresh_for
+        self.stale_for = stale_for
+        self.lock_for = lock_for
+        self.wait_for = wait_for
+        self.poll_every = poll_every
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def generation(self):
+        return list(ChangeStamp.objects.filter(
+            name__in=self.STAMPS
+        ).order_by('name').values_list('version', flat=True))
+
+    def wait(self, key, lock):
+        """Запись, собранная воркером, взявшим блокировку, или None, если он
+        снял блокировку, не записав страницу, или не успел за wait_for."""
+
+        deadline = time.monotonic() + self.wait_for
+        while time.monotonic() < deadline:
+            time.sleep(self.poll_every)
+            found = self.cache.get_many((key, lock))
+            if key in found or lock not in found:
+                return found.get(key)
+        return None
+
+    def get_or_build(self, key, build):
+        """Ответ из кэша по каноническому ключу запроса или build(). В кэш
+        попадают только ответы 200."""
+
+        key = 'recipe-page:' + hashlib.md5(key.encode()).hexdigest()
+        entry = self.cache.get(key)
+        generation = self.generation()
+        if (entry and entry['generation'] == generation
+                and entry['expires'] > time.time()):
+            return Response(entry['data'])
+        lock = key + ':lock'
+        if not self.cache.add(lock, 1, self.lock_for):
+            # Страницу уже собирает другой воркер:
+            entry = entry or self.wait(key, lock)
+            return Response(entry['data']) if entry else build()
+        try:
+            response = build()
+            if response.status_code == status.HTTP_200_OK:
+                self.cache.set(key, {
+                    'generation': generation,
+                    'expires': time.time() + self.fresh_for,
+                    'data': response.data,
+                }, self.stale_for)
+        finally:
+            self.cache.delete(lock)
+        return response
+
+
+recipe_pages = RecipePageCache('recipes')
@@ -1,17 +1,70 @@
+from django import forms
+from django.db import connections
+from django.db.models.functions import Collate, Lower
 from django_filters.rest_framework import FilterSet, filters
-from recipes.models import Recipe, Tag
-from rest_framework.filters import SearchFilter
+from recipes.ingredient_index import ingredient_index, to_bitmap
+from recipes.models import RankedRecipes, Recipe, Tag
+from rest_framework.filters import BaseFilterBackend
 from users.models import User
 
+from .pagination import CursorLimitPagination
 
-class IngredientSearchFilter(SearchFilter):
-    """Фильтр ингредиентов по имени."""
+
+class IngredientSearchFilter(BaseFilterBackend):
+    """Автодополнение ингредиентов по имени: сначала совпадения по началу
+    названия, затем, если их меньше max_results, по вхождению. Поиск по
+    вхождению включается с contains_min_length символов."""
 
     search_param = 'name'
+    contains_min_length = 3
+    max_results = 50
+
+    def filter_queryset(self, request, queryset, view):
+        name = request.query_params.get(self.search_param, '').strip().lower()
+        if not name or view.action != 'list':
+            return queryset
+        sort_name = Lower('name')
+        if connections[queryset.db].vendor == 'postgresql':
+            # Совпадает с индексом recipes_ingredient_lower_name_prefix,
+            # первые результаты читаются из индекса без сортировки:
+            sort_name = Collate(sort_name, 'C')
+        queryset = queryset.alias(lower_name=Lower('name'),
+                                  sort_name=sort_name)
+        ingredients = list(queryset.filter(
+            sort_name__startswith=name
+        ).order_by('sort_name')[:self.max_results])
+        if (len(ingredients) < self.max_results
+                and len(name) >= self.contains_min_length):
+            ingredients += queryset.filter(
+                lower_name__contains=name
+            ).exclude(
+                sort_name__startswith=name
+            ).order_by('sort_name')[:self.max_results - len(ingredients)]
+        return ingredients
+
+
+class IntegerFilter(filters.NumberFilter):
+    field_class = forms.IntegerField
+
+
+class IdsFilter(filters.BaseInFilter, IntegerFilter):
+    """id через запятую."""
 
 
 class RecipeFilterSet(FilterSet):
-    """Фильтр рецептов по тэгам и автору."""
+    """Фильтр рецептов по тэгам, автору, поисковому запросу и
+    ингредиентам. С search рецепты отсортированы по релевантности, с
+    фильтрами по ингредиентам - сначала по числу недостающих ингредиентов
+    или совпадений, см. filter_ingredients."""
+
+    ingredient_filters = ('ingredients_all', 'ingredients_any',
+                          'ingredients_exclude', 'max_missing')
+    # Совпадения из индекса ингредиентов передаются в запрос списком id,
+    # если их не больше max_ids. Рецепты, отобранные остальными фильтрами,
+    # пересекаются с совпадениями в индексе, если их не больше
+    # max_candidates, иначе фильтры по ингредиентам применяет база:
+    max_ids = 1000
+    max_candidates = 10000
 
     tags = filters.ModelMultipleChoiceFilter(
         field_name='tags__slug',
@@ -22,6 +75,12 @@ class RecipeFilterSet(FilterSet):
     is_favorited = filters.BooleanFilter(method='filter_is_favorited')
     is_in_shopping_cart = filters.BooleanFilter(
         method='filter_is_in_shopping_cart')
+    search = filters.CharFilter(method='filter_search')
+    ingredients_all = IdsFilter(method='filter_ingredients')
+    ingredients_any = IdsFilter(method='filter_ingredients')
+    ingredients_exclude = IdsFilter(method='filter_ingredients')
+    max_missing = IntegerFilter(method='filter_ingredients', min_value=0,
+                                max_value=20)
 
     def filter_is_favorited(self, queryset, name, value):
         """Фильтруются избранные рецепты."""
@@ -37,6 +96,59 @@ class RecipeFilterSet(FilterSet):
             return queryset.filter(shopping_cart__user=self.request.user)
         return queryset
 
+    def filter_search(self, queryset, name, value):
+        """Полнотекстовый поиск по названию и описанию."""
+
+        return queryset.search(value)
+
+    def filter_ingredients(self, queryset, name, value):
+        # Фильтры по ингредиентам применяются вместе в filter_queryset.
+        return queryset
+
+    def filter_queryset(self, queryset):
+        """Рецепты со всеми ingredients_all, хотя бы одним из
+        ingredients_any и без ingredients_exclude. С max_missing - рецепты,
+        которым из ingredients_all и ingredients_any не хватает не больше
+        max_missing ингредиентов, сначала те, кому не хватает меньше. Без
+        max_missing рецепты с большим числом ingredients_any идут первыми.
+        Совпадения ищутся в индексе в памяти среди рецептов, отобранных
+        остальными фильтрами, пока индекс строится - запросом к базе. Оба
+        пути отдают одни и те же рецепты в одном порядке."""
+
+        queryset = super().filter_queryset(queryset)
+        data = self.form.cleaned_data
+        ingredients = {
+            'all_ids': data.get('ingredients_all') or (),
+            'any_ids': data.get('ingredients_any') or (),
+            'exclude_ids': data.get('ingredients_exclude') or (),
+            'max_missing': data.get('max_missing'),
+        }
+        if (ingredients['max_missing'] is None
+                and not any(ingredients.values())):
+            return queryset
+        ranking = ingredient_index.match(**ingredients)
+        if ranking is None:
+            return queryset.with_ingredients(**ingredients)
+        if (len(ranking) > self.max_ids
+                and queryset.query.where != self.queryset.query.where):
+            # Остальные фильтры отбирают рецепты-кандидаты, совпадения
+            # ищутся среди них. Кандидатов больше max_candidates в процесс
+            # не тянем, их пересекает с ингредиентами база:
+            candidates = sorted(queryset.order_by().values_list(
+                'pk', flat=True)[:self.max_candidates + 1])
+            if len(candidates) > self.max_candidates:
+                return queryset.with_ingredients(**ingredients)
+            ranking = ingredient_index.find(**ingredients,
+                                            within=to_bitmap(candidates))
+        if len(ranking) <= self.max_ids:
+            return queryset.ranked(ranking.slice())
+        if (queryset.query.order_by
+                or CursorLimitPagination.cursor_query_param
+                in self.request.query_params):
+            # Порядок поиска и курсор по id индекс не воспроизводит:
+            return queryset.with_ingredients(**ingredients)
+        return RankedRecipes(queryset, ranking)
+
     class Meta:
         model = Recipe
         fields = ('tags', 'author')
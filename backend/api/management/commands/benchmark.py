@@ -0,0 +1,442 @@
+import random
+import time
+
+from django.conf import settings
+from django.contrib import admin
+from django.core.management.base import BaseCommand, CommandError
+from django.core.paginator import Paginator
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from foodgram.metrics import request_metrics
+from foodgram.routers import primary_only
+from django.db.models import Q
+from recipes.feed import fan_out, pulled_authors
+from recipes.ingredient_index import bitmap_ids, ingredient_index
+from recipes.models import (FeedEntry, Ingredient, IngredientsAmount, Recipe,
+                            SimilarRecipes, Tag)
+from recipes.similarity import TOP, RecipeVectors, Refresh, top_per_row
+from rest_framework.authtoken.models import Token
+from rest_framework.pagination import Cursor
+from rest_framework.test import APIClient
+from users.models import Follow, User
+
+from api.caching import recipe_fragments
+from api.pagination import CursorLimitPagination
+
+SCENARIOS = {}
+
+
+def scenario(name):
+    """Регистрирует сценарий бенчмарка. Сценарий получает команду и опции,
+    может создавать данные (они откатываются) и замеряет запросы через
+    command.measure."""
+
+    def register(func):
+        SCENARIOS[name] = func
+        return func
+    return register
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+class Command(BaseCommand):
+    help = 'measuring latency of api endpoints on the current database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenarios', nargs='*',
+                            help=f'сценарии: {", ".join(SCENARIOS)}')
+        parser.add_argument('--repeat', type=int, default=50)
+        parser.add_argument('--warmup', type=int, default=5)
+        parser.add_argument('--deep-page', type=int, default=10000,
+                            help='номер дальней страницы для сценария '
+                                 'recipes-pagination')
+        parser.add_argument('--search', nargs='+',
+                            default=['курица', 'суп с грибами', 'базилик',
+                                     'несуществующий'],
+                            help='запросы для сценария recipes-search')
+        parser.add_argument('--feed-follows', type=int, default=3000,
+                            help='подписок юзера в сценарии recipes-feed')
+
+    def handle(self, *args, **options):
+        names = options['scenarios'] or list(SCENARIOS)
+        unknown = set(names) - set(SCENARIOS)
+        if unknown:
+            raise CommandError(f'Нет сценариев: {", ".join(unknown)}')
+        self.repeat = options['repeat']
+        self.warmup = options['warmup']
+        self.client = APIClient(SERVER_NAME='localhost')
+        for name in names:
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            # Данные, созданные сценарием, откатываются, реплики их не видят:
+            with primary_only(), transaction.atomic():
+                SCENARIOS[name](self, options)
+                transaction.set_rollback(True)
+
+    def measure(self, label, url, client=None):
+        """Выполняет GET-запрос repeat раз и печатает задержки в мс."""
+
+        client = client or self.client
+        for _ in range(self.warmup):
+            client.get(url)
+        timings = []
+        for _ in range(self.repeat):
+            with CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                response = client.get(url)
+                if response.streaming:
+                    b''.join(response.streaming_content)
+                timings.append((time.perf_counter() - start) * 1000)
+        self.stdout.write(
+            f'{label}: {response.status_code}, {len(queries)} запросов, '
+            f'p50 {percentile(timings, 0.5):.2f} мс, '
+            f'p99 {percentile(timings, 0.99):.2f} мс, '
+            f'max {max(timings):.2f} мс')
+        return timings
+
+
+@scenario('ingredients-autocomplete')
+def ingredients_autocomplete(command, options):
+    """Автодополнение на каталоге, увеличенном в 100 раз копиями текущих
+    ингредиентов с числовыми суффиксами."""
+
+    catalog = list(Ingredient.objects.values_list('name', 'measurement_unit'))
+    if not catalog:
+        raise CommandError('Каталог пуст, выполните load_data')
+    for copy in range(1, 100):
+        Ingredient.objects.bulk_create(
+            Ingredient(name=f'{name} {copy}', measurement_unit=unit)
+            for name, unit in catalog)
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute(f'ANALYZE {Ingredient._meta.db_table}')
+    command.stdout.write(f'Ингредиентов: {len(catalog) * 100}')
+    name = catalog[len(catalog) // 2][0]
+    for query in (name[:1], name[:2], name[:3], name[:5], name,
+                  name[1:4], 'несуществующий'):
+        command.measure(f'name={query}', f'/api/ingredients/?name={query}')
+
+
+@scenario('recipes-pagination')
+def recipes_pagination(command, options):
+    """Первая и дальняя страница ленты рецептов по номеру страницы и по
+    курсору. Для страницы 10 000 нужно 60 000 рецептов, см. seed_load."""
+
+    page_size = CursorLimitPagination.page_size
+    pages = Recipe.objects.count() // page_size
+    if not pages:
+        raise CommandError('Нет рецептов, выполните seed_load')
+    deep_page = min(options['deep_page'], pages)
+    # Курсор дальней страницы указывает на последний рецепт предыдущей:
+    position = Recipe.objects.values_list('id', flat=True)[
+        (deep_page - 1) * page_size - 1] if deep_page > 1 else None
+    paginator = CursorLimitPagination()
+    paginator.base_url = '/api/recipes/'
+    deep_cursor = paginator.encode_cursor(Cursor(0, False, position))
+    command.measure('page=1', '/api/recipes/?page=1')
+    command.measure(f'page={deep_page}', f'/api/recipes/?page={deep_page}')
+    command.measure('cursor, первая страница', '/api/recipes/?cursor=')
+    command.measure(f'cursor, страница {deep_page}', deep_cursor)
+
+
+@scenario('recipe-fragments')
+def recipe_fragments_cache(command, options):
+    """Лента и рецепт с пустым и прогретым кэшем фрагментов."""
+
+    recipe = Recipe.objects.first()
+    if recipe is None:
+        raise CommandError('Нет рецептов, выполните seed_load')
+    for label, url in (('лента', '/api/recipes/?limit=50'),
+                       ('рецепт', f'/api/recipes/{recipe.id}/')):
+        with override_settings(CACHES={
+                **settings.CACHES,
+                'recipes': settings.RECIPE_CACHE_BACKENDS['dummy']}):
+            command.measure(f'{label}, без кэша', url)
+        recipe_fragments.reset_stats()
+        command.measure(f'{label}, кэш прогрет', url)
+        hits, misses = recipe_fragments.stats()
+        command.stdout.write(f'Попаданий: {hits}, промахов: {misses}')
+
+
+@scenario('recipes-search')
+def recipes_search(command, options):
+    """Поиск рецептов: первая страница, с фильтром по тэгу и по курсору,
+    без кэша страниц. Для сравнения - поиск вхождением без индекса. На
+    данных seed_load названия и описания составлены из словаря."""
+
+    recipes = Recipe.objects.count()
+    if not recipes:
+        raise CommandError('Нет рецептов, выполните seed_load')
+    command.stdout.write(f'Рецептов: {recipes}')
+    tag = Tag.objects.values_list('slug', flat=True).first()
+    with override_settings(CACHES={
+            **settings.CACHES,
+            'recipes': settings.RECIPE_CACHE_BACKENDS['dummy']}):
+        for query in options['search']:
+            found = Recipe.objects.search(query).count()
+            command.measure(f'search={query}, найдено {found}',
+                            f'/api/recipes/?search={query}')
+            command.measure(f'search={query}&tags={tag}',
+                            f'/api/recipes/?search={query}&tags={tag}')
+            command.measure(f'search={query}&cursor=',
+                            f'/api/recipes/?search={query}&cursor=')
+            matches = Q()
+            for word in query.split():
+                matches &= Q(name__icontains=word) | Q(text__icontains=word)
+            timings = []
+            for _ in range(min(command.repeat, 5)):
+                start = time.perf_counter()
+                list(Recipe.objects.filter(matches)[:6])
+                timings.append((time.perf_counter() - start) * 1000)
+            command.stdout.write(
+                f'icontains {query}: p50 {percentile(timings, 0.5):.2f} мс, '
+                f'max {max(timings):.2f} мс')
+
+
+@scenario('recipes-ingredients')
+def recipes_ingredients(command, options):
+    """Фильтры ленты по ингредиентам на индексе в памяти и, для сравнения,
+    те же фильтры запросами к базе, без кэша страниц. Ингредиенты берутся
+    самые частые."""
+
+    start = time.perf_counter()
+    ingredient_index.build()
+    arrays, bitmaps, size = ingredient_index.stats()
+    command.stdout.write(
+        f'Индекс построен за {time.perf_counter() - start:.1f} с: '
+        f'{arrays} массивов, {bitmaps} битовых карт, {size / 2 ** 20:.1f} МБ')
+    popular = sorted(
+        ingredient_index.postings,
+        key=lambda pk: -sum(1 for _ in bitmap_ids(
+            ingredient_index.bitmap(pk))))[:10]
+    if len(popular) < 10:
+        raise CommandError('Мало ингредиентов, выполните seed_load')
+    pantry = ','.join(map(str, popular[2:10]))
+    tag = Tag.objects.values_list('slug', flat=True).first()
+    cases = (
+        ('ingredients_all', {'all_ids': popular[:2]},
+         f'ingredients_all={popular[0]},{popular[1]}'),
+        ('ingredients_any', {'any_ids': popular[5:10]},
+         f'ingredients_any={",".join(map(str, popular[5:10]))}'),
+        ('ingredients_exclude', {'exclude_ids': popular[:1]},
+         f'ingredients_exclude={popular[0]}'),
+        ('max_missing=1', {'any_ids': popular[2:10], 'max_missing': 1},
+         f'ingredients_any={pantry}&max_missing=1'),
+        ('max_missing=2 и тэг', {'any_ids': popular[2:10], 'max_missing': 2},
+         f'ingredients_any={pantry}&max_missing=2&tags={tag}'),
+    )
+    with override_settings(CACHES={
+            **settings.CACHES,
+            'recipes': settings.RECIPE_CACHE_BACKENDS['dummy']}):
+        for label, filters, query in cases:
+            command.measure(f'{label}, индекс', f'/api/recipes/?{query}')
+            if 'tags' in query:
+                continue
+            timings = []
+            for _ in range(min(command.repeat, 5)):
+                start = time.perf_counter()
+                queryset = Recipe.objects.with_ingredients(**filters)
+                queryset.count()
+                list(queryset[:6])
+                timings.append((time.perf_counter() - start) * 1000)
+            command.stdout.write(
+                f'{label}, запросами к базе: '
+                f'p50 {percentile(timings, 0.5):.2f} мс, '
+                f'max {max(timings):.2f} мс')
+
+
+@scenario('recipes-similar')
+def recipes_similar(command, options):
+    """Похожие рецепты: загрузка векторов, скорость расчета списков и их
+    полнота относительно точного перебора на выборке рецептов,
+    инкрементальный пересчет после изменения ингредиентов нескольких
+    рецептов (изменения откатываются) и сам эндпоинт."""
+
+    start = time.perf_counter()
+    vectors = RecipeVectors.load()
+    size = len(vectors.ids)
+    if size < 100:
+        raise CommandError('Мало рецептов, выполните seed_load')
+    command.stdout.write(
+        f'Векторы {size} рецептов загружены за '
+        f'{time.perf_counter() - start:.1f} с, ненулевых весов '
+        f'{vectors.matrix.nnz}')
+    rows = random.Random(1).sample(range(size), min(size, 5000))
+    start = time.perf_counter()
+    found = {row: set(neighbors.tolist())
+             for row, neighbors, _ in vectors.neighbors(sorted(rows))}
+    elapsed = time.perf_counter() - start
+    command.stdout.write(
+        f'Списки для {len(rows)} рецептов за {elapsed:.1f} с, все рецепты - '
+        f'около {elapsed / len(rows) * size / 60:.1f} мин')
+    # Точный перебор - со всеми рецептами с общими признаками:
+    recall = []
+    for row in rows[:50]:
+        exact = vectors.matrix[row] @ vectors.matrix.T
+        exact[0, row] = 0
+        exact.eliminate_zeros()
+        best = set(top_per_row(exact.tocsr(), TOP)[1].tolist())
+        recall.append(len(best & found[row]) / max(len(best), 1))
+    command.stdout.write(f'Полнота top-{TOP} относительно точного перебора: '
+                         f'{sum(recall) / len(recall):.2f}')
+    if not SimilarRecipes.objects.exists():
+        command.stdout.write('Списков нет, выполните build_similar_recipes')
+        return
+    ingredients = list(Ingredient.objects.values_list('id', flat=True)[:100])
+    changed = [int(vectors.ids[row]) for row in rows[:10]]
+    IngredientsAmount.objects.filter(recipe_id__in=changed).delete()
+    IngredientsAmount.objects.bulk_create(
+        IngredientsAmount(recipe_id=recipe_id, ingredient_id=ingredient,
+                          amount=1)
+        for recipe_id in changed
+        for ingredient in random.Random(recipe_id).sample(ingredients, 6))
+    start = time.perf_counter()
+    counts = Refresh(RecipeVectors.load()).run()
+    command.stdout.write(
+        f'Инкрементальный пересчет после изменения {len(changed)} рецептов: '
+        f'{time.perf_counter() - start:.1f} с, посчитано '
+        f'{counts["changed"]} + {counts["affected"]}, дополнено '
+        f'{counts["merged"]}')
+    recipe_id = SimilarRecipes.objects.values_list(
+        'recipe_id', flat=True).first()
+    command.measure('similar', f'/api/recipes/{recipe_id}/similar/')
+
+
+@scenario('recipes-feed')
+def recipes_feed(command, options):
+    """Лента подписок юзера, подписанного на --feed-follows авторов с
+    наибольшим числом рецептов: выборка с JOIN по подпискам против
+    разложенной ленты, первая и дальняя страницы, ленты с авторами, чьи
+    рецепты подмешиваются при чтении, и раскладка рецепта по лентам
+    подписчиков."""
+
+    authors = list(User.objects.order_by('-recipes_count').values_list(
+        'id', flat=True)[:options['feed_follows']])
+    if len(authors) < 10:
+        raise CommandError('Мало авторов, выполните seed_load')
+    reader = User.objects.create(
+        username='feed_reader', email='feed_reader@benchmark.ru',
+        first_name='Лента', last_name='Подписок')
+    Follow.objects.bulk_create(Follow(user=reader, author_id=author)
+                               for author in authors)
+    FeedEntry.objects.bulk_create(
+        FeedEntry(user=reader, recipe_id=recipe_id)
+        for recipe_id in Recipe.objects.filter(
+            author__in=authors).order_by('-id').values_list(
+            'id', flat=True)[:settings.FEED_LENGTH])
+    client = APIClient(SERVER_NAME='localhost')
+    client.credentials(
+        HTTP_AUTHORIZATION=f'Token {Token.objects.create(user=reader).key}')
+    command.stdout.write(f'Подписок: {len(authors)}')
+    timings = []
+    for _ in range(min(command.repeat, 5)):
+        start = time.perf_counter()
+        list(Recipe.objects.filter(
+            author__following__user=reader).order_by('-id')[:6])
+        timings.append((time.perf_counter() - start) * 1000)
+    command.stdout.write(
+        f'JOIN по подпискам, первая страница: '
+        f'p50 {percentile(timings, 0.5):.2f} мс, max {max(timings):.2f} мс')
+    pulled_authors.clear()
+    command.measure('лента, первая страница', '/api/recipes/feed/', client)
+    url = '/api/recipes/feed/?limit=50'
+    for _ in range(10):
+        url = client.get(url).data['next'] or url
+    command.measure('лента, 11-я страница по 50', url, client)
+    with override_settings(FEED_FANOUT_LIMIT=User.objects.get(
+            id=authors[0]).followers_count - 1):
+        pulled_authors.clear()
+        command.measure(f'лента с подмешиванием рецептов '
+                        f'{len(pulled_authors.get())} авторов',
+                        '/api/recipes/feed/', client)
+    pulled_authors.clear()
+    followers = User.objects.exclude(id=authors[0]).values_list(
+        'id', flat=True)[:settings.FEED_FANOUT_LIMIT]
+    Follow.objects.bulk_create(
+        (Follow(user_id=user_id, author_id=authors[0])
+         for user_id in followers), ignore_conflicts=True)
+    recipe = Recipe.objects.create(
+        name='Рецепт для ленты', author_id=authors[0], text='Описание',
+        image='recipes/benchmark.png', cooking_time=10)
+    start = time.perf_counter()
+    fan_out(recipe)
+    command.stdout.write(
+        f'Раскладка рецепта по лентам '
+        f'{FeedEntry.objects.filter(recipe=recipe).count()} подписчиков: '
+        f'{(time.perf_counter() - start) * 1000:.1f} мс')
+
+
+@scenario('admin-changelists')
+def admin_changelists(command, options):
+    """Списки админки на больших таблицах: рецепты с поиском, фильтрами и
+    сортировкой по популярности, форма рецепта и списки связей. Для
+    сравнения - список рецептов с точным COUNT(*), как у пагинатора
+    Django."""
+
+    recipe = Recipe.objects.order_by('-favorites_count').first()
+    if recipe is None:
+        raise CommandError('Нет рецептов, выполните seed_load')
+    command.stdout.write(f'Рецептов: {Recipe.objects.count()}')
+    client = Client(SERVER_NAME='localhost')
+    client.force_login(User.objects.create_superuser(
+        username='admin_benchmark', email='admin_benchmark@benchmark.ru',
+        password=None, first_name='Админ', last_name='Бенчмарка'))
+    tag = Tag.objects.values_list('id', flat=True).first()
+    author = recipe.author.username
+    for label, url in (
+            ('рецепты', '/admin/recipes/recipe/'),
+            ('рецепты, страница 10', '/admin/recipes/recipe/?p=10'),
+            ('рецепты по популярности', '/admin/recipes/recipe/?o=-5'),
+            ('рецепты с тэгом и временем',
+             f'/admin/recipes/recipe/?tags__id__exact={tag}'
+             f'&cooking_time=60'),
+            ('поиск рецептов по словам', '/admin/recipes/recipe/?q=суп'),
+            ('поиск рецептов автора', f'/admin/recipes/recipe/?q={author}'),
+            ('форма рецепта', f'/admin/recipes/recipe/{recipe.id}/change/'),
+            ('ингредиенты рецептов', '/admin/recipes/ingredientsamount/'),
+            ('избранное', '/admin/recipes/favorite/'),
+            ('избранное юзера', f'/admin/recipes/favorite/?q={author}'),
+            ('корзины', '/admin/recipes/shoppingcart/'),
+            ('списки покупок', '/admin/recipes/shoppinglist/'),
+            ('юзеры', '/admin/users/user/'),
+            ('подписки', '/admin/users/follow/')):
+        command.measure(label, url, client)
+    recipe_admin = admin.site._registry[Recipe]
+    recipe_admin.paginator = Paginator
+    recipe_admin.show_full_result_count = True
+    try:
+        command.measure('рецепты с COUNT(*)', '/admin/recipes/recipe/',
+                        client)
+        command.measure('поиск рецептов по словам с COUNT(*)',
+                        '/admin/recipes/recipe/?q=суп', client)
+    finally:
+        del recipe_admin.paginator, recipe_admin.show_full_result_count
+
+
+@scenario('request-metrics')
+def request_metrics_overhead(command, options):
+    """Цена TimingMiddleware: те же адреса с ним и без него."""
+
+    recipe = Recipe.objects.first()
+    if recipe is None:
+        raise CommandError('Нет рецептов, выполните seed_load')
+    urls = ('/api/tags/', '/api/recipes/?limit=6',
+            f'/api/recipes/{recipe.id}/')
+    without = [name for name in settings.MIDDLEWARE
+               if name != 'foodgram.middleware.TimingMiddleware']
+    for url in urls:
+        with override_settings(MIDDLEWARE=without):
+            command.measure(f'{url} без метрик', url,
+                            APIClient(SERVER_NAME='localhost'))
+        command.measure(f'{url} с метриками', url,
+                        APIClient(SERVER_NAME='localhost'))
+    timings = []
+    for _ in range(command.repeat):
+        start = time.perf_counter()
+        request_metrics.render()
+        timings.append((time.perf_counter() - start) * 1000)
+    command.stdout.write(f'Выдача метрик: p50 {percentile(timings, 0.5):.2f} '
+                         f'мс')
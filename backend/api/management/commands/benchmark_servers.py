@@ -0,0 +1,220 @@
+import asyncio
+import importlib.util
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from recipes.models import Recipe
+
+from api.management.commands.benchmark import percentile
+
+# Команды запуска: как в Dockerfile, sync-воркеры gunicorn под WSGI и
+# воркеры uvicorn под ASGI с асинхронными вьюхами чтения.
+SERVERS = {
+    'wsgi': ['foodgram.wsgi:application'],
+    'asgi': ['foodgram.asgi:application',
+             '--worker-class', 'uvicorn.workers.UvicornWorker'],
+}
+URLS = ('/api/recipes/', '/api/recipes/{recipe}/', '/api/tags/',
+        '/api/ingredients/?name=сол')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def fetch(reader, writer, request):
+    """Отправляет запрос и читает ответ целиком. Возвращает статус и
+    признак того, что сервер закрывает соединение."""
+
+    writer.write(request)
+    await writer.drain()
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError('Сервер закрыл соединение')
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    if headers.get('transfer-encoding') == 'chunked':
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            await reader.readexactly(size + 2)
+            if not size:
+                break
+    else:
+        await reader.readexactly(int(headers.get('content-length', 0)))
+    return (int(status_line.split()[1]),
+            headers.get('connection', '').lower() == 'close')
+
+
+async def client(port, request, deadline, timings, errors):
+    """Один клиент: запросы подряд по keep-alive, пока не истечет
+    deadline. Sync-воркеры gunicorn закрывают соединение после ответа,
+    тогда оно открывается заново."""
+
+    connection = None
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            if connection is None:
+                connection = await asyncio.open_connection('127.0.0.1', port)
+            status, close = await asyncio.wait_for(
+                fetch(*connection, request), timeout=30)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError,
+                ValueError):
+            errors.append(1)
+            close, status = True, None
+        if status is not None:
+            timings.append((time.perf_counter() - start) * 1000)
+            if status >= 500:
+                errors.append(status)
+        if close and connection is not None:
+            connection[1].close()
+            connection = None
+    if connection is not None:
+        connection[1].close()
+
+
+async def slow_client(port, request, deadline, interval):
+    """Медленный клиент: отправляет заголовки запроса по строке раз в
+    interval секунд до deadline. Sync-воркер gunicorn все это время занят
+    чтением запроса, под uvicorn это просто открытый сокет."""
+
+    try:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        head, _, _ = request.partition(b'\r\n')
+        writer.write(head + b'\r\n')
+        while time.perf_counter() < deadline:
+            await asyncio.sleep(interval)
+            writer.write(b'X-Slow: 1\r\n')
+            await writer.drain()
+        writer.close()
+    except OSError:
+        pass
+
+
+async def load(port, path, headers, concurrency, duration, slow_clients=0,
+               slow_interval=1.0):
+    request = (f'GET {quote(path, safe="/?=&")} HTTP/1.1\r\n'
+               f'Host: localhost\r\n{headers}\r\n').encode()
+    timings, errors = [], []
+    deadline = time.perf_counter() + duration
+    await asyncio.gather(
+        *(client(port, request, deadline, timings, errors)
+          for _ in range(concurrency)),
+        *(slow_client(port, request, deadline, slow_interval)
+          for _ in range(slow_clients)))
+    return timings, errors
+
+
+class Command(BaseCommand):
+    help = ('comparing requests per second and latency of read endpoints '
+            'under gunicorn wsgi and uvicorn asgi workers')
+
+    def add_arguments(self, parser):
+        parser.add_argument('urls', nargs='*',
+                            help='адреса, по умолчанию лента, рецепт, '
+                                 'тэги и поиск ингредиентов')
+        parser.add_argument('--servers', nargs='+', choices=list(SERVERS),
+                            default=list(SERVERS))
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--concurrency', type=int, default=200)
+        parser.add_argument('--duration', type=float, default=10,
+                            help='секунд нагрузки на каждый адрес')
+        parser.add_argument('--warmup', type=float, default=2)
+        parser.add_argument('--slow-clients', type=int, default=0,
+                            help='сколько клиентов одновременно шлют '
+                                 'заголовки по строке в секунду')
+        parser.add_argument('--slow-interval', type=float, default=1.0)
+        parser.add_argument('--token', help='токен для запросов от юзера, '
+                                            'например к подпискам')
+
+    def handle(self, *args, **options):
+        for module in ('gunicorn', 'uvicorn'):
+            if importlib.util.find_spec(module) is None:
+                raise CommandError(f'Не найден {module}, см. requirements.txt')
+        recipe = Recipe.objects.order_by('id').first()
+        if recipe is None:
+            raise CommandError('Нет рецептов, выполните seed_load')
+        urls = [url.format(recipe=recipe.id)
+                for url in options['urls'] or URLS]
+        headers = 'Connection: keep-alive\r\n'
+        if options['token']:
+            headers += f'Authorization: Token {options["token"]}\r\n'
+        self.stdout.write(f'Воркеров: {options["workers"]}, клиентов: '
+                          f'{options["concurrency"]}, медленных клиентов: '
+                          f'{options["slow_clients"]}, '
+                          f'{options["duration"]:g} с на адрес')
+        for name in options['servers']:
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            with Server(name, options['workers']) as port:
+                for url in urls:
+                    asyncio.run(load(port, url, headers, 10,
+                                     options['warmup']))
+                    timings, errors = asyncio.run(load(
+                        port, url, headers, options['concurrency'],
+                        options['duration'], options['slow_clients'],
+                        options['slow_interval']))
+                    self.report(url, timings, errors, options['duration'])
+
+    def report(self, url, timings, errors, duration):
+        if not timings:
+            self.stdout.write(f'{url}: нет ответов, ошибок {len(errors)}')
+            return
+        self.stdout.write(
+            f'{url}: {len(timings) / duration:.0f} запросов/с, '
+            f'p50 {percentile(timings, 0.5):.1f} мс, '
+            f'p99 {percentile(timings, 0.99):.1f} мс, '
+            f'ошибок {len(errors)}')
+
+
+class Server:
+    """Сервер в отдельном процессе на свободном порту на время блока
+    with. Настройки и переменные окружения те же, что у команды."""
+
+    def __init__(self, name, workers):
+        self.port = free_port()
+        self.command = [
+            sys.executable, '-m', 'gunicorn', *SERVERS[name],
+            '--workers', str(workers),
+            '--bind', f'127.0.0.1:{self.port}',
+            '--backlog', '4096',
+        ]
+
+    def __enter__(self):
+        self.log = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(
+            self.command, cwd=settings.BASE_DIR,
+            stdout=self.log, stderr=subprocess.STDOUT)
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                break
+            try:
+                socket.create_connection(('127.0.0.1', self.port), 1).close()
+                return self.port
+            except OSError:
+                time.sleep(0.2)
+        self.__exit__()
+        self.log.seek(0)
+        raise CommandError('Сервер не запустился:\n'
+                           + self.log.read().decode(errors='replace')[-2000:])
+
+    def __exit__(self, *exc_info):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self.log.close()
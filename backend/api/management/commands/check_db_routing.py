@@ -0,0 +1,116 @@
+from contextlib import ExitStack
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.test import AsyncClient
+from django.test.utils import CaptureQueriesContext, override_settings
+from foodgram.routers import pin_key
+from recipes.models import Recipe
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+from users.models import User
+
+PRIMARY = 'основная'
+REPLICA = 'реплика'
+
+
+class Command(BaseCommand):
+    help = ('checks that api reads go to replicas and reads after writes '
+            'go to the primary database')
+
+    def handle(self, *args, **options):
+        if not settings.DATABASE_REPLICAS:
+            raise CommandError(
+                'Реплики не настроены. Для проверки на одной базе задайте '
+                'DB_REPLICA_HOSTS=$DB_HOST: реплика будет вторым '
+                'подключением к основной базе.')
+        recipe = Recipe.objects.first()
+        if recipe is None:
+            raise CommandError('Нет рецептов, выполните seed_load')
+        failures = []
+        # Юзер создается в транзакции и откатывается в конце:
+        with transaction.atomic():
+            user = User.objects.create(
+                username='routing', email='routing@routing.ru',
+                first_name='Имя', last_name='Фамилия')
+            token = Token.objects.create(user=user).key
+            for mode, anonymous, client in (
+                ('WSGI', APIClient(SERVER_NAME='localhost'),
+                 APIClient(SERVER_NAME='localhost')),
+                ('ASGI', AsyncClient(), AsyncClient()),
+            ):
+                # Асинхронный клиент всегда ходит на testserver:
+                with override_settings(
+                        ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+                    failures += self.check_mode(recipe, token, mode,
+                                                anonymous, client)
+            transaction.set_rollback(True)
+
+        if failures:
+            raise CommandError('Ошибки маршрутизации:\n' + '\n'.join(failures))
+        self.stdout.write(self.style.SUCCESS('Маршрутизация верна'))
+
+    def check_mode(self, recipe, token, mode, anonymous, client):
+        """Чтение и запись через WSGI- или ASGI-обработчик."""
+
+        failures = []
+        auth = {'Authorization': f'Token {token}'}
+        # Юзер по токену дальше берется из кэша:
+        self.request(client, 'get', '/api/users/me/', auth)
+        for label, who, method, url, expected in (
+            ('тэги', anonymous, 'get', '/api/tags/', REPLICA),
+            ('лента', anonymous, 'get', '/api/recipes/', REPLICA),
+            ('лента', client, 'get', '/api/recipes/', REPLICA),
+            ('рецепт', client, 'get', f'/api/recipes/{recipe.id}/',
+             REPLICA),
+            ('в избранное', client, 'post',
+             f'/api/recipes/{recipe.id}/favorite/', PRIMARY),
+            ('лента после записи', client, 'get', '/api/recipes/',
+             PRIMARY),
+            ('лента другого юзера', anonymous, 'get', '/api/recipes/',
+             REPLICA),
+            ('окно истекло', client, 'get', '/api/recipes/', REPLICA),
+            ('из избранного', client, 'delete',
+             f'/api/recipes/{recipe.id}/favorite/', PRIMARY),
+        ):
+            if label == 'окно истекло':
+                caches[settings.REPLICA_PIN_CACHE].delete(pin_key(token))
+            caches['recipes'].clear()
+            primary, replica = self.count_queries(
+                who, method, url, auth if who is client else {})
+            who = 'auth' if who is client else 'anon'
+            self.stdout.write(f'{mode} {who} {method.upper()} {url} '
+                              f'({label}): основная {primary}, '
+                              f'реплики {replica}')
+            if expected == REPLICA and (primary or not replica):
+                failures.append(f'{mode} {who} {label}: чтение не на реплике')
+            if expected == PRIMARY and replica:
+                failures.append(f'{mode} {who} {label}: чтение с реплики')
+        caches[settings.REPLICA_PIN_CACHE].delete(pin_key(token))
+        return failures
+
+    @staticmethod
+    def request(client, method, url, headers):
+        if not isinstance(client, AsyncClient):
+            return getattr(client, method)(url, headers=headers)
+
+        async def request():
+            return await getattr(client, method)(url, headers=headers)
+
+        return async_to_sync(request)()
+
+    def count_queries(self, client, method, url, headers):
+        """Число запросов к основной базе и ко всем репликам."""
+
+        with ExitStack() as stack:
+            queries = {
+                alias: stack.enter_context(
+                    CaptureQueriesContext(connections[alias]))
+                for alias in (DEFAULT_DB_ALIAS, *settings.DATABASE_REPLICAS)
+            }
+            self.request(client, method, url, headers)
+        return (len(queries.pop(DEFAULT_DB_ALIAS)),
+                sum(len(captured) for captured in queries.values()))
@@ -0,0 +1,357 @@
+import random
+import tempfile
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+from foodgram.routers import primary_only
+from recipes.ingredient_index import ingredient_index
+from recipes.models import (Favorite, FeedEntry, Ingredient,
+                            IngredientsAmount, Recipe, ShoppingCart,
+                            SimilarRecipes, Tag)
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+from users.models import Follow, User
+
+from api.caching import recipe_fragments
+from api.urls import router
+
+PASSWORD = 'Budget-pa55word'
+IMAGE = ('data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJ'
+         'AAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg==')
+PAGE_SIZES = (1, 6, 50)
+
+# Бюджет одного запроса к эндпоинту. В path подставляются id из
+# сгенерированных данных, limits - размеры страниц, на которых число
+# запросов к базе должно совпадать. Для status=304 запрос повторяется с
+# If-None-Match из ETag предыдущего ответа. Кэш сериализованных рецептов
+# очищается перед каждым запросом, с warm=True - прогревается им же.
+Budget = namedtuple(
+    'Budget',
+    'url_name method path auth queries ms status data limits warm',
+    defaults=(200, None, (), False),
+)
+
+BUDGETS = (
+    Budget('api-root', 'get', '/api/', False, 0, 100),
+    Budget('tags-list', 'get', '/api/tags/', False, 2, 50),
+    Budget('tags-list', 'get', '/api/tags/', False, 1, 50, 304),
+    Budget('tags-detail', 'get', '/api/tags/{tag}/', False, 2, 50),
+    Budget('ingredients-list', 'get', '/api/ingredients/', False, 2, 200),
+    Budget('ingredients-list', 'get', '/api/ingredients/', False, 1, 50,
+           304),
+    Budget('ingredients-list', 'get', '/api/ingredients/?name=соль',
+           False, 2, 100),
+    Budget('ingredients-list', 'get', '/api/ingredients/?name=оль',
+           False, 3, 100),
+    Budget('ingredients-detail', 'get', '/api/ingredients/{ingredient}/',
+           False, 2, 50),
+    Budget('recipes-list', 'get', '/api/recipes/', False, 6, 300,
+           limits=PAGE_SIZES),
+    Budget('recipes-list', 'get', '/api/recipes/', False, 1, 100,
+           limits=PAGE_SIZES, warm=True),
+    Budget('recipes-list', 'get', '/api/recipes/?tags={tag_slug}',
+           False, 7, 300, limits=PAGE_SIZES),
+    Budget('recipes-list', 'get',
+           '/api/recipes/?tags={tag_slug}&tags={other_tag_slug}',
+           False, 7, 300, limits=PAGE_SIZES),
+    Budget('recipes-list', 'get', '/api/recipes/?author={author}',
+           False, 7, 300, limits=PAGE_SIZES),
+    Budget('recipes-list', 'get', '/api/recipes/?search=рецепт',
+           False, 6, 300, limits=PAGE_SIZES),
+    Budget('recipes-list', 'get', '/api/recipes/?ingredients_all={ingredient}',
+           False, 7, 300, limits=PAGE_SIZES),
+    Budget('recipes-list', 'get',
+           '/api/recipes/?ingredients_any={ingredient},{other_ingredient}'
+           '&ingredients_exclude={third_ingredient}&max_missing=5',
+           False, 7, 300, limits=PAGE_SIZES),
+    Budget('recipes-list', 'get', '/api/recipes/?cursor=', False, 5, 300,
+           limits=PAGE_SIZES),
+    Budget('recipes-detail', 'get', '/api/recipes/{recipe}/', False, 5, 100),
+    Budget('recipes-detail', 'get', '/api/recipes/{recipe}/', False, 1, 50,
+           304),
+    Budget('recipes-detail', 'get', '/api/recipes/{recipe}/', False, 3, 100,
+           warm=True),
+    Budget('recipes-similar', 'get', '/api/recipes/{recipe}/similar/',
+           False, 5, 100),
+    Budget('users-list', 'post', '/api/users/', False, 5, 1000, 201,
+           {'email': 'new@budget.ru', 'username': 'budget_new',
+            'first_name': 'Новый', 'last_name': 'Юзер',
+            'password': PASSWORD}),
+    Budget('login', 'post', '/api/auth/token/login/', False, 3, 1000, 200,
+           {'email': 'budget@budget.ru', 'password': PASSWORD}),
+
+    Budget('users-me', 'get', '/api/users/me/', True, 0, 50),
+    # Метрики только для staff, юзер бюджетов - нет:
+    Budget('metrics', 'get', '/api/_metrics', True, 0, 50, 403),
+    Budget('users-list', 'get', '/api/users/', True, 3, 100,
+           limits=PAGE_SIZES),
+    Budget('users-detail', 'get', '/api/users/{author}/', True, 2, 50),
+    Budget('users-subscriptions', 'get', '/api/users/subscriptions/',
+           True, 3, 300, limits=PAGE_SIZES),
+    Budget('users-subscriptions', 'get',
+           '/api/users/subscriptions/?recipes_limit=3',
+           True, 3, 300, limits=PAGE_SIZES),
+    Budget('users-subscriptions', 'get',
+           '/api/users/subscriptions/?cursor=&recipes_limit=3',
+           True, 2, 300, limits=PAGE_SIZES),
+    # Подписка добавляет последние рецепты автора в ленту, отписка убирает,
+    # обе в транзакции (точка сохранения здесь) меняют счетчик подписчиков:
+    Budget('users-subscribe', 'post', '/api/users/{stranger}/subscribe/',
+           True, 12, 300, 201),
+    Budget('users-subscribe', 'delete', '/api/users/{stranger}/subscribe/',
+           True, 7, 100, 204),
+    Budget('recipes-list', 'get', '/api/recipes/', True, 5, 300,
+           limits=PAGE_SIZES),
+    Budget('recipes-list', 'get', '/api/recipes/?is_favorited=1',
+           True, 5, 300, limits=PAGE_SIZES),
+    Budget('recipes-list', 'get', '/api/recipes/?is_in_shopping_cart=1',
+           True, 5, 300, limits=PAGE_SIZES),
+    Budget('recipes-list', 'get',
+           '/api/recipes/?tags={tag_slug}&author={author}&is_favorited=1'
+           '&is_in_shopping_cart=1',
+           True, 5, 300, limits=PAGE_SIZES),
+    Budget('recipes-list', 'get',
+           '/api/recipes/?search=рецепт&tags={tag_slug}', True, 6, 300,
+           limits=PAGE_SIZES),
+    # Плюс запрос рецептов-кандидатов для индекса ингредиентов:
+    Budget('recipes-list', 'get',
+           '/api/recipes/?ingredients_exclude={ingredient}&is_favorited=1',
+           True, 7, 300, limits=PAGE_SIZES),
+    Budget('recipes-feed', 'get', '/api/recipes/feed/', True, 6, 300,
+           limits=PAGE_SIZES),
+    Budget('recipes-detail', 'get', '/api/recipes/{recipe}/', True, 5, 100),
+    Budget('recipes-detail', 'get', '/api/recipes/{recipe}/', True, 1, 50,
+           304),
+    Budget('recipes-detail', 'get', '/api/recipes/{recipe}/', True, 3, 100,
+           warm=True),
+    Budget('recipes-similar', 'get', '/api/recipes/{recipe}/similar/',
+           True, 5, 100),
+    # Создание и удаление рецепта меняют счетчик рецептов автора:
+    Budget('recipes-list', 'post', '/api/recipes/', True, 21, 500, 201,
+           {'name': 'Бюджетный рецепт', 'text': 'Описание',
+            'cooking_time': 10, 'image': IMAGE, 'tags': ['{tag}'],
+            'ingredients': [{'id': '{ingredient}', 'amount': 5}]}),
+    Budget('recipes-detail', 'patch', '/api/recipes/{own_recipe}/', True,
+           18, 500, 200,
+           {'name': 'Бюджетный рецепт', 'text': 'Новое описание',
+            'cooking_time': 15, 'image': IMAGE, 'tags': ['{tag}'],
+            'ingredients': [{'id': '{ingredient}', 'amount': 7}]}),
+    # Повторное сохранение без изменений ничего не пишет:
+    Budget('recipes-detail', 'patch', '/api/recipes/{own_recipe}/', True,
+           10, 300, 200,
+           {'name': 'Бюджетный рецепт', 'text': 'Новое описание',
+            'cooking_time': 15, 'tags': ['{tag}'],
+            'ingredients': [{'id': '{ingredient}', 'amount': 7}]}),
+    # Избранное и корзина в транзакции меняют счетчики рецепта:
+    Budget('recipes-favorite', 'post', '/api/recipes/{recipe}/favorite/',
+           True, 6, 100, 201),
+    Budget('recipes-favorite', 'delete', '/api/recipes/{recipe}/favorite/',
+           True, 4, 100, 204),
+    Budget('recipes-shopping-cart', 'post',
+           '/api/recipes/{recipe}/shopping_cart/', True, 9, 100, 201),
+    # Корзина и ингредиенты рецепта удаляются с сигналами, которые ведут
+    # списки покупок, поэтому сначала читаются:
+    Budget('recipes-shopping-cart', 'delete',
+           '/api/recipes/{recipe}/shopping_cart/', True, 8, 100, 204),
+    Budget('recipes-download-shopping-cart', 'get',
+           '/api/recipes/download_shopping_cart/', True, 2, 300),
+    Budget('recipes-download-shopping-cart', 'get',
+           '/api/recipes/download_shopping_cart/?format=csv', True, 2, 300),
+    Budget('recipes-download-shopping-cart', 'get',
+           '/api/recipes/download_shopping_cart/?format=pdf', True, 2, 1000),
+    Budget('recipes-detail', 'delete', '/api/recipes/{own_recipe}/', True,
+           16, 300, 204),
+    # Плюс чтение хэша пароля, его нет в кэше токенов:
+    Budget('users-set-password', 'post', '/api/users/set_password/', True,
+           4, 1000, 204,
+           {'current_password': PASSWORD, 'new_password': PASSWORD[::-1]}),
+    # Смена пароля сбрасывает юзера в кэше токенов, выход - промах:
+    Budget('logout', 'post', '/api/auth/token/logout/', True, 3, 100, 204),
+)
+
+BUDGET_CACHE = {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'check_query_budget',
+}
+
+# Маршруты djoser для сценариев с почтой, на сайте не используются:
+SKIPPED_ROUTES = {
+    'users-activation', 'users-resend-activation', 'users-reset-password',
+    'users-reset-password-confirm', 'users-reset-username',
+    'users-reset-username-confirm', 'users-set-username',
+}
+
+
+class Command(BaseCommand):
+    help = ('checks query count and response time of every api endpoint '
+            'against declared budgets on generated data')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=50)
+        parser.add_argument('--recipes', type=int, default=300)
+        parser.add_argument('--ingredients', type=int, default=500)
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--time-factor', type=float, default=1.0,
+                            help='множитель бюджетов времени')
+
+    def handle(self, *args, **options):
+        self.check_coverage()
+        failures = []
+        # Все данные создаются в транзакции и откатываются в конце, реплики
+        # их не видят:
+        with primary_only(), transaction.atomic(), \
+                tempfile.TemporaryDirectory() as media_root, \
+                override_settings(MEDIA_ROOT=media_root,
+                                  CACHES={**settings.CACHES,
+                                          'recipes': BUDGET_CACHE}):
+            ids = self.seed(options)
+            # Индекс ингредиентов строится здесь, а не в фоне: фоновый поток
+            # не видит данных этой транзакции.
+            ingredient_index.build()
+            anonymous = APIClient(SERVER_NAME='localhost')
+            client = APIClient(SERVER_NAME='localhost')
+            client.credentials(HTTP_AUTHORIZATION=f'Token {ids["token"]}')
+            # Юзер по токену берется из кэша, см. api/authentication.py:
+            client.get('/api/users/me/')
+            for budget in BUDGETS:
+                failures += self.check_budget(
+                    client if budget.auth else anonymous, budget, ids,
+                    options['time_factor'])
+            transaction.set_rollback(True)
+
+        if failures:
+            raise CommandError('Превышены бюджеты:\n' + '\n'.join(failures))
+        self.stdout.write(self.style.SUCCESS('Все бюджеты соблюдены'))
+
+    def check_coverage(self):
+        routes = {url.name for url in router.urls} | {'login', 'logout'}
+        missing = routes - SKIPPED_ROUTES - {b.url_name for b in BUDGETS}
+        if missing:
+            raise CommandError(
+                f'Нет бюджета для маршрутов: {", ".join(sorted(missing))}')
+
+    def check_budget(self, client, budget, ids, time_factor):
+        path = budget.path.format(**ids)
+        data = fill(budget.data, ids)
+        who = 'auth' if budget.auth else 'anon'
+        failures = []
+        counts = set()
+        for limit in budget.limits or (None,):
+            url = path
+            if limit:
+                url += f'{"&" if "?" in url else "?"}limit={limit}'
+            label = f'{who} {budget.method.upper()} {url}'
+            headers = {}
+            if budget.warm:
+                label += ' (кэш прогрет)'
+                client.get(url)
+            else:
+                recipe_fragments.cache.clear()
+            if budget.status == 304:
+                label += ' (If-None-Match)'
+                headers['HTTP_IF_NONE_MATCH'] = client.get(url)['ETag']
+            with CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                response = getattr(client, budget.method)(
+                    url, data, format='json', **headers)
+                if response.streaming:
+                    b''.join(response.streaming_content)
+                elapsed = (time.perf_counter() - start) * 1000
+            counts.add(len(queries))
+            self.stdout.write(f'{label}: {response.status_code}, '
+                              f'{len(queries)} запросов, {elapsed:.1f} мс')
+            if response.status_code != budget.status:
+                failures.append(f'{label}: статус {response.status_code}, '
+                                f'ожидался {budget.status}')
+            if len(queries) > budget.queries:
+                failures.append(f'{label}: {len(queries)} запросов, '
+                                f'бюджет {budget.queries}')
+            if elapsed > budget.ms * time_factor:
+                failures.append(f'{label}: {elapsed:.1f} мс, '
+                                f'бюджет {budget.ms * time_factor:.0f} мс')
+        if len(counts) > 1:
+            failures.append(f'{who} {budget.method.upper()} {path}: число '
+                            f'запросов зависит от размера страницы {counts}')
+        return failures
+
+    def seed(self, options):
+        rnd = random.Random(options['seed'])
+        password = make_password(PASSWORD)
+        users = User.objects.bulk_create(
+            User(username=f'budget_{i}', email=f'budget_{i}@budget.ru',
+                 first_name='Имя', last_name='Фамилия', password=password)
+            for i in range(options['users']))
+        user = User.objects.create(
+            username='budget', email='budget@budget.ru', first_name='Имя',
+            last_name='Фамилия', password=password)
+        tags = Tag.objects.bulk_create(
+            # Цвета вне HexColors, чтобы не пересечься с тэгами в базе:
+            Tag(name=f'budget_{i}', slug=f'budget_{i}', color=f'#BD00{i:02X}')
+            for i in range(3))
+        ingredients = Ingredient.objects.bulk_create(
+            Ingredient(name=f'{rnd.choice(("соль", "сахар", "мука"))} {i}',
+                       measurement_unit='г')
+            for i in range(options['ingredients']))
+        recipes = Recipe.objects.bulk_create(
+            Recipe(name=f'Рецепт {i}', author=rnd.choice(users + [user]),
+                   image='recipes/budget.png', text='Описание рецепта',
+                   cooking_time=rnd.randint(1, 120))
+            for i in range(options['recipes']))
+        Recipe.tags.through.objects.bulk_create(
+            Recipe.tags.through(recipe=recipe, tag=tag)
+            for recipe in recipes for tag in rnd.sample(tags, 2))
+        IngredientsAmount.objects.bulk_create(
+            IngredientsAmount(recipe=recipe, ingredient=ingredient,
+                              amount=rnd.randint(1, 500))
+            for recipe in recipes
+            for ingredient in rnd.sample(ingredients, rnd.randint(3, 10)))
+        follows = Follow.objects.bulk_create(
+            Follow(user=user, author=author)
+            for author in rnd.sample(users[1:], len(users) // 2))
+        followed = {follow.author_id for follow in follows}
+        FeedEntry.objects.bulk_create(
+            FeedEntry(user=user, recipe=recipe)
+            for recipe in recipes if recipe.author_id in followed)
+        Favorite.objects.bulk_create(
+            Favorite(user=user, recipe=recipe)
+            for recipe in rnd.sample(recipes[1:], len(recipes) // 5))
+        ShoppingCart.objects.bulk_create(
+            ShoppingCart(user=user, recipe=recipe)
+            for recipe in rnd.sample(recipes[1:], len(recipes) // 10))
+        SimilarRecipes.objects.create(
+            recipe=recipes[0], fingerprint=0,
+            neighbors=SimilarRecipes.pack(
+                [recipe.id for recipe in recipes[1:11]],
+                [1 - i / 10 for i in range(10)]))
+        return {
+            'token': Token.objects.create(user=user).key,
+            'tag': tags[0].id,
+            'tag_slug': tags[0].slug,
+            'other_tag_slug': tags[1].slug,
+            'ingredient': ingredients[0].id,
+            'other_ingredient': ingredients[1].id,
+            'third_ingredient': ingredients[2].id,
+            'recipe': recipes[0].id,
+            'own_recipe': Recipe.objects.create(
+                name='Свой рецепт', author=user, image='recipes/budget.png',
+                text='Описание', cooking_time=5).id,
+            'author': users[1].id,
+            'stranger': users[0].id,
+        }
+
+
+def fill(data, ids):
+    """Подставляет id сгенерированных объектов в тело запроса."""
+
+    if isinstance(data, dict):
+        return {key: fill(value, ids) for key, value in data.items()}
+    if isinstance(data, list):
+        return [fill(value, ids) for value in data]
+    if isinstance(data, str) and data.startswith('{'):
+        return ids[data[1:-1]]
+    return data
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from api.caching import recipe_fragments
+
+
+class Command(BaseCommand):
+    help = 'printing hit and miss counters of the recipe fragment cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true',
+                            help='обнулить счетчики')
+
+    def handle(self, *args, **options):
+        hits, misses = recipe_fragments.stats()
+        total = hits + misses
+        ratio = hits / total * 100 if total else 0
+        backend = recipe_fragments.cache.__class__.__name__
+        self.stdout.write(f'Бэкенд: {backend}\n'
+                          f'Попаданий: {hits}, промахов: {misses}, '
+                          f'доля попаданий: {ratio:.1f}%')
+        if options['reset']:
+            recipe_fragments.reset_stats()
+            self.stdout.write('Счетчики обнулены')
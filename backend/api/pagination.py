@@ -1,8 +1,87 @@
-from rest_framework.pagination import PageNumberPagination
+from django.conf import settings
+from recipes.feed import feed_ids
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import (Cursor, CursorPagination,
+                                       PageNumberPagination)
 
 
 class PageNumberLimitPagination(PageNumberPagination):
-    """Отображение 6 рецептов на странице."""
+    """Отображение 6 рецептов на странице, не больше 100 по limit."""
 
     page_size = 6
     page_size_query_param = 'limit'
+    max_page_size = 100
+
+
+class CursorLimitPagination(CursorPagination):
+    """Постраничный вывод по курсору: следующая страница ищется по индексу
+    от последнего показанного id, без OFFSET и без COUNT(*). Первая
+    страница запрашивается с пустым параметром ?cursor=."""
+
+    page_size = 6
+    page_size_query_param = 'limit'
+    max_page_size = 100
+    ordering = '-id'
+
+
+class SubscriptionsCursorPagination(CursorLimitPagination):
+    """Курсор по id подписки, аннотированному в кверисете подписок."""
+
+    ordering = '-follow_id'
+
+
+class FeedCursorPagination(CursorLimitPagination):
+    """Курсор ленты подписок. Страница собирается из двух запросов, см.
+    recipes/feed.py, поэтому курсор хранит id последнего показанного рецепта
+    и сколько рецептов уже показано: лента обрывается на FEED_LENGTH.
+    Ссылки на предыдущую страницу нет."""
+
+    offset_cutoff = settings.FEED_LENGTH
+
+    def paginate_feed(self, user, request):
+        """id рецептов страницы ленты юзера."""
+
+        self.base_url = request.build_absolute_uri()
+        cursor = self.decode_cursor(request)
+        before, shown = None, 0
+        if cursor is not None:
+            try:
+                before, shown = int(cursor.position), cursor.offset
+            except (TypeError, ValueError):
+                raise NotFound(self.invalid_cursor_message)
+        size = max(0, min(self.get_page_size(request),
+                          settings.FEED_LENGTH - shown))
+        ids = feed_ids(user, before, size + 1) if size else []
+        self.has_next = (len(ids) > size
+                         and shown + size < settings.FEED_LENGTH)
+        ids = ids[:size]
+        if ids:
+            self.next_cursor = Cursor(offset=shown + len(ids),
+                                      reverse=False, position=ids[-1])
+        return ids
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        return self.encode_cursor(self.next_cursor)
+
+    def get_previous_link(self):
+        return None
+
+
+class CursorPaginationMixin:
+    """Переключает вьюсет на постраничный вывод по курсору, если в запросе
+    есть параметр cursor и для действия задан класс в
+    cursor_pagination_classes. Иначе работает pagination_class."""
+
+    cursor_pagination_classes = {}
+
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator'):
+            pagination_class = self.cursor_pagination_classes.get(self.action)
+            if (pagination_class is not None
+                    and pagination_class.cursor_query_param
+                    in self.request.query_params):
+                self._paginator = pagination_class()
+        return super().paginator
@@ -0,0 +1,43 @@
+from rest_framework.negotiation import DefaultContentNegotiation
+from rest_framework.renderers import JSONRenderer
+
+
+class ShoppingListRenderer(JSONRenderer):
+    """Формат списка покупок, выбирается параметром ?format=. Сам файл
+    отдается потоком из вьюсета, через рендерер проходят только ошибки, и
+    они отдаются как JSON."""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        response = (renderer_context or {}).get('response')
+        if response is not None:
+            response['Content-Type'] = JSONRenderer.media_type
+        return super().render(data, None, renderer_context)
+
+
+class TxtRenderer(ShoppingListRenderer):
+    media_type = 'text/plain'
+    format = 'txt'
+
+
+class CSVRenderer(ShoppingListRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+
+
+class PDFRenderer(ShoppingListRenderer):
+    media_type = 'application/pdf'
+    format = 'pdf'
+
+
+class ShoppingListNegotiation(DefaultContentNegotiation):
+    """Формат файла из ?format= выбирается без оглядки на Accept: клиенты
+    API шлют Accept: application/json. Без параметра формат выбирается по
+    Accept как обычно."""
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        file_format = format_suffix or request.query_params.get(
+            self.settings.URL_FORMAT_OVERRIDE)
+        for renderer in renderers:
+            if file_format and renderer.format == file_format:
+                return renderer, renderer.media_type
+        return super().select_renderer(request, renderers, format_suffix)
@@ -1,12 +1,33 @@
 from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator
+from django.db import models, transaction
+from django.db.models import prefetch_related_objects
 from drf_extra_fields.fields import Base64ImageField
-from recipes.models import Ingredient, IngredientsAmount, Recipe, Tag
+from foodgram.metrics import serializing
+from recipes.feed import fan_out
+from recipes.models import (Ingredient, IngredientsAmount, Recipe,
+                            ShoppingList, Tag)
+from recipes.renditions import rendition_name
 from rest_framework import serializers, validators, exceptions
 from rest_framework.fields import SerializerMethodField
 from rest_framework.validators import UniqueTogetherValidator
 from users.models import User
 
+from .caching import recipe_fragments
+
+
+class TimedSerializerMixin:
+    """Время получения data попадает в Server-Timing и метрики запроса."""
+
+    @property
+    def data(self):
+        with serializing():
+            return super().data
+
+
+class TimedListSerializer(TimedSerializerMixin, serializers.ListSerializer):
+    pass
+
 
 class CreateUserSerializer(serializers.ModelSerializer):
     """Сериализатор создания юзера."""
@@ -31,7 +52,7 @@ class CreateUserSerializer(serializers.ModelSerializer):
         }
 
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     """Сериализатор юзера."""
 
     is_subscribed = serializers.SerializerMethodField(read_only=True)
@@ -40,24 +61,55 @@ class UserSerializer(serializers.ModelSerializer):
         model = User
         fields = ('email', 'id', 'username', 'first_name', 'last_name',
                   'is_subscribed')
+        list_serializer_class = TimedListSerializer
 
     def get_is_subscribed(self, obj):
+        # Флаг уже посчитан в кверисете Recipe.objects.with_user_flags:
+        if hasattr(obj, 'is_subscribed'):
+            return obj.is_subscribed
         user = self.context.get('request').user
         if user.is_anonymous or user is None:
             return False
         return user.follower.filter(author=obj).exists()
 
 
-class MiniRecipeSerializer(serializers.ModelSerializer):
+def rendition_url(recipe, size, image_format, request=None):
+    if not recipe.image:
+        return None
+    url = recipe.image.storage.url(
+        rendition_name(recipe, size, image_format))
+    return request.build_absolute_uri(url) if request else url
+
+
+class RenditionField(serializers.Field):
+    """Ссылка на уменьшенную копию фото рецепта в формате image_format,
+    пока копии нет - на оригинал. Без size размер берется из контекста
+    сериализатора: card для ленты, full для страницы рецепта."""
+
+    def __init__(self, size=None, image_format='jpeg', **kwargs):
+        self.size = size
+        self.image_format = image_format
+        kwargs.update(source='*', read_only=True)
+        super().__init__(**kwargs)
+
+    def to_representation(self, recipe):
+        size = self.size or self.context.get('rendition', 'card')
+        return rendition_url(recipe, size, self.image_format,
+                             self.context.get('request'))
+
+
+class MiniRecipeSerializer(TimedSerializerMixin,
+                           serializers.ModelSerializer):
     """Сериализатор модели Recipe с укороченным набором полей для сериализатора
      подписок"""
 
-    image = Base64ImageField()
+    image = RenditionField('thumbnail')
+    image_webp = RenditionField('thumbnail', 'webp')
 
     class Meta:
         model = Recipe
-        fields = ('id', 'name', 'image', 'cooking_time')
-        read_only_fields = ('id', 'name', 'image', 'cooking_time')
+        fields = ('id', 'name', 'image', 'image_webp', 'cooking_time')
+        read_only_fields = ('id', 'name', 'cooking_time')
 
 
 class FollowSerializer(UserSerializer):
@@ -75,34 +127,35 @@ class FollowSerializer(UserSerializer):
         request = self.context.get('request')
         if not request or request.user.is_anonymous:
             return False
-        limit = request.query_params.get('recipes_limit')
-        recipes = obj.recipes.select_related('author')
-        if limit:
-            recipes = recipes[:int(limit)]
-        serializer = MiniRecipeSerializer(recipes, many=True, read_only=True)
+        # Рецепты уже подгружены и обрезаны по recipes_limit во вьюсете:
+        serializer = MiniRecipeSerializer(obj.recipes.all(), many=True,
+                                          read_only=True)
         return serializer.data
 
     def get_recipes_count(self, obj):
-        return obj.recipes.count()
+        return obj.recipes_count
 
     def get_is_subscribed(self, obj):
         return True
 
 
-class IngredientSerializer(serializers.ModelSerializer):
+class IngredientSerializer(TimedSerializerMixin,
+                           serializers.ModelSerializer):
     """Сериализатор модели ингредиентов."""
 
     class Meta:
         model = Ingredient
         fields = '__all__'
+        list_serializer_class = TimedListSerializer
 
 
-class TagSerializer(serializers.ModelSerializer):
+class TagSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     """Сериалиатор модели тэгов."""
 
     class Meta:
         model = Tag
         fields = '__all__'
+        list_serializer_class = TimedListSerializer
 
 
 class IngredientsAmountSerializer(serializers.ModelSerializer):
@@ -127,36 +180,95 @@ class IngredientsAmountSerializer(serializers.ModelSerializer):
         ]
 
 
-class RecipeSerializer(serializers.ModelSerializer):
-    """Сериализатор модели рецептов (создание, обновление, чтение рецепта)."""
+class RecipeListSerializer(TimedListSerializer):
+    """Собирает страницу рецептов из кэша фрагментов одним обращением к
+    кэшу."""
+
+    def to_representation(self, data):
+        if isinstance(data, models.Manager):
+            data = data.all()
+        return self.child.represent(list(data))
+
+
+class RecipeFragmentSerializer(TimedSerializerMixin,
+                               serializers.ModelSerializer):
+    """Поля рецепта, одинаковые для всех юзеров, для кэша фрагментов.
+    Сериализуется без request, поэтому ссылка на картинку относительная."""
 
-    author = UserSerializer(read_only=True)
     tags = TagSerializer(many=True, read_only=True)
+    ingredients = SerializerMethodField()
+
+    class Meta:
+        model = Recipe
+        fields = ('id', 'name', 'tags', 'ingredients', 'text',
+                  'cooking_time')
+
+    def get_ingredients(self, recipe):
+        ingredients = recipe.recipes_ingredients.all()
+        return IngredientsAmountSerializer(ingredients, many=True).data
+
+
+class RecipeSerializer(RecipeFragmentSerializer):
+    """Сериализатор модели рецептов (создание, обновление, чтение рецепта).
+    Поля, одинаковые для всех юзеров, берутся из кэша фрагментов, поверх
+    них подставляются автор, флаги текущего юзера и ссылки на копии фото
+    нужного размера."""
+
+    author = UserSerializer(read_only=True)
     image = Base64ImageField()
+    image_webp = RenditionField(image_format='webp')
     cooking_time = serializers.IntegerField(
         validators=(MinValueValidator(
             1, 'Время приготовления должно быть больше 0'),))
-    ingredients = SerializerMethodField()
     is_favorited = SerializerMethodField(read_only=True)
     is_in_shopping_cart = SerializerMethodField(read_only=True)
 
     class Meta:
         model = Recipe
         fields = ('id', 'name', 'author', 'tags', 'ingredients', 'image',
-                  'text', 'cooking_time', 'is_favorited',
+                  'image_webp', 'text', 'cooking_time', 'is_favorited',
                   'is_in_shopping_cart')
-
-    def get_ingredients(self, recipe):
-        ingredients = recipe.recipes_ingredients.filter(recipe=recipe)
-        return IngredientsAmountSerializer(ingredients, many=True).data
+        list_serializer_class = RecipeListSerializer
+
+    def to_representation(self, recipe):
+        return self.represent([recipe])[0]
+
+    def represent(self, recipes):
+        fragments = recipe_fragments.get_many(recipes)
+        missing = [recipe for recipe in recipes if recipe.pk not in fragments]
+        if missing:
+            prefetch_related_objects(missing,
+                                     *Recipe.objects.related_lookups())
+            new = {recipe.pk: RecipeFragmentSerializer(recipe).data
+                   for recipe in missing}
+            recipe_fragments.set_many(missing, new)
+            fragments.update(new)
+        return [self.merge(fragments[recipe.pk], recipe) for recipe in recipes]
+
+    def merge(self, fragment, recipe):
+        request = self.context.get('request')
+        size = self.context.get('rendition', 'card')
+        data = dict(fragment)
+        data.update(
+            image=rendition_url(recipe, size, 'jpeg', request),
+            image_webp=rendition_url(recipe, size, 'webp', request),
+            author=UserSerializer(recipe.author, context=self.context).data,
+            is_favorited=self.get_is_favorited(recipe),
+            is_in_shopping_cart=self.get_is_in_shopping_cart(recipe),
+        )
+        return {field: data[field] for field in self.Meta.fields}
 
     def get_is_favorited(self, recipe):
+        if hasattr(recipe, 'is_favorited'):
+            return recipe.is_favorited
         user = self.context.get('request').user
         if user.is_anonymous:
             return False
         return user.favorite.filter(recipe=recipe).exists()
 
     def get_is_in_shopping_cart(self, recipe):
+        if hasattr(recipe, 'is_in_shopping_cart'):
+            return recipe.is_in_shopping_cart
         user = self.context.get('request').user
         if user.is_anonymous:
             return False
@@ -211,18 +323,20 @@ class RecipeSerializer(serializers.ModelSerializer):
             raise exceptions.ValidationError({
                 'tags': 'Нужно выбрать хотя бы оин тэг'
             })
-        valid_tags = []
-        for tag in tags:
-            if not Tag.objects.filter(id__in=tags).exists():
-                raise exceptions.ValidationError({
-                    'tags': 'Такой тэг пока не добавили, '
-                            'обратитесь к админу :)'
-                })
-            if tag in valid_tags:
-                raise exceptions.ValidationError({
-                    'tags': 'Вы уже добавили этот тэг, проверьте :)'
-                })
-            valid_tags.append(tag)
+        if len(set(tags)) != len(tags):
+            raise exceptions.ValidationError({
+                'tags': 'Вы уже добавили этот тэг, проверьте :)'
+            })
+        try:
+            tag_ids = {int(tag) for tag in tags}
+        except (TypeError, ValueError):
+            raise exceptions.ValidationError({'tags': 'Укажите id тэгов'})
+        # Все тэги проверяются одним запросом:
+        if Tag.objects.filter(id__in=tag_ids).count() != len(tag_ids):
+            raise exceptions.ValidationError({
+                'tags': 'Такой тэг пока не добавили, '
+                        'обратитесь к админу :)'
+            })
         return tags
 
     def validate_cooking_time(self, cooking_time):
@@ -241,28 +355,82 @@ class RecipeSerializer(serializers.ModelSerializer):
                 amount=amount))
         recipe.recipes_ingredients.bulk_create(ingredients_amount)
 
+    @transaction.atomic
     def create(self, validated_data) -> Recipe:
+        """Создает рецепт и добавляет его в ленты подписчиков автора."""
+
         ingredients = validated_data.pop('ingredients')
         tags = validated_data.pop('tags')
         image = validated_data.pop('image')
         recipe = Recipe.objects.create(image=image, **validated_data)
         recipe.tags.set(tags)
         self.create_ingredients_amount(ingredients, recipe)
+        fan_out(recipe)
         return recipe
 
+    @transaction.atomic
     def update(self, recipe, validated_data):
+        """Пишет в базу только изменения: поля рецепта, которые поменялись,
+        добавленные, измененные и удаленные ингредиенты и тэги."""
+
         ingredients = validated_data.pop('ingredients')
         tags = validated_data.pop('tags')
 
-        for key, value in validated_data.items():
-            if hasattr(recipe, key):
-                setattr(recipe, key, value)
-        if ingredients:
-            recipe.ingredients.clear()
-            self.create_ingredients_amount(ingredients, recipe)
-        if tags:
-            recipe.tags.clear()
-            recipe.tags.set(tags)
-
-        recipe.save()
+        changed_fields = [
+            key for key, value in validated_data.items()
+            if hasattr(recipe, key)
+            and (key == 'image' or getattr(recipe, key) != value)]
+        for key in changed_fields:
+            setattr(recipe, key, validated_data[key])
+        ingredients_changed = self.update_ingredients_amount(ingredients,
+                                                             recipe)
+        tags_changed = self.update_tags(tags, recipe)
+
+        if changed_fields or ingredients_changed or tags_changed:
+            recipe.save(update_fields=[*changed_fields, 'modified'])
         return recipe
+
+    @staticmethod
+    def update_ingredients_amount(ingredients, recipe):
+        """Приводит ингредиенты рецепта к ingredients не больше чем тремя
+        запросами на запись и пересчитывает списки покупок юзеров с рецептом
+        в корзине. Возвращает True, если что-то изменилось."""
+
+        new_amounts = {ingredient.id: amount
+                       for ingredient, amount in ingredients.values()}
+        rows = {ingredient_id: (row_id, amount)
+                for row_id, ingredient_id, amount
+                in recipe.recipes_ingredients.values_list(
+                    'id', 'ingredient_id', 'amount')}
+        deleted = [row_id for ingredient_id, (row_id, _) in rows.items()
+                   if ingredient_id not in new_amounts]
+        created = [IngredientsAmount(recipe=recipe, ingredient_id=ingredient,
+                                     amount=amount)
+                   for ingredient, amount in new_amounts.items()
+                   if ingredient not in rows]
+        updated = [IngredientsAmount(id=rows[ingredient][0], amount=amount)
+                   for ingredient, amount in new_amounts.items()
+                   if ingredient in rows and rows[ingredient][1] != amount]
+        if deleted:
+            IngredientsAmount.objects.filter(id__in=deleted).delete()
+        if created:
+            IngredientsAmount.objects.bulk_create(created)
+        if updated:
+            IngredientsAmount.objects.bulk_update(updated, ['amount'])
+
+        # Удаленные ингредиенты вычитает из списков сигнал post_delete, а
+        # bulk_create и bulk_update сигналов не шлют:
+        ShoppingList.objects.change_recipe(recipe.id, {
+            ingredient: amount - rows.get(ingredient, (None, 0))[1]
+            for ingredient, amount in new_amounts.items()})
+        return bool(deleted or created or updated)
+
+    @staticmethod
+    def update_tags(tags, recipe):
+        new_tags = {int(tag) for tag in tags}
+        old_tags = set(recipe.tags.values_list('id', flat=True))
+        if old_tags - new_tags:
+            recipe.tags.remove(*(old_tags - new_tags))
+        if new_tags - old_tags:
+            recipe.tags.add(*(new_tags - old_tags))
+        return new_tags != old_tags
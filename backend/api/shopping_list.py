@@ -0,0 +1,105 @@
+import csv
+import io
+from datetime import datetime
+
+from django.conf import settings
+from recipes.models import ShoppingList
+
+SITE_SIGNATURE = 'Создано на сайте foodgram.catiska.ru пользователем {}'
+PDF_CHUNK_SIZE = 64 * 1024
+
+
+def get_ingredients(user):
+    """Суммарное количество каждого ингредиента из корзины юзера из
+    заранее посчитанной таблицы ShoppingList. Строки читаются из базы
+    курсором, без загрузки всего списка в память."""
+
+    return ShoppingList.objects.filter(
+        user=user
+    ).order_by(
+        'ingredient__name'
+    ).values(
+        'ingredient__name', 'ingredient__measurement_unit', 'amount'
+    ).iterator()
+
+
+def render_txt(user, ingredients):
+    yield 'Список покупок:\n'
+    for num, ingredient in enumerate(ingredients):
+        yield (f'\n{num + 1}. {ingredient["ingredient__name"]} - '
+               f'{ingredient["amount"]} '
+               f'{ingredient["ingredient__measurement_unit"]}')
+    yield (f'\n\n\n{datetime.today():%d.%m.%Y}\n'
+           + SITE_SIGNATURE.format(user.get_full_name()))
+
+
+class Echo:
+    """Псевдобуфер для csv.writer: возвращает строку вместо записи."""
+
+    def write(self, value):
+        return value
+
+
+def render_csv(user, ingredients):
+    writer = csv.writer(Echo())
+    # BOM, чтобы Excel открыл кириллицу в utf-8:
+    yield '\ufeff' + writer.writerow(
+        ('№', 'Ингредиент', 'Количество', 'Единица измерения'))
+    for num, ingredient in enumerate(ingredients):
+        yield writer.writerow((num + 1, ingredient['ingredient__name'],
+                               ingredient['amount'],
+                               ingredient['ingredient__measurement_unit']))
+
+
+def render_pdf(user, ingredients):
+    """PDF собирается постранично по мере чтения строк из базы и отдается
+    кусками. Формат требует таблицу ссылок в конце файла, поэтому отдача
+    начинается после сборки документа."""
+
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+    from reportlab.pdfgen import canvas
+
+    pdfmetrics.registerFont(TTFont('ShoppingList',
+                                   settings.SHOPPING_LIST_PDF_FONT))
+    buffer = io.BytesIO()
+    pdf = canvas.Canvas(buffer, pagesize=A4)
+    width, height = A4
+    margin, line_height = 50, 18
+
+    def new_page():
+        pdf.setFont('ShoppingList', 12)
+        return height - margin
+
+    y = new_page()
+    pdf.setFont('ShoppingList', 16)
+    pdf.drawString(margin, y, 'Список покупок:')
+    y -= line_height * 2
+    pdf.setFont('ShoppingList', 12)
+    for num, ingredient in enumerate(ingredients):
+        if y < margin:
+            pdf.showPage()
+            y = new_page()
+        pdf.drawString(margin, y,
+                       f'{num + 1}. {ingredient["ingredient__name"]} - '
+                       f'{ingredient["amount"]} '
+                       f'{ingredient["ingredient__measurement_unit"]}')
+        y -= line_height
+    if y < margin + line_height * 3:
+        pdf.showPage()
+        y = new_page()
+    y -= line_height
+    pdf.drawString(margin, y, f'{datetime.today():%d.%m.%Y}')
+    pdf.drawString(margin, y - line_height,
+                   SITE_SIGNATURE.format(user.get_full_name()))
+    pdf.save()
+    buffer.seek(0)
+    yield from iter(lambda: buffer.read(PDF_CHUNK_SIZE), b'')
+
+
+RENDERERS = {
+    'txt': (render_txt, 'text/plain; charset=utf-8'),
+    'csv': (render_csv, 'text/csv; charset=utf-8'),
+    'pdf': (render_pdf, 'application/pdf'),
+}
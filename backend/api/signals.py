@@ -0,0 +1,24 @@
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from .authentication import token_cache
+
+
+@receiver(post_delete, sender=Token)
+def forget_token(sender, instance, **kwargs):
+    """Выход (auth/token/logout) и удаление юзера удаляют токен."""
+
+    token_cache.delete(instance.key)
+
+
+@receiver(post_save, sender=get_user_model())
+def forget_user_tokens(sender, instance, created, update_fields, **kwargs):
+    """Смена пароля, деактивация и любое другое изменение юзера, кроме
+    отметки о входе, сбрасывают его снимок в кэше токенов."""
+
+    if created or (update_fields and set(update_fields) <= {'last_login'}):
+        return
+    token_cache.delete(*Token.objects.filter(
+        user_id=instance.pk).values_list('key', flat=True))
@@ -1,8 +1,8 @@
 from django.urls import include, path
 from rest_framework.routers import DefaultRouter
 
-from .views import (UserViewSet, IngredientViewSet, RecipeViewSet,
-                    TagViewSet)
+from .views import (UserViewSet, IngredientViewSet, MetricsView,
+                    RecipeViewSet, TagViewSet)
 
 app_name = 'api'
 
@@ -14,5 +14,6 @@ router.register('recipes', RecipeViewSet, 'recipes')
 
 urlpatterns = [
     path('', include(router.urls)),
-    path('auth/', include('djoser.urls.authtoken'),)
+    path('auth/', include('djoser.urls.authtoken'),),
+    path('_metrics', MetricsView.as_view(), name='metrics'),
 ]
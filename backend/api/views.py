@@ -1,32 +1,47 @@
-from datetime import datetime
+import hashlib
+from functools import partial
+from urllib.parse import urlencode
 
-from django.db.models import Sum
-from django.http import HttpResponse
+from django.db import transaction
+from django.db.models import F, Prefetch, Window
+from django.db.models.functions import RowNumber
+from django.http import HttpResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django_filters.rest_framework import DjangoFilterBackend
 from djoser.views import UserViewSet as Djoserviewset
-from recipes.models import (Favorite, Ingredient, IngredientsAmount, Recipe,
-                            ShoppingCart, Tag)
-from rest_framework import status
+from foodgram.metrics import request_metrics
+from recipes.models import (ChangeStamp, Favorite, Ingredient, Recipe,
+                            ShoppingCart, SimilarRecipes, Tag)
+from rest_framework import generics, status
 from rest_framework.decorators import action
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
+from rest_framework.views import APIView
 from rest_framework.viewsets import ModelViewSet, ReadOnlyModelViewSet
 from users.models import Follow, User
 
+from .caching import ConditionalGetMixin, TableVersionMixin, recipe_pages
 from .filters import IngredientSearchFilter, RecipeFilterSet
-from .pagination import PageNumberLimitPagination
+from .pagination import (CursorLimitPagination, CursorPaginationMixin,
+                         FeedCursorPagination, PageNumberLimitPagination,
+                         SubscriptionsCursorPagination)
 from .permissions import IsAdminOrReadOnly, IsAuthorOrReadOnly
+from .renderers import (CSVRenderer, PDFRenderer, ShoppingListNegotiation,
+                        TxtRenderer)
 from .serializers import (FollowSerializer, IngredientSerializer,
                           MiniRecipeSerializer, RecipeSerializer,
                           TagSerializer, UserSerializer)
+from .shopping_list import RENDERERS, get_ingredients
 
 
-class UserViewSet(Djoserviewset):
+class UserViewSet(CursorPaginationMixin, Djoserviewset):
     """Вьюсет юзера. Возможность подписываться и отписываться от других
     юзеров, просмотреть список подписок."""
 
     pagination_class = PageNumberLimitPagination
+    cursor_pagination_classes = {
+        'subscriptions': SubscriptionsCursorPagination}
     serializer_class = UserSerializer
     add_serializer = FollowSerializer
     queryset = User.objects.all()
@@ -34,9 +49,34 @@ class UserViewSet(Djoserviewset):
     def get_object(self):
         return get_object_or_404(User, pk=self.kwargs.get('id'))
 
+    def get_subscriptions_queryset(self, request):
+        """Авторы, на которых подписан юзер, с первыми recipes_limit
+        рецептами каждого автора. Лимит применяется в базе через ROW_NUMBER
+        по автору, поэтому страница собирается за фиксированное число
+        запросов. Число рецептов автора берется из счетчика
+        recipes_count."""
+
+        recipes = Recipe.objects.only('id', 'name', 'image', 'renditions',
+                                      'cooking_time', 'author_id')
+        limit = request.query_params.get('recipes_limit')
+        if limit and limit.isdigit():
+            recipes = recipes.annotate(row_number=Window(
+                expression=RowNumber(),
+                partition_by=F('author_id'),
+                order_by=F('id').desc(),
+            )).filter(row_number__lte=int(limit))
+        return User.objects.filter(
+            following__user=request.user
+        ).annotate(
+            follow_id=F('following__id'),
+        ).prefetch_related(
+            Prefetch('recipes', queryset=recipes)
+        ).order_by('-id')
+
     @action(detail=True,
             methods=['post', 'delete'],
             permission_classes=(IsAuthenticated,))
+    @transaction.atomic
     def subscribe(self, request, id=None):
         user = request.user
         author = get_object_or_404(User, pk=id)
@@ -45,6 +85,8 @@ class UserViewSet(Djoserviewset):
             subscription = get_object_or_404(Follow, user=user,
                                              author=author)
             subscription.delete()
+            User.objects.filter(pk=author.pk).update(
+                followers_count=F('followers_count') - 1)
             return Response(status=status.HTTP_204_NO_CONTENT)
 
         if user == author:
@@ -57,7 +99,9 @@ class UserViewSet(Djoserviewset):
             }, status=status.HTTP_400_BAD_REQUEST)
 
         Follow.objects.create(user=user, author=author)
-        queryset = User.objects.filter(following__user=user)
+        User.objects.filter(pk=author.pk).update(
+            followers_count=F('followers_count') + 1)
+        queryset = self.get_subscriptions_queryset(request)
         pages = self.paginate_queryset(queryset)
         serializer = FollowSerializer(pages,
                                       many=True,
@@ -67,7 +111,7 @@ class UserViewSet(Djoserviewset):
 
     @action(detail=False, permission_classes=(IsAuthenticated,))
     def subscriptions(self, request):
-        queryset = User.objects.filter(following__user=self.request.user)
+        queryset = self.get_subscriptions_queryset(request)
         pages = self.paginate_queryset(queryset)
         serializer = FollowSerializer(pages,
                                       many=True,
@@ -75,52 +119,134 @@ class UserViewSet(Djoserviewset):
         return self.get_paginated_response(serializer.data)
 
 
-class IngredientViewSet(ReadOnlyModelViewSet):
+class IngredientViewSet(TableVersionMixin, ReadOnlyModelViewSet):
     """Вьюсет для ингредиентов, добавлять ингредиенты может только админ."""
 
+    change_stamp = ChangeStamp.INGREDIENTS
     queryset = Ingredient.objects.all()
     serializer_class = IngredientSerializer
     permission_classes = (IsAdminOrReadOnly,)
     filter_backends = (IngredientSearchFilter,)
-    search_fields = ('^name',)
 
 
-class TagViewSet(ReadOnlyModelViewSet):
+class TagViewSet(TableVersionMixin, ReadOnlyModelViewSet):
     """Вьюсет для тэгов, добавлять тэги может только админ."""
 
+    change_stamp = ChangeStamp.TAGS
     queryset = Tag.objects.all()
     serializer_class = TagSerializer
     permission_classes = (IsAdminOrReadOnly,)
 
 
-class RecipeViewSet(ModelViewSet):
+class RecipeViewSet(ConditionalGetMixin, CursorPaginationMixin, ModelViewSet):
     """Вьюсет для рецептов. Создание, удаление и обновление рецепта.
     Возможность добавлять рецепты в избранное и в список покупок.
-    Возможность скачать список покупок в формате txt."""
+    Возможность скачать список покупок в форматах txt, csv и pdf."""
 
-    queryset = Recipe.objects.select_related('author')
     serializer_class = RecipeSerializer
     permission_classes = (IsAuthorOrReadOnly,)
     pagination_class = PageNumberLimitPagination
+    cursor_pagination_classes = {'list': CursorLimitPagination}
     filter_backends = [DjangoFilterBackend, ]
     filterset_class = RecipeFilterSet
+    conditional_actions = ('retrieve',)
+    cache_control = {'private': True, 'no_cache': True}
+    vary_headers = ('Authorization',)
+
+    def get_queryset(self):
+        return Recipe.objects.with_user_flags(
+            self.request.user).with_versions()
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['rendition'] = (
+            'card' if self.action in ('list', 'similar', 'feed') else 'full')
+        return context
+
+    def list(self, request, *args, **kwargs):
+        """Лента для анонимов отдается из кэша страниц recipe_pages."""
+
+        if not request.user.is_anonymous:
+            return super().list(request, *args, **kwargs)
+        return recipe_pages.get_or_build(
+            self.get_page_cache_key(request),
+            partial(super().list, request, *args, **kwargs))
 
+    def get_page_cache_key(self, request):
+        """Канонический вид запроса ленты: тэги отсортированы, limit
+        приведен к размеру страницы пагинатора, параметры, которые для
+        анонимов ничего не меняют, отброшены. Хост входит в ключ, потому
+        что ссылки в ответе абсолютные."""
+
+        params = request.query_params
+        return urlencode({
+            'host': request.build_absolute_uri('/'),
+            'tags': ','.join(sorted(set(params.getlist('tags')))),
+            'author': params.get('author', ''),
+            'search': ' '.join(params.get('search', '').split()),
+            **{name: params.get(name, '')
+               for name in RecipeFilterSet.ingredient_filters},
+            'page': params.get('page', '1'),
+            'cursor': params.get('cursor'),
+            'limit': self.paginator.get_page_size(request),
+        })
+
+    def get_version(self, request):
+        """ETag рецепта - хэш времени изменения рецепта, профиля автора,
+        версий тэгов и ингредиентов и флагов юзера, считается одним
+        запросом. Last-Modified не отдается: у профиля автора и флагов нет
+        времени изменения."""
+
+        version = generics.get_object_or_404(
+            Recipe.objects.with_versions().annotate(
+                **Recipe.objects.user_flags(request.user),
+            ).values_list(
+                'modified', 'author__email', 'author__username',
+                'author__first_name', 'author__last_name', 'is_favorited',
+                'is_in_shopping_cart', 'is_subscribed', 'tags_version',
+                'ingredients_version'),
+            pk=self.kwargs['pk'])
+        digest = hashlib.md5(repr(version).encode()).hexdigest()
+        return f'"recipe-{self.kwargs["pk"]}-{digest}"', None
+
+    @transaction.atomic
     def perform_create(self, serializer):
         serializer.save(author=self.request.user)
+        User.objects.filter(pk=self.request.user.pk).update(
+            recipes_count=F('recipes_count') + 1)
+
+    @transaction.atomic
+    def perform_destroy(self, instance):
+        # Списки покупок юзеров с рецептом в корзине пересчитывает сигнал
+        # recipes.signals.release_shopping_lists:
+        instance.delete()
+        User.objects.filter(pk=instance.author_id).update(
+            recipes_count=F('recipes_count') - 1)
+
+    # Счетчик рецепта, который меняется вместе с избранным или корзиной:
+    counters = {Favorite: 'favorites_count', ShoppingCart: 'in_carts_count'}
 
     def add_object(self, model, user, pk):
+        """Добавляет рецепт в избранное или корзину и увеличивает счетчик
+        рецепта. Вызывается в транзакции экшена."""
+
         if model.objects.filter(user=user, recipe__id=pk):
             return Response({'errors': 'Этот рецепт уже добавлен'},
                             status=status.HTTP_400_BAD_REQUEST)
         recipe = get_object_or_404(Recipe, id=pk)
         model.objects.create(user=user, recipe=recipe)
+        counter = self.counters[model]
+        Recipe.objects.filter(pk=recipe.pk).update(
+            **{counter: F(counter) + 1})
         serializer = MiniRecipeSerializer(recipe)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
     def delete_object(self, model, user, pk):
-        obj = model.objects.filter(user=user, recipe__id=pk)
-        if obj.exists():
-            obj.delete()
+        deleted, _ = model.objects.filter(user=user, recipe__id=pk).delete()
+        if deleted:
+            counter = self.counters[model]
+            Recipe.objects.filter(pk=pk).update(
+                **{counter: F(counter) - deleted})
             return Response(status=status.HTTP_204_NO_CONTENT)
         return Response({'errors': 'Уже удалено'},
                         status=status.HTTP_400_BAD_REQUEST)
@@ -128,6 +254,7 @@ class RecipeViewSet(ModelViewSet):
     @action(detail=True,
             methods=['get', 'post', 'delete'],
             permission_classes=(IsAuthenticated,))
+    @transaction.atomic
     def favorite(self, request, pk=None):
         if request.method == 'DELETE':
             return self.delete_object(Favorite, request.user, pk)
@@ -136,40 +263,80 @@ class RecipeViewSet(ModelViewSet):
     @action(detail=True,
             methods=['get', 'post', 'delete'],
             permission_classes=(IsAuthenticated,))
+    @transaction.atomic
     def shopping_cart(self, request, pk=None):
+        # Список покупок юзера меняют сигналы корзины, см. recipes/signals.py.
         if request.method == 'DELETE':
             return self.delete_object(ShoppingCart, request.user, pk)
         return self.add_object(ShoppingCart, request.user, pk)
 
+    @action(detail=True)
+    def similar(self, request, pk=None):
+        """Рецепты, похожие на этот по ингредиентам и тэгам, по убыванию
+        сходства, не больше limit. Списки считает команда
+        build_similar_recipes, у нового рецепта список пуст до ее запуска."""
+
+        recipe = generics.get_object_or_404(
+            Recipe.objects.select_related('similar').only(
+                'pk', 'similar__neighbors'), pk=pk)
+        try:
+            ids, _ = recipe.similar.unpack()
+        except SimilarRecipes.DoesNotExist:
+            return Response([])
+        limit = request.query_params.get('limit')
+        if limit and limit.isdigit():
+            ids = ids[:int(limit)]
+        recipes = self.get_queryset().in_bulk(ids)
+        serializer = self.get_serializer(
+            [recipes[recipe_id] for recipe_id in ids if recipe_id in recipes],
+            many=True)
+        return Response(serializer.data)
+
+    @action(detail=False, permission_classes=(IsAuthenticated,))
+    def feed(self, request):
+        """Новые рецепты авторов, на которых подписан юзер, по убыванию
+        id, постранично по курсору."""
+
+        paginator = FeedCursorPagination()
+        ids = paginator.paginate_feed(request.user, request)
+        recipes = self.get_queryset().in_bulk(ids)
+        serializer = self.get_serializer(
+            [recipes[recipe_id] for recipe_id in ids if recipe_id in recipes],
+            many=True)
+        return paginator.get_paginated_response(serializer.data)
+
     @action(detail=False,
             methods=['get'],
-            permission_classes=(IsAuthenticated,))
+            permission_classes=(IsAuthenticated,),
+            renderer_classes=(TxtRenderer, CSVRenderer, PDFRenderer,
+                              JSONRenderer),
+            content_negotiation_class=ShoppingListNegotiation)
     def download_shopping_cart(self, request):
         if not request.user.shopping_cart.exists():
             return Response({'errors': 'Корзина пуста'},
                             status=status.HTTP_400_BAD_REQUEST)
-        download_list = 'Список покупок:\n'
-        current_date = datetime.today()
-        ingredients = IngredientsAmount.objects.filter(
-            recipe__shopping_cart__user=request.user
-        ).order_by(
-            'ingredient__name'
-        ).values(
-            'ingredient__name', 'ingredient__measurement_unit'
-        ).annotate(amount=Sum('amount'))
-
-        for num, ingredient in enumerate(ingredients):
-            download_list += (
-                f'\n{num + 1}. {ingredient["ingredient__name"]} - '
-                f'{ingredient["amount"]} '
-                f'{ingredient["ingredient__measurement_unit"]}'
-            )
-        download_list += f'\n\n\n{current_date:%d.%m.%Y}\n' \
-                         f'Создано на сайте foodgram.catiska.ru ' \
-                         f'пользователем {request.user.get_full_name()}'
-        filename = f'{request.user.username}_download_list.txt'
-        response = HttpResponse(download_list,
-                                content_type='text.txt; charset=utf-8')
+        # Клиенты API с Accept: application/json получают текстовый файл:
+        file_format = request.accepted_renderer.format
+        if file_format not in RENDERERS:
+            file_format = TxtRenderer.format
+        render, content_type = RENDERERS[file_format]
+        response = StreamingHttpResponse(
+            render(request.user, get_ingredients(request.user)),
+            content_type=content_type)
+        filename = f'{request.user.username}_download_list.{file_format}'
         response['Content-Disposition'] = f'attachment; filename={filename}'
 
         return response
+
+
+class MetricsView(APIView):
+    """Гистограммы времени обработки, запросов к базе и сериализации по
+    маршрутам в текстовом формате Prometheus, только для staff. Их копит
+    foodgram.middleware.TimingMiddleware."""
+
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request):
+        return HttpResponse(request_metrics.render(),
+                            content_type='text/plain; version=0.0.4; '
+                                         'charset=utf-8')
@@ -0,0 +1,46 @@
+import json
+
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+
+# Если планировщик ожидает меньше строк, они считаются точно.
+EXACT_COUNT_LIMIT = 10000
+
+
+def estimated_count(queryset):
+    """Число строк кверисета по оценке планировщика Postgres (EXPLAIN),
+    без выполнения запроса. None на других базах."""
+
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    sql, params = queryset.order_by().query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]['Plan']['Plan Rows']
+
+
+class EstimatedCountPaginator(Paginator):
+    """Пагинатор списков админки, который не делает COUNT(*) по большим
+    таблицам: число строк берется из оценки планировщика, точно
+    считаются только выборки меньше EXACT_COUNT_LIMIT строк."""
+
+    @cached_property
+    def count(self):
+        estimate = estimated_count(self.object_list)
+        if estimate is None or estimate < EXACT_COUNT_LIMIT:
+            return super().count
+        return estimate
+
+
+class LargeTableAdmin:
+    """Примесь для админок таблиц на миллионы строк: число строк в списке
+    оценивается, а полное число строк таблицы рядом с результатом поиска
+    или фильтра не считается."""
+
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
@@ -0,0 +1,158 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+# Границы корзин гистограмм: время в секундах, как у клиентов Prometheus,
+# и число запросов к базе.
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERIES_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200)
+
+# Гистограммы на маршрут: имя метрики, описание, корзины и как значение
+# берется из RequestTimings.
+METRICS = (
+    ('foodgram_view_duration_seconds', 'Время обработки запроса',
+     SECONDS_BUCKETS, lambda timings: timings.view_time),
+    ('foodgram_sql_duration_seconds', 'Время запросов к базе',
+     SECONDS_BUCKETS, lambda timings: timings.sql_time),
+    ('foodgram_sql_queries', 'Число запросов к базе',
+     QUERIES_BUCKETS, lambda timings: timings.sql_count),
+    ('foodgram_serializer_duration_seconds', 'Время сериализации',
+     SECONDS_BUCKETS, lambda timings: timings.serializer_time),
+)
+
+
+class RequestTimings:
+    """Время и число запросов к базе, время сериализации и всего запроса
+    для одного HTTP-запроса. Текущий объект лежит в current_timings, его
+    заполняют TimingMiddleware, track_query и сериализаторы API."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.view_time = 0
+        self.sql_count = 0
+        self.sql_time = 0
+        self.serializer_time = 0
+        self.serializing = False
+
+    def finish(self):
+        self.view_time = time.perf_counter() - self.start
+
+    def server_timing(self):
+        """Значение заголовка Server-Timing, время в миллисекундах."""
+
+        return (f'sql;dur={self.sql_time * 1000:.1f};'
+                f'desc="{self.sql_count} queries", '
+                f'serializer;dur={self.serializer_time * 1000:.1f}, '
+                f'view;dur={self.view_time * 1000:.1f}')
+
+
+current_timings = ContextVar('request_timings', default=None)
+
+
+def track_query(execute, sql, params, many, context):
+    """execute_wrapper соединений: считает запросы и их время в текущем
+    запросе. Текущий запрос берется из контекста, а не из обертки на время
+    запроса: под ASGI вьюхи в потоке работают со своими соединениями, а
+    контекст sync_to_async переносит."""
+
+    timings = current_timings.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timings.sql_time += time.perf_counter() - start
+        timings.sql_count += 1
+
+
+@receiver(connection_created)
+def install_query_tracking(sender, connection, **kwargs):
+    if track_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(track_query)
+
+
+@contextmanager
+def serializing():
+    """Засекает время сериализации в текущем запросе. Вложенные
+    сериализаторы не считаются второй раз."""
+
+    timings = current_timings.get()
+    if timings is None or timings.serializing:
+        yield
+        return
+    timings.serializing = True
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.serializer_time += time.perf_counter() - start
+        timings.serializing = False
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def lines(self, name, labels):
+        total = 0
+        for bound, count in zip((*self.buckets, '+Inf'), self.counts):
+            total += count
+            yield f'{name}_bucket{{{labels},le="{bound}"}} {total}'
+        yield f'{name}_sum{{{labels}}} {self.sum:.6f}'
+        yield f'{name}_count{{{labels}}} {total}'
+
+
+class RequestMetrics:
+    """Гистограммы METRICS по маршрутам и методам в памяти процесса.
+    Воркер отдает только свои запросы с меткой worker - своим pid. Опросы
+    Prometheus попадают в разные воркеры, но ряды каждого воркера растут
+    монотонно, поэтому rate() и sum() по маршруту считаются верно."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = {}
+
+    def observe(self, route, method, timings):
+        with self.lock:
+            histograms = self.routes.get((route, method))
+            if histograms is None:
+                histograms = self.routes[route, method] = [
+                    Histogram(buckets) for _, _, buckets, _ in METRICS]
+            for histogram, (_, _, _, value) in zip(histograms, METRICS):
+                histogram.observe(value(timings))
+
+    def render(self):
+        """Гистограммы в текстовом формате Prometheus."""
+
+        worker = os.getpid()
+        lines = []
+        with self.lock:
+            for number, (name, description, _, _) in enumerate(METRICS):
+                lines += [f'# HELP {name} {description}',
+                          f'# TYPE {name} histogram']
+                for (route, method), histograms in sorted(
+                        self.routes.items()):
+                    lines.extend(histograms[number].lines(
+                        name, f'route="{route}",method="{method}",'
+                              f'worker="{worker}"'))
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        with self.lock:
+            self.routes.clear()
+
+
+request_metrics = RequestMetrics()
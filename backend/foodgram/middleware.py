@@ -0,0 +1,130 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+from .metrics import RequestTimings, current_timings, request_metrics
+from .routers import (Route, ais_pinned, apin, choose_replica, is_pinned,
+                      pin, route)
+
+SAFE_METHODS = ('GET', 'HEAD')
+
+
+def request_token(request):
+    """Токен из заголовка Authorization: Token <ключ> или None."""
+
+    parts = request.META.get('HTTP_AUTHORIZATION', '').split()
+    if len(parts) == 2 and parts[0] == 'Token':
+        return parts[1]
+    return None
+
+
+class ReplicaMiddleware:
+    """Отправляет чтение в GET- и HEAD-запросах к API на реплику, см.
+    routers.py. Запрос, в котором была запись, и все запросы того же
+    токена в течение REPLICA_PIN_SECONDS после нее читают с основной базы,
+    чтобы юзер сразу видел свои изменения. Запись отмечает
+    routers.track_writes на каждом соединении с основной базой. Работает и
+    под WSGI, и под ASGI без перехода в поток."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    @staticmethod
+    def is_routed(request):
+        return bool(settings.DATABASE_REPLICAS) and route.get() is None
+
+    @staticmethod
+    def may_use_replica(request):
+        return (request.method in SAFE_METHODS
+                and request.path.startswith('/api/'))
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not self.is_routed(request):
+            return self.get_response(request)
+        token = request_token(request)
+        replica = None
+        if (self.may_use_replica(request)
+                and not (token and is_pinned(token))):
+            replica = choose_replica()
+        current = Route(replica)
+        context = route.set(current)
+        try:
+            response = self.get_response(request)
+        finally:
+            route.reset(context)
+        if token and current.wrote:
+            pin(token)
+        return response
+
+    async def __acall__(self, request):
+        if not self.is_routed(request):
+            return await self.get_response(request)
+        token = request_token(request)
+        replica = None
+        if (self.may_use_replica(request)
+                and not (token and await ais_pinned(token))):
+            replica = choose_replica()
+        current = Route(replica)
+        context = route.set(current)
+        try:
+            response = await self.get_response(request)
+        finally:
+            route.reset(context)
+        if token and current.wrote:
+            await apin(token)
+        return response
+
+
+class TimingMiddleware:
+    """Считает для каждого запроса число и время запросов к базе, время
+    сериализации и всей обработки, отдает их в заголовке Server-Timing и
+    копит гистограммы по маршрутам для /api/_metrics, см. metrics.py.
+    Стоит первым в MIDDLEWARE, чтобы время включало остальные middleware.
+    У потоковых ответов запросы при отдаче тела не учитываются."""
+
+    sync_capable = True
+    async_capable = True
+    methods = ('GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS')
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        timings = RequestTimings()
+        context = current_timings.set(timings)
+        try:
+            response = self.get_response(request)
+        finally:
+            current_timings.reset(context)
+        return self.finish(request, response, timings)
+
+    async def __acall__(self, request):
+        timings = RequestTimings()
+        context = current_timings.set(timings)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_timings.reset(context)
+        return self.finish(request, response, timings)
+
+    def finish(self, request, response, timings):
+        timings.finish()
+        # Метки ограничены маршрутами и известными методами, чтобы число
+        # рядов не росло от произвольных адресов:
+        route = getattr(request.resolver_match, 'url_name',
+                        None) or 'unmatched'
+        method = request.method if request.method in self.methods else 'OTHER'
+        request_metrics.observe(route, method, timings)
+        if settings.SERVER_TIMING:
+            response['Server-Timing'] = timings.server_timing()
+        return response
@@ -0,0 +1,121 @@
+import hashlib
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+
+class Route:
+    """Куда идут запросы к базе в рамках одного HTTP-запроса: replica -
+    алиас реплики для чтения или None, если читать можно только с
+    основной базы."""
+
+    def __init__(self, replica=None):
+        self.replica = replica
+        self.wrote = False
+
+
+route = ContextVar('db_route', default=None)
+
+# Токены читаются с основной базы: токен, выданный при входе, должен
+# работать сразу, до того как он доедет до реплики.
+PRIMARY_MODELS = {'authtoken.token'}
+WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE')
+
+
+def track_writes(execute, sql, params, many, context):
+    """execute_wrapper соединений с основной базой: отмечает первую запись
+    в текущем Route. Route берется из контекста, а не из обертки на время
+    запроса: под ASGI ORM работает в потоках sync_to_async со своими
+    соединениями, а контекст sync_to_async переносит."""
+
+    current = route.get()
+    if (current is not None and not current.wrote
+            and sql.lstrip()[:6].upper() in WRITE_STATEMENTS):
+        current.wrote = True
+    return execute(sql, params, many, context)
+
+
+@receiver(connection_created)
+def install_write_tracking(sender, connection, **kwargs):
+    if (connection.alias == DEFAULT_DB_ALIAS
+            and track_writes not in connection.execute_wrappers):
+        connection.execute_wrappers.append(track_writes)
+
+
+def pin_key(token):
+    return 'primary-pin:' + hashlib.sha256(token.encode()).hexdigest()
+
+
+def is_pinned(token):
+    """Писал ли юзер с этим токеном в последние REPLICA_PIN_SECONDS."""
+
+    return caches[settings.REPLICA_PIN_CACHE].get(pin_key(token)) is not None
+
+
+def pin(token):
+    caches[settings.REPLICA_PIN_CACHE].set(
+        pin_key(token), 1, settings.REPLICA_PIN_SECONDS)
+
+
+async def ais_pinned(token):
+    pinned = await caches[settings.REPLICA_PIN_CACHE].aget(pin_key(token))
+    return pinned is not None
+
+
+async def apin(token):
+    await caches[settings.REPLICA_PIN_CACHE].aset(
+        pin_key(token), 1, settings.REPLICA_PIN_SECONDS)
+
+
+def choose_replica():
+    return random.choice(settings.DATABASE_REPLICAS)
+
+
+@contextmanager
+def primary_only():
+    """Все запросы внутри блока, в том числе через API, идут в основную
+    базу. Нужно командам, которые создают данные в транзакции: реплика их
+    не видит."""
+
+    token = route.set(Route())
+    try:
+        yield
+    finally:
+        route.reset(token)
+
+
+class ReplicaRouter:
+    """Чтение в рамках Route с репликой идет на реплику, пока в запросе не
+    было записи, после первой записи - в основную базу. Запись всегда идет
+    в основную базу. Вне запросов API (админка, команды, фоновые потоки)
+    роутер ничего не меняет."""
+
+    def db_for_read(self, model, **hints):
+        current = route.get()
+        if current is None:
+            return None
+        if (current.replica is None or current.wrote
+                or model._meta.label_lower in PRIMARY_MODELS):
+            return DEFAULT_DB_ALIAS
+        return current.replica
+
+    def db_for_write(self, model, **hints):
+        # Явно, иначе объект, прочитанный с реплики, сохранился бы в нее:
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *settings.DATABASE_REPLICAS}
+        if {obj1._state.db, obj2._state.db} <= databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, **hints):
+        if db in settings.DATABASE_REPLICAS:
+            return False
+        return None
@@ -32,7 +32,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'foodgram.middleware.TimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'foodgram.middleware.ReplicaMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -61,17 +63,85 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'foodgram.wsgi.application'
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.postgresql',
-        'NAME': os.getenv('POSTGRES_DB'),
-        'USER': os.getenv('POSTGRES_USER'),
-        'PASSWORD': os.getenv('POSTGRES_PASSWORD'),
-        'HOST': os.getenv('DB_HOST'),
-        'PORT': os.getenv('DB_PORT', 5432)
+# DB_ENGINE=sqlite - база в файле SQLITE_PATH вместо Postgres, например для
+# check_query_budget локально. Поиск там идет без полнотекстового индекса.
+if os.getenv('DB_ENGINE', 'postgresql') == 'sqlite':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.getenv('SQLITE_PATH', BASE_DIR / 'db.sqlite3'),
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.getenv('POSTGRES_DB'),
+            'USER': os.getenv('POSTGRES_USER'),
+            'PASSWORD': os.getenv('POSTGRES_PASSWORD'),
+            'HOST': os.getenv('DB_HOST'),
+            'PORT': os.getenv('DB_PORT', 5432)
+        }
+    }
+
+# Реплики для чтения: DB_REPLICA_HOSTS=replica1,replica2. Имя базы, юзер и
+# пароль те же, что у основной. В тестах реплики смотрят в основную базу.
+DATABASE_REPLICAS = []
+for num, host in enumerate(
+        filter(None, os.getenv('DB_REPLICA_HOSTS', '').split(','))):
+    DATABASE_REPLICAS.append(f'replica_{num}')
+    DATABASES[f'replica_{num}'] = {
+        **DATABASES['default'],
+        'HOST': host.strip(),
+        'TEST': {'MIRROR': 'default'},
     }
+
+DATABASE_ROUTERS = ['foodgram.routers.ReplicaRouter']
+
+# Сколько секунд после записи юзер читает с основной базы и алиас кэша, где
+# это хранится. Кэш должен быть общим для воркеров, например recipes при
+# RECIPE_CACHE=redis.
+REPLICA_PIN_SECONDS = int(os.getenv('REPLICA_PIN_SECONDS', 5))
+REPLICA_PIN_CACHE = os.getenv('REPLICA_PIN_CACHE', 'default')
+
+# Кэш сериализованных рецептов: locmem, file, redis или dummy (выключен).
+RECIPE_CACHE_BACKENDS = {
+    'locmem': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'recipes',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+    'file': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.getenv('RECIPE_CACHE_LOCATION', '/tmp/foodgram'),
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    },
+    'redis': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.getenv('REDIS_URL', 'redis://localhost:6379'),
+    },
+    'dummy': {
+        'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+    },
 }
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'recipes': {
+        **RECIPE_CACHE_BACKENDS[os.getenv('RECIPE_CACHE', 'locmem')],
+        'TIMEOUT': 24 * 60 * 60,
+    },
+}
+
+# Кэш юзеров по токену: LRU процесса и, если задан алиас из CACHES,
+# общий кэш для всех воркеров.
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', 10000))
+TOKEN_CACHE_LOCAL_TTL = int(os.getenv('TOKEN_CACHE_LOCAL_TTL', 10))
+TOKEN_CACHE_SHARED = os.getenv('TOKEN_CACHE_SHARED')
+TOKEN_CACHE_SHARED_TTL = int(os.getenv('TOKEN_CACHE_SHARED_TTL', 300))
+
 AUTH_USER_MODEL = 'users.User'
 
 AUTH_PASSWORD_VALIDATORS = [
@@ -91,7 +161,7 @@ AUTH_PASSWORD_VALIDATORS = [
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES':
-    ['rest_framework.authentication.TokenAuthentication', ],
+    ['api.authentication.CachedTokenAuthentication', ],
 
     'DEFAULT_PERMISSION_CLASSES':
     ['rest_framework.permissions.IsAuthenticatedOrReadOnly', ],
@@ -111,4 +181,27 @@ STATIC_ROOT = BASE_DIR / 'collect_static'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = '/media'
 
+# Заголовок Server-Timing со временем базы, сериализации и обработки
+# запроса, гистограммы для /api/_metrics копятся независимо от него:
+SERVER_TIMING = os.getenv('SERVER_TIMING', 'True') == 'True'
+
+
+# Раз в сколько секунд индекс ингредиентов для фильтров ленты строится
+# заново, между перестройками он догоняет базу по изменениям рецептов:
+INGREDIENT_INDEX_REBUILD = int(os.getenv('INGREDIENT_INDEX_REBUILD', 3600))
+
+# Лента подписок: сколько рецептов в ней видно и хранится на юзера. Рецепты
+# авторов, у которых подписчиков больше FEED_FANOUT_LIMIT, не раскладываются
+# по лентам, а подмешиваются при чтении, список таких авторов перечитывается
+# раз в FEED_PULL_TTL секунд:
+FEED_LENGTH = int(os.getenv('FEED_LENGTH', 1000))
+FEED_FANOUT_LIMIT = int(os.getenv('FEED_FANOUT_LIMIT', 10000))
+FEED_PULL_TTL = int(os.getenv('FEED_PULL_TTL', 60))
+
+# Потоки, в которых создаются уменьшенные копии фото рецептов:
+IMAGE_RENDITION_WORKERS = int(os.getenv('IMAGE_RENDITION_WORKERS', 2))
+
+SHOPPING_LIST_PDF_FONT = os.getenv(
+    'PDF_FONT', '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf')
+
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
@@ -1,13 +1,15 @@
 from django.contrib import admin
+from foodgram.admin import LargeTableAdmin
+from users.models import User
 
 from .models import (Favorite, Ingredient, IngredientsAmount, Recipe,
-                     ShoppingCart, Tag)
+                     ShoppingCart, ShoppingList, Tag)
 
 
 @admin.register(Ingredient)
 class IngredientAdmin(admin.ModelAdmin):
     list_display = ('name', 'measurement_unit')
-    list_filter = ('name',)
+    list_filter = ('measurement_unit',)
     search_fields = ('name',)
     empty_value_display = '-'
 
@@ -22,43 +24,106 @@ class TagAdmin(admin.ModelAdmin):
 
 class IngredientInline(admin.TabularInline):
     model = Recipe.ingredients.through
+    autocomplete_fields = ('ingredient',)
+
+
+class CookingTimeFilter(admin.SimpleListFilter):
+    """Время приготовления диапазонами: список всех значений - это
+    SELECT DISTINCT по всей таблице рецептов."""
+
+    title = 'Время приготовления'
+    parameter_name = 'cooking_time'
+    ranges = {
+        '15': ('До 15 минут', 0, 15),
+        '60': ('До часа', 16, 60),
+        '180': ('До трех часов', 61, 180),
+        'long': ('Дольше трех часов', 181, None),
+    }
+
+    def lookups(self, request, model_admin):
+        return [(key, label) for key, (label, _, _) in self.ranges.items()]
+
+    def queryset(self, request, queryset):
+        if self.value() not in self.ranges:
+            return queryset
+        _, low, high = self.ranges[self.value()]
+        queryset = queryset.filter(cooking_time__gte=low)
+        if high is not None:
+            queryset = queryset.filter(cooking_time__lte=high)
+        return queryset
 
 
 @admin.register(Recipe)
-class RecipeAdmin(admin.ModelAdmin):
-    list_display = ('id', 'name', 'author', 'cooking_time', 'text',
-                    'in_favorites')
+class RecipeAdmin(LargeTableAdmin, admin.ModelAdmin):
+    list_display = ('id', 'name', 'author', 'cooking_time', 'in_favorites')
+    list_select_related = ('author',)
     readonly_fields = ('in_favorites',)
-    list_filter = ('name', 'author', 'tags', 'cooking_time')
+    list_filter = ('tags', CookingTimeFilter)
     empty_value_display = '-'
-    search_fields = ('name', 'author__username', 'tags__name')
+    search_fields = ('name',)
+    search_help_text = ('id рецепта, ник автора или слова из названия и '
+                        'описания')
+    raw_id_fields = ('author',)
     inlines = [IngredientInline, ]
     exclude = ('ingredient',)
 
+    def get_search_results(self, request, queryset, search_term):
+        """Поиск по индексам: число - id рецепта, ник автора - его
+        рецепты, иначе полнотекстовый поиск Recipe.objects.search."""
+
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        if search_term.isdigit():
+            return queryset.filter(pk=int(search_term)), False
+        author = User.objects.filter(
+            username=search_term).values_list('id', flat=True).first()
+        if author is not None:
+            return queryset.filter(author_id=author), False
+        return queryset.search(search_term), False
+
     def in_favorites(self, obj):
-        return obj.favorite.count()
+        return obj.favorites_count
 
     in_favorites.short_description = 'В избранном'
+    in_favorites.admin_order_field = 'favorites_count'
 
 
 @admin.register(IngredientsAmount)
-class IngredientsAmountAdmin(admin.ModelAdmin):
+class IngredientsAmountAdmin(LargeTableAdmin, admin.ModelAdmin):
     list_display = ('recipe', 'ingredient', 'amount')
-    list_filter = ('recipe',)
+    list_select_related = ('recipe', 'ingredient')
+    raw_id_fields = ('recipe',)
+    autocomplete_fields = ('ingredient',)
     empty_value_display = '-'
 
 
 @admin.register(Favorite)
-class FavoriteAdmin(admin.ModelAdmin):
+class FavoriteAdmin(LargeTableAdmin, admin.ModelAdmin):
     list_display = ('recipe', 'user')
-    list_filter = ('recipe', 'user')
-    search_fields = ('user__username', 'recipe__name')
+    list_select_related = ('recipe', 'user')
+    raw_id_fields = ('recipe', 'user')
+    search_fields = ('=user__username',)
+    search_help_text = 'Ник юзера'
     empty_value_display = '-'
 
 
 @admin.register(ShoppingCart)
-class ShoppingCartAdmin(admin.ModelAdmin):
+class ShoppingCartAdmin(LargeTableAdmin, admin.ModelAdmin):
     list_display = ('recipe', 'user')
-    list_filter = ('recipe', 'user')
-    search_fields = ('user__username', 'recipe__name')
+    list_select_related = ('recipe', 'user')
+    raw_id_fields = ('recipe', 'user')
+    search_fields = ('=user__username',)
+    search_help_text = 'Ник юзера'
+    empty_value_display = '-'
+
+
+@admin.register(ShoppingList)
+class ShoppingListAdmin(LargeTableAdmin, admin.ModelAdmin):
+    list_display = ('user', 'ingredient', 'amount')
+    list_select_related = ('user', 'ingredient')
+    raw_id_fields = ('user',)
+    autocomplete_fields = ('ingredient',)
+    search_fields = ('=user__username',)
+    search_help_text = 'Ник юзера'
     empty_value_display = '-'
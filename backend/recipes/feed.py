@@ -0,0 +1,230 @@
+import heapq
+import logging
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import chain, groupby, islice
+from operator import itemgetter
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber
+from users.models import Follow, User
+
+from .models import FeedEntry, Recipe
+
+logger = logging.getLogger(__name__)
+
+# Сколько последних рецептов автора попадает в ленту при подписке:
+BACKFILL = 50
+
+# Ленты, в которые добавились рецепты, обрезаются до FEED_LENGTH, а ленты
+# подписчиков авторов, вышедших из pulled_authors, дополняются в фоне:
+executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='feeds')
+
+
+class PulledAuthors:
+    """id авторов, у которых подписчиков по счетчику followers_count больше
+    FEED_FANOUT_LIMIT: их рецепты не раскладываются по лентам, а
+    подмешиваются при чтении. Список хранится в процессе и перечитывается
+    раз в FEED_PULL_TTL секунд. Раскладка, подписка и чтение ленты решают
+    по этому списку, а не по счетчику автора: иначе, пока список не
+    перечитан, рецепт автора, перешедшего порог, не попал бы в ленту ни
+    раскладкой, ни при чтении. Рецепты автора, вышедшего из списка, по
+    лентам не раскладывались, поэтому при перечитывании последние из них
+    добавляются в ленты его подписчиков в фоне."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.authors = frozenset()
+        self.expires = 0
+
+    @staticmethod
+    def load():
+        return frozenset(User.objects.filter(
+            followers_count__gt=settings.FEED_FANOUT_LIMIT
+        ).values_list('id', flat=True))
+
+    def get(self):
+        with self.lock:
+            if self.expires < time.monotonic():
+                authors = self.load()
+                left = self.authors - authors
+                if left:
+                    executor.submit(refill_in_background, sorted(left))
+                self.authors = authors
+                self.expires = time.monotonic() + settings.FEED_PULL_TTL
+            return self.authors
+
+    def clear(self):
+        with self.lock:
+            self.expires = 0
+
+
+pulled_authors = PulledAuthors()
+
+
+def fan_out(recipe):
+    """Добавляет новый рецепт в ленты подписчиков автора, если автора нет
+    в pulled_authors. Иначе рецепт подмешивается при чтении."""
+
+    if recipe.author_id in pulled_authors.get():
+        return
+    followers = list(Follow.objects.filter(
+        author_id=recipe.author_id).values_list('user_id', flat=True))
+    FeedEntry.objects.bulk_create(
+        (FeedEntry(user_id=user_id, recipe=recipe) for user_id in followers),
+        batch_size=1000, ignore_conflicts=True)
+    schedule_trim(followers)
+
+
+def backfill(user_id, author_id):
+    """Последние рецепты автора в ленту нового подписчика."""
+
+    if author_id in pulled_authors.get():
+        return
+    FeedEntry.objects.bulk_create(
+        (FeedEntry(user_id=user_id, recipe_id=recipe_id)
+         for recipe_id in latest_recipes(author_id)),
+        ignore_conflicts=True)
+    schedule_trim([user_id])
+
+
+def latest_recipes(author_id):
+    return Recipe.objects.filter(author_id=author_id).order_by(
+        '-id').values_list('id', flat=True)[:BACKFILL]
+
+
+def refill(author_id):
+    """Последние рецепты автора, вышедшего из pulled_authors, в ленты всех
+    его подписчиков."""
+
+    followers = list(Follow.objects.filter(
+        author_id=author_id).values_list('user_id', flat=True))
+    recipe_ids = list(latest_recipes(author_id))
+    FeedEntry.objects.bulk_create(
+        (FeedEntry(user_id=user_id, recipe_id=recipe_id)
+         for user_id in followers for recipe_id in recipe_ids),
+        batch_size=1000, ignore_conflicts=True)
+    trim_users(followers)
+
+
+def forget(user_id, author_id):
+    """Убирает рецепты автора из ленты отписавшегося юзера."""
+
+    FeedEntry.objects.filter(user_id=user_id,
+                             recipe__author_id=author_id).delete()
+
+
+def feed_ids(user, before=None, limit=6):
+    """id рецептов ленты юзера меньше before по убыванию, не больше limit:
+    разложенные по ленте и рецепты авторов из pulled_authors, на которых
+    юзер подписан. Рецепты таких авторов читаются отдельным запросом на
+    автора по индексу (author, -id): с author IN (...) база сортировала бы
+    все их рецепты."""
+
+    pushed = FeedEntry.objects.filter(user=user)
+    if before is not None:
+        pushed = pushed.filter(recipe_id__lt=before)
+    ids = list(pushed.order_by('-recipe_id').values_list(
+        'recipe_id', flat=True)[:limit])
+    authors = pulled_authors.get()
+    if not authors:
+        return ids
+    for author_id in Follow.objects.filter(
+            user=user, author_id__in=authors).values_list('author_id',
+                                                          flat=True):
+        pulled = Recipe.objects.filter(author_id=author_id)
+        if before is not None:
+            pulled = pulled.filter(id__lt=before)
+        ids += pulled.order_by('-id').values_list('id', flat=True)[:limit]
+    return sorted(set(ids), reverse=True)[:limit]
+
+
+def trim(batch_size=10000, user_ids=None):
+    """Удаляет из лент юзеров user_ids или из всех лент рецепты сверх
+    FEED_LENGTH последних. Возвращает число удаленных строк."""
+
+    entries = FeedEntry.objects.all()
+    if user_ids is not None:
+        entries = entries.filter(user_id__in=user_ids)
+    deleted = 0
+    while True:
+        extra = list(entries.alias(
+            position=Window(RowNumber(), partition_by=F('user_id'),
+                            order_by=F('recipe_id').desc())
+        ).filter(
+            position__gt=settings.FEED_LENGTH
+        ).values_list('id', flat=True)[:batch_size])
+        if not extra:
+            return deleted
+        deleted += FeedEntry.objects.filter(id__in=extra).delete()[0]
+
+
+def trim_users(user_ids, batch_size=1000):
+    for start in range(0, len(user_ids), batch_size):
+        trim(user_ids=user_ids[start:start + batch_size])
+
+
+def trim_in_background(user_ids):
+    try:
+        trim_users(user_ids)
+    except Exception:
+        logger.exception('Не удалось обрезать ленты подписок')
+    finally:
+        connection.close()
+
+
+def refill_in_background(author_ids):
+    try:
+        for author_id in author_ids:
+            refill(author_id)
+    except Exception:
+        logger.exception('Не удалось дополнить ленты подписок')
+    finally:
+        connection.close()
+
+
+def schedule_trim(user_ids):
+    """Обрезает ленты юзеров user_ids до FEED_LENGTH в фоновом потоке после
+    коммита транзакции, в которой в них добавлены рецепты."""
+
+    if user_ids:
+        transaction.on_commit(
+            partial(executor.submit, trim_in_background, user_ids))
+
+
+def rebuild(batch_size=5000):
+    """Пересобирает все ленты: подписчику - последние BACKFILL рецептов
+    каждого автора, на которого он подписан, кроме авторов из
+    pulled_authors, и не больше FEED_LENGTH. Возвращает число строк."""
+
+    latest = defaultdict(list)
+    for author_id, recipe_id in Recipe.objects.exclude(
+        author_id__in=PulledAuthors.load()
+    ).alias(
+        position=Window(RowNumber(), partition_by=F('author_id'),
+                        order_by=F('id').desc())
+    ).filter(position__lte=BACKFILL).values_list('author_id', 'id'):
+        latest[author_id].append(recipe_id)
+    follows = Follow.objects.order_by('user_id').values_list(
+        'user_id', 'author_id').iterator()
+    entries = (
+        FeedEntry(user_id=user_id, recipe_id=recipe_id)
+        for user_id, authors in groupby(follows, itemgetter(0))
+        for recipe_id in heapq.nlargest(
+            settings.FEED_LENGTH,
+            chain.from_iterable(latest[author_id]
+                                for _, author_id in authors)))
+    created = 0
+    with transaction.atomic():
+        FeedEntry.objects.all().delete()
+        while True:
+            batch = list(islice(entries, batch_size))
+            if not batch:
+                return created
+            FeedEntry.objects.bulk_create(batch)
+            created += len(batch)
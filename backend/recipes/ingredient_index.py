@@ -0,0 +1,378 @@
+import logging
+import threading
+import time
+from array import array
+from bisect import bisect_left, insort
+from collections import defaultdict
+from datetime import timedelta
+from functools import reduce
+from itertools import islice
+from operator import or_
+
+from django.conf import settings
+from django.db import connection
+
+from .models import ChangeStamp, IngredientsAmount, Recipe
+
+logger = logging.getLogger(__name__)
+
+# Рецепты, измененные в пределах этого интервала до последней
+# синхронизации, перечитываются повторно: время изменения ставит
+# приложение, а транзакция может закоммититься позже.
+SYNC_MARGIN = timedelta(seconds=60)
+# Если изменилось больше рецептов, индекс перестраивается в фоне, а не
+# догоняет базу в запросе.
+MAX_CHANGES = 1000
+# Ингредиент хранится битовой картой, если в нем больше 1/256 рецептов:
+# тогда карта не больше чем в 8 раз длиннее массива id.
+DENSITY = 256
+
+
+def to_bitmap(ids):
+    """Битовая карта из отсортированных id: int, в котором бит N - рецепт
+    с id N."""
+
+    if not ids:
+        return 0
+    bits = bytearray(ids[-1] // 8 + 1)
+    for recipe_id in ids:
+        bits[recipe_id >> 3] |= 1 << (recipe_id & 7)
+    return int.from_bytes(bits, 'little')
+
+
+def bitmap_ids(bitmap):
+    """id из битовой карты по убыванию."""
+
+    bits = bin(bitmap)
+    top = len(bits) - 1
+    position = bits.find('1', 2)
+    while position != -1:
+        yield top - position
+        position = bits.find('1', position + 1)
+
+
+def counts_bitmap(counts, bit=None):
+    """Битовая карта рецептов, у которых в счетчике counts[id] установлен
+    бит bit, или, без bit, счетчик не ноль."""
+
+    table = bytes(
+        ord('0') + (bool(value) if bit is None else value >> bit & 1)
+        for value in range(256))
+    return int(bytes(counts.translate(table))[::-1] or b'0', 2)
+
+
+def count_slices(counts):
+    """Поразрядные срезы счетчиков: бит id среза i - i-й бит counts[id]."""
+
+    slices = [counts_bitmap(counts, bit) for bit in range(8)]
+    while slices and not slices[-1]:
+        slices.pop()
+    return slices
+
+
+def increment(slices, bitmap):
+    """Прибавляет единицу к счетчикам в срезах slices в позициях bitmap."""
+
+    for bit, current in enumerate(slices):
+        if not bitmap:
+            return
+        slices[bit], bitmap = current ^ bitmap, current & bitmap
+    if bitmap:
+        slices.append(bitmap)
+
+
+def subtract(minuend, subtrahend):
+    """Поразрядная разность счетчиков, уменьшаемое не меньше вычитаемого."""
+
+    result, borrow = [], 0
+    for bit in range(max(len(minuend), len(subtrahend))):
+        x = minuend[bit] if bit < len(minuend) else 0
+        y = subtrahend[bit] if bit < len(subtrahend) else 0
+        result.append(x ^ y ^ borrow)
+        borrow = (~x & (y | borrow)) | (y & borrow)
+    return result
+
+
+def equals(slices, value, mask):
+    """Позиции из mask, в которых счетчик в slices равен value."""
+
+    for bit in range(max(len(slices), value.bit_length())):
+        current = slices[bit] if bit < len(slices) else 0
+        mask = mask & current if value >> bit & 1 else mask ^ mask & current
+    return mask
+
+
+class Ranking:
+    """Результат IngredientIndex.match: группы рецептов битовыми картами по
+    убыванию релевантности, внутри группы рецепты идут по убыванию id."""
+
+    def __init__(self, groups):
+        self.groups = [group for group in groups if group]
+        self.sizes = [group.bit_count() for group in self.groups]
+
+    def __len__(self):
+        return sum(self.sizes)
+
+    def slice(self, start=0, stop=None):
+        """id рецептов с позиции start до stop по группам, для
+        RecipeQuerySet.ranked."""
+
+        stop = len(self) if stop is None else stop
+        result = []
+        for group, size in zip(self.groups, self.sizes):
+            if start >= stop:
+                break
+            if start < size:
+                result.append(list(islice(bitmap_ids(group), start,
+                                          min(size, stop))))
+            start, stop = max(0, start - size), stop - size
+        return result
+
+
+class IngredientIndex:
+    """Инвертированный индекс ингредиент - рецепты в памяти процесса для
+    фильтров ленты по ингредиентам. Рецепты ингредиента хранятся
+    отсортированным массивом id или, если ингредиент частый, битовой картой.
+    Число ингредиентов рецептов хранится поразрядными срезами, поэтому
+    «не хватает не больше N» считается операциями над картами целиком.
+
+    Индекс строится в фоновом потоке при первом обращении и раз в
+    INGREDIENT_INDEX_REBUILD секунд, пока он строится, match возвращает
+    None. Перед поиском индекс догоняет базу по версиям ChangeStamp: рецепты,
+    созданные и измененные с прошлой синхронизации, перечитываются. Удаленные
+    рецепты убираются сразу в процессе, где их удалили, в остальных - при
+    перестройке, до этого их отсекает запрос к базе."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.postings = None
+        self.sizes = []
+        self.everything = 0
+        self.stamps = None
+        self.synced = None
+        self.built = None
+        self.building = False
+
+    def build(self):
+        """Строит индекс заново по всей таблице ингредиентов рецептов."""
+
+        stamps = self.current_stamps()
+        synced = Recipe.objects.order_by('-modified').values_list(
+            'modified', flat=True).first()
+        postings = defaultdict(lambda: array('I'))
+        counts = bytearray()
+        rows = IngredientsAmount.objects.order_by(
+            'ingredient_id', 'recipe_id'
+        ).values_list('ingredient_id', 'recipe_id').iterator(chunk_size=20000)
+        for ingredient_id, recipe_id in rows:
+            postings[ingredient_id].append(recipe_id)
+            if recipe_id >= len(counts):
+                counts.extend(bytes(recipe_id + 1 - len(counts)))
+            if counts[recipe_id] < 255:
+                counts[recipe_id] += 1
+        size = len(counts)
+        postings = {
+            ingredient_id: (to_bitmap(ids) if len(ids) * DENSITY > size
+                            else ids)
+            for ingredient_id, ids in postings.items()}
+        sizes, everything = count_slices(counts), counts_bitmap(counts)
+        with self.lock:
+            self.postings = postings
+            self.sizes = sizes
+            self.everything = everything
+            self.stamps = stamps
+            self.synced = synced
+            self.built = time.monotonic()
+
+    def build_in_background(self):
+        with self.lock:
+            if self.building:
+                return
+            self.building = True
+        threading.Thread(target=self.rebuild, daemon=True,
+                         name='ingredient-index').start()
+
+    def rebuild(self):
+        try:
+            self.build()
+        except Exception:
+            logger.exception('Не удалось построить индекс ингредиентов')
+        finally:
+            self.building = False
+            connection.close()
+
+    @staticmethod
+    def current_stamps():
+        return dict(ChangeStamp.objects.filter(
+            name__in=(ChangeStamp.RECIPES, ChangeStamp.INGREDIENTS)
+        ).values_list('name', 'version'))
+
+    def sync(self):
+        """Догоняет базу после изменений рецептов и перестраивает индекс в
+        фоне, если он устарел или изменился каталог ингредиентов.
+        Возвращает False, пока индекса нет."""
+
+        stamps = self.current_stamps()
+        with self.lock:
+            if (self.postings is None
+                    or stamps.get(ChangeStamp.INGREDIENTS)
+                    != self.stamps.get(ChangeStamp.INGREDIENTS)
+                    or time.monotonic() - self.built
+                    > settings.INGREDIENT_INDEX_REBUILD):
+                self.build_in_background()
+            if self.postings is None:
+                return False
+            if stamps.get(ChangeStamp.RECIPES) == self.stamps.get(
+                    ChangeStamp.RECIPES):
+                return True
+            changed = Recipe.objects.order_by()
+            if self.synced is not None:
+                changed = changed.filter(
+                    modified__gte=self.synced - SYNC_MARGIN)
+            changed = dict(
+                changed.values_list('id', 'modified')[:MAX_CHANGES + 1])
+            if len(changed) > MAX_CHANGES:
+                self.build_in_background()
+                return True
+            self.apply(changed)
+            self.stamps = stamps
+            self.synced = max(filter(None, (self.synced, *changed.values())),
+                              default=None)
+        return True
+
+    def apply(self, recipe_ids):
+        """Перечитывает ингредиенты рецептов recipe_ids."""
+
+        current = defaultdict(set)
+        for recipe_id, ingredient_id in IngredientsAmount.objects.filter(
+                recipe_id__in=recipe_ids).values_list('recipe_id',
+                                                      'ingredient_id'):
+            current[recipe_id].add(ingredient_id)
+        for recipe_id in recipe_ids:
+            self.update(recipe_id, current[recipe_id])
+
+    def discard(self, recipe_id):
+        with self.lock:
+            if self.postings is not None:
+                self.update(recipe_id, set())
+
+    def update(self, recipe_id, ingredient_ids):
+        old = self.ingredients_of(recipe_id)
+        for ingredient_id in old - ingredient_ids:
+            self.remove(ingredient_id, recipe_id)
+        for ingredient_id in ingredient_ids - old:
+            self.add(ingredient_id, recipe_id)
+        if old == ingredient_ids:
+            return
+        size = len(ingredient_ids)
+        bit = 1 << recipe_id
+        for num in range(max(len(self.sizes), size.bit_length())):
+            if num == len(self.sizes):
+                self.sizes.append(0)
+            self.sizes[num] = (self.sizes[num] | bit if size >> num & 1
+                               else self.sizes[num] & ~bit)
+        self.everything = (self.everything | bit if size
+                           else self.everything & ~bit)
+
+    def size(self, recipe_id):
+        return sum((current >> recipe_id & 1) << num
+                   for num, current in enumerate(self.sizes))
+
+    def ingredients_of(self, recipe_id):
+        """Ингредиенты рецепта по индексу. Поиск останавливается, когда
+        найдено столько ингредиентов, сколько записано у рецепта."""
+
+        size = self.size(recipe_id)
+        found = set()
+        for ingredient_id, posting in self.postings.items():
+            if len(found) == size:
+                break
+            if isinstance(posting, int):
+                if posting >> recipe_id & 1:
+                    found.add(ingredient_id)
+            else:
+                position = bisect_left(posting, recipe_id)
+                if (position < len(posting)
+                        and posting[position] == recipe_id):
+                    found.add(ingredient_id)
+        return found
+
+    def add(self, ingredient_id, recipe_id):
+        posting = self.postings.setdefault(ingredient_id, array('I'))
+        if isinstance(posting, int):
+            self.postings[ingredient_id] = posting | 1 << recipe_id
+            return
+        insort(posting, recipe_id)
+        if len(posting) * DENSITY > posting[-1]:
+            self.postings[ingredient_id] = to_bitmap(posting)
+
+    def remove(self, ingredient_id, recipe_id):
+        posting = self.postings[ingredient_id]
+        if isinstance(posting, int):
+            self.postings[ingredient_id] = posting & ~(1 << recipe_id)
+        else:
+            del posting[bisect_left(posting, recipe_id)]
+
+    def bitmap(self, ingredient_id):
+        posting = self.postings.get(ingredient_id, 0)
+        return posting if isinstance(posting, int) else to_bitmap(posting)
+
+    def match(self, all_ids=(), any_ids=(), exclude_ids=(),
+              max_missing=None):
+        """Рецепты с каждым из all_ids, хотя бы одним из any_ids и без
+        exclude_ids, которым из всех ингредиентов all_ids и any_ids не
+        хватает не больше max_missing. Возвращает Ranking - все совпадения
+        по убыванию релевантности: сначала меньше недостающих ингредиентов,
+        без max_missing - больше совпадений с any_ids, внутри группы по
+        убыванию id. None, если индекс еще строится."""
+
+        if not self.sync():
+            return None
+        return self.find(all_ids, any_ids, exclude_ids, max_missing)
+
+    def find(self, all_ids=(), any_ids=(), exclude_ids=(), max_missing=None,
+             within=None):
+        """match без синхронизации с базой, только среди рецептов битовой
+        карты within, если она задана."""
+
+        with self.lock:
+            found = self.everything
+            if within is not None:
+                found &= within
+            for ingredient_id in all_ids:
+                found &= self.bitmap(ingredient_id)
+            if any_ids:
+                found &= reduce(or_, map(self.bitmap, any_ids))
+            if exclude_ids:
+                found ^= found & reduce(or_, map(self.bitmap, exclude_ids))
+            if max_missing is not None:
+                matched = []
+                for ingredient_id in {*all_ids, *any_ids}:
+                    increment(matched, found & self.bitmap(ingredient_id))
+                missing = subtract(self.sizes, matched)
+                return Ranking(equals(missing, value, found)
+                               for value in range(max_missing + 1))
+            if len(any_ids) > 1:
+                matched = []
+                for ingredient_id in any_ids:
+                    increment(matched, found & self.bitmap(ingredient_id))
+                return Ranking(equals(matched, value, found)
+                               for value in range(len(any_ids), 0, -1))
+            return Ranking((found,))
+
+    def stats(self):
+        """Число ингредиентов в массивах и картах и их размер в байтах."""
+
+        with self.lock:
+            arrays = [posting for posting in (self.postings or {}).values()
+                      if not isinstance(posting, int)]
+            bitmaps = [posting for posting in (self.postings or {}).values()
+                       if isinstance(posting, int)]
+            return (len(arrays), len(bitmaps),
+                    sum(posting.buffer_info()[1] * posting.itemsize
+                        for posting in arrays)
+                    + sum((posting.bit_length() + 7) // 8
+                          for posting in (*bitmaps, *self.sizes)))
+
+
+ingredient_index = IngredientIndex()
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from recipes.models import Recipe
+from recipes.renditions import build_renditions
+
+
+class Command(BaseCommand):
+    help = 'building missing thumbnail, card and full copies of recipe photos'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help='пересоздать копии для всех рецептов')
+
+    def handle(self, *args, **options):
+        built = failed = 0
+        recipes = Recipe.objects.only('id', 'image', 'renditions')
+        for recipe in recipes.iterator():
+            if not recipe.image:
+                continue
+            if (not options['all']
+                    and recipe.renditions.get('source') == recipe.image.name):
+                continue
+            try:
+                build_renditions(recipe.id, recipe.image.name)
+            except (OSError, ValueError) as error:
+                failed += 1
+                self.stderr.write(f'Рецепт {recipe.id}: {error}')
+                continue
+            built += 1
+        self.stdout.write(self.style.SUCCESS(
+            f'Созданы копии фото для рецептов: {built}, ошибок: {failed}'))
@@ -0,0 +1,34 @@
+import time
+
+from django.core.management.base import BaseCommand
+from recipes.similarity import (CANDIDATES, POSTING_CAP, TOP, RecipeVectors,
+                                Refresh)
+
+
+class Command(BaseCommand):
+    help = ('building lists of recipes similar by ingredients and tags, '
+            'by default only for recipes that changed since the last run')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true',
+                            help='пересчитать списки всех рецептов')
+        parser.add_argument('--top', type=int, default=TOP)
+        parser.add_argument('--candidates', type=int, default=CANDIDATES)
+        parser.add_argument('--posting-cap', type=int, default=POSTING_CAP)
+        parser.add_argument('--chunk-size', type=int, default=1000)
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        vectors = RecipeVectors.load(posting_cap=options['posting_cap'])
+        self.stdout.write(
+            f'Векторы {len(vectors.ids)} рецептов загружены за '
+            f'{time.perf_counter() - start:.1f} с')
+        counts = Refresh(
+            vectors, options['top'], options['candidates'],
+            options['chunk_size'], options['batch_size'],
+        ).run(options['full'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Посчитаны списки измененных рецептов: {counts["changed"]}, '
+            f'ссылавшихся на них: {counts["affected"]}, дополнено списков: '
+            f'{counts["merged"]}, всего {time.perf_counter() - start:.1f} с'))
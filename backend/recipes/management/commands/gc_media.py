@@ -0,0 +1,53 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from recipes.models import Recipe
+from recipes.renditions import rendition_names
+
+
+def walk(storage, path):
+    """Все файлы хранилища в каталоге path и его подкаталогах."""
+
+    directories, files = storage.listdir(path)
+    for name in files:
+        yield f'{path}/{name}'
+    for directory in directories:
+        yield from walk(storage, f'{path}/{directory}')
+
+
+class Command(BaseCommand):
+    help = 'deleting recipe photos and their copies not used by any recipe'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace-hours', type=int, default=24,
+                            help='не трогать файлы моложе, они могут '
+                                 'принадлежать незавершенной транзакции')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='только показать, что будет удалено')
+
+    def handle(self, *args, **options):
+        storage = Recipe._meta.get_field('image').storage
+        used = set()
+        for image, renditions in Recipe.objects.values_list(
+                'image', 'renditions').iterator():
+            used.add(image)
+            used.update(rendition_names(renditions, image))
+
+        deadline = timezone.now() - timedelta(hours=options['grace_hours'])
+        orphans = freed = 0
+        if storage.exists('recipes'):
+            for name in walk(storage, 'recipes'):
+                if (name in used
+                        or storage.get_modified_time(name) > deadline):
+                    continue
+                orphans += 1
+                freed += storage.size(name)
+                if options['dry_run']:
+                    self.stdout.write(name)
+                else:
+                    storage.delete(name)
+        action = 'Найдено' if options['dry_run'] else 'Удалено'
+        self.stdout.write(self.style.SUCCESS(
+            f'{action} файлов без рецептов: {orphans}, '
+            f'{freed / 1024 / 1024:.1f} МБ'))
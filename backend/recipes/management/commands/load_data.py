@@ -1,35 +1,121 @@
+import csv
+import io
 import json
 import os
+from itertools import islice
 
 from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
-from django.db.utils import IntegrityError
-from recipes.models import Ingredient
+from django.db import connection, transaction
+from recipes.models import ChangeStamp, Ingredient
 
 DATA_ROOT = os.path.join(settings.BASE_DIR, 'data')
+CHUNK_SIZE = 64 * 1024
+
+
+def read_json(file):
+    """По одному отдает ингредиенты из json-массива, не загружая файл в
+    память целиком."""
+
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    while True:
+        chunk = file.read(CHUNK_SIZE)
+        buffer = buffer[position:] + chunk
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position] in '[, \t\r\n':
+                position += 1
+            if buffer[position:position + 1] == ']':
+                return
+            try:
+                ingredient, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # Объект не поместился в буфер, дочитываем файл:
+                break
+            yield ingredient['name'], ingredient['measurement_unit']
+        if not chunk:
+            if buffer[position:].strip():
+                raise CommandError('Некорректный json-файл')
+            return
+
+
+def read_csv(file):
+    """Построчно отдает ингредиенты из csv-файла вида name,unit."""
+
+    for row in csv.reader(file):
+        if row:
+            yield row[0].strip(), row[1].strip()
+
+
+READERS = {'.json': read_json, '.csv': read_csv}
 
 
 class Command(BaseCommand):
-    help = 'loading ingredients from data in json'
+    help = 'loading ingredients from data in json or csv'
 
     def add_arguments(self, parser):
         parser.add_argument('filename', default='ingredients.json', nargs='?',
                             type=str)
+        parser.add_argument('--batch-size', type=int, default=5000)
 
     def handle(self, *args, **options):
+        reader = READERS.get(os.path.splitext(options['filename'])[1])
+        if reader is None:
+            raise CommandError('Поддерживаются только файлы json и csv')
+        save_batch = (self.copy_batch
+                      if connection.vendor == 'postgresql'
+                      else self.bulk_create_batch)
+        total = 0
+        before = Ingredient.objects.count()
         try:
             with open(os.path.join(DATA_ROOT, options['filename']), 'r',
-                      encoding='utf-8') as f:
-                data = json.load(f)
-                for ingredient in data:
-                    try:
-                        Ingredient.objects.create(name=ingredient["name"],
-                                                  measurement_unit=ingredient[
-                                                      "measurement_unit"])
-                    except IntegrityError:
-                        print(f'Ингредиент {ingredient["name"]} '
-                              f'{ingredient["measurement_unit"]} '
-                              f'уже есть в базе')
-
+                      encoding='utf-8', newline='') as f:
+                rows = reader(f)
+                while True:
+                    batch = list(islice(rows, options['batch_size']))
+                    if not batch:
+                        break
+                    with transaction.atomic():
+                        save_batch(batch)
+                    total += len(batch)
         except FileNotFoundError:
             raise CommandError('Файл отсутствует в директории data')
+
+        inserted = Ingredient.objects.count() - before
+        if inserted:
+            # bulk_create и COPY не отправляют сигналы post_save:
+            ChangeStamp.bump(ChangeStamp.INGREDIENTS)
+        self.stdout.write(self.style.SUCCESS(
+            f'Добавлено ингредиентов: {inserted}, '
+            f'пропущено (уже есть в базе): {total - inserted}'))
+
+    @staticmethod
+    def bulk_create_batch(batch):
+        Ingredient.objects.bulk_create(
+            (Ingredient(name=name, measurement_unit=measurement_unit)
+             for name, measurement_unit in batch),
+            ignore_conflicts=True)
+
+    @staticmethod
+    def copy_batch(batch):
+        """Загружает пачку через COPY во временную таблицу и переносит в
+        таблицу ингредиентов, пропуская уже существующие."""
+
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(batch)
+        buffer.seek(0)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'CREATE TEMP TABLE IF NOT EXISTS ingredients_import '
+                '(name varchar(200), measurement_unit varchar(200)) '
+                'ON COMMIT DELETE ROWS')
+            cursor.copy_expert(
+                'COPY ingredients_import FROM STDIN WITH (FORMAT csv)',
+                buffer)
+            cursor.execute(
+                f'INSERT INTO {Ingredient._meta.db_table} '
+                '(name, measurement_unit) '
+                'SELECT DISTINCT name, measurement_unit '
+                'FROM ingredients_import ON CONFLICT DO NOTHING')
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from recipes.feed import rebuild
+
+
+class Command(BaseCommand):
+    help = 'rebuilding feeds of all users from their follows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        created = rebuild(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Пересобрано строк лент подписок: {created}'))
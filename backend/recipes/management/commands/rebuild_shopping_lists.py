@@ -0,0 +1,83 @@
+from itertools import islice
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Sum
+from recipes.models import IngredientsAmount, ShoppingList
+
+
+def live_totals():
+    """Списки покупок, посчитанные заново по корзинам и рецептам."""
+
+    return IngredientsAmount.objects.filter(
+        recipe__shopping_cart__isnull=False
+    ).order_by(
+        'recipe__shopping_cart__user', 'ingredient'
+    ).values_list(
+        'recipe__shopping_cart__user', 'ingredient'
+    ).annotate(total=Sum('amount')).iterator()
+
+
+def stored_totals():
+    return ShoppingList.objects.order_by(
+        'user', 'ingredient'
+    ).values_list('user', 'ingredient', 'amount').iterator()
+
+
+def compare(live, stored):
+    """Сравнивает два упорядоченных по (юзер, ингредиент) потока строк и
+    отдает расхождения (юзер, ингредиент, ожидалось, в таблице)."""
+
+    live_row, stored_row = next(live, None), next(stored, None)
+    while live_row or stored_row:
+        live_key = live_row[:2] if live_row else None
+        stored_key = stored_row[:2] if stored_row else None
+        if stored_key is None or (live_key and live_key < stored_key):
+            yield (*live_key, live_row[2], None)
+            live_row = next(live, None)
+        elif live_key is None or stored_key < live_key:
+            yield (*stored_key, None, stored_row[2])
+            stored_row = next(stored, None)
+        else:
+            if live_row[2] != stored_row[2]:
+                yield (*live_key, live_row[2], stored_row[2])
+            live_row, stored_row = next(live, None), next(stored, None)
+
+
+class Command(BaseCommand):
+    help = 'rebuilding and verifying shopping list totals against carts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true',
+                            help='только сверить, не пересобирать')
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        if not options['check']:
+            self.rebuild(options['batch_size'])
+        mismatches = 0
+        for user, ingredient, expected, stored in compare(live_totals(),
+                                                          stored_totals()):
+            mismatches += 1
+            if mismatches <= 20:
+                self.stdout.write(f'Юзер {user}, ингредиент {ingredient}: '
+                                  f'ожидалось {expected}, в таблице {stored}')
+        if mismatches:
+            raise CommandError(f'Расхождений: {mismatches}')
+        self.stdout.write(self.style.SUCCESS('Списки покупок совпадают '
+                                             'с корзинами'))
+
+    def rebuild(self, batch_size):
+        rows = (ShoppingList(user_id=user, ingredient_id=ingredient,
+                             amount=total)
+                for user, ingredient, total in live_totals())
+        created = 0
+        with transaction.atomic():
+            ShoppingList.objects.all().delete()
+            while True:
+                batch = list(islice(rows, batch_size))
+                if not batch:
+                    break
+                ShoppingList.objects.bulk_create(batch)
+                created += len(batch)
+        self.stdout.write(f'Пересобрано строк: {created}')
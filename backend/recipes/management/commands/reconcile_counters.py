@@ -0,0 +1,71 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from recipes.models import Favorite, Recipe, ShoppingCart
+from users.models import Follow, User
+
+# Счетчики: модель, поле счетчика, модель считаемых объектов и ее поле
+# связи с моделью счетчика.
+COUNTERS = (
+    (Recipe, 'favorites_count', Favorite, 'recipe'),
+    (Recipe, 'in_carts_count', ShoppingCart, 'recipe'),
+    (User, 'recipes_count', Recipe, 'author'),
+    (User, 'followers_count', Follow, 'author'),
+)
+
+
+def live_count(related, field):
+    """Число объектов related, которые ссылаются через field на строку
+    внешнего запроса, подзапросом."""
+
+    return Coalesce(Subquery(
+        related.objects.filter(
+            **{field: OuterRef('pk')}
+        ).order_by().values(field).annotate(
+            count=Count('pk')
+        ).values('count')), 0)
+
+
+def drift(model, counter, related, field):
+    """Строки, у которых счетчик не совпадает с числом объектов:
+    (pk, ожидалось, в таблице)."""
+
+    return model.objects.order_by('pk').annotate(
+        live=live_count(related, field)
+    ).exclude(**{counter: F('live')}).values_list('pk', 'live', counter)
+
+
+class Command(BaseCommand):
+    help = ('verifying favorite, cart, recipe and follower counters '
+            'against the rows they count and repairing drift')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true',
+                            help='только сверить, не исправлять')
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        mismatches = 0
+        for model, counter, related, field in COUNTERS:
+            rows = list(drift(model, counter, related, field))
+            mismatches += len(rows)
+            name = f'{model._meta.model_name}.{counter}'
+            for pk, expected, stored in rows[:20]:
+                self.stdout.write(f'{name} у {pk}: ожидалось {expected}, '
+                                  f'в таблице {stored}')
+            if options['check'] or not rows:
+                continue
+            batch_size = options['batch_size']
+            for start in range(0, len(rows), batch_size):
+                # Число пересчитывается в самом UPDATE, а не берется из
+                # сверки: объекты могли добавить или удалить после нее.
+                model.objects.filter(pk__in=[
+                    pk for pk, _, _ in rows[start:start + batch_size]
+                ]).update(**{counter: live_count(related, field)})
+            self.stdout.write(f'{name}: исправлено {len(rows)}')
+        if options['check'] and mismatches:
+            raise CommandError(f'Расхождений: {mismatches}')
+        self.stdout.write(self.style.SUCCESS(
+            'Счетчики совпадают с избранным, корзинами, рецептами и '
+            'подписками' if not mismatches
+            else f'Исправлено счетчиков: {mismatches}'))
@@ -0,0 +1,215 @@
+import random
+import time
+from itertools import accumulate, islice
+
+from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from recipes.colors import HexColors
+from recipes.models import (ChangeStamp, Favorite, Ingredient,
+                            IngredientsAmount, Recipe, ShoppingCart, Tag)
+from users.models import Follow, User
+
+# Словарь для названий и описаний рецептов, чтобы полнотекстовый поиск
+# работал на данных, похожих на настоящие: слова в разных формах, частота
+# по закону Ципфа.
+DISHES = ('суп', 'салат', 'пирог', 'каша', 'запеканка', 'омлет', 'рагу',
+          'плов', 'паста', 'котлеты', 'блины', 'оладьи', 'борщ', 'щи',
+          'гуляш', 'жаркое', 'пюре', 'сырники', 'пицца', 'лазанья')
+FILLINGS = ('с курицей', 'с грибами', 'с сыром', 'с картофелем',
+            'с говядиной', 'с рисом', 'с овощами', 'с яблоками',
+            'с творогом', 'с тыквой', 'с рыбой', 'со свининой',
+            'с капустой', 'с морковью', 'с фасолью', 'с ветчиной')
+WORDS = ('нарезать', 'добавить', 'соль', 'перец', 'обжарить', 'варить',
+         'минут', 'масло', 'лук', 'морковь', 'чеснок', 'сковороде',
+         'кастрюле', 'духовке', 'запекать', 'тушить', 'перемешать',
+         'подавать', 'горячим', 'сметаной', 'зеленью', 'куриное', 'филе',
+         'грибы', 'сыр', 'картофель', 'тесто', 'муку', 'яйца', 'молоко',
+         'сахар', 'сливочное', 'растительное', 'помидоры', 'огурцы',
+         'кубиками', 'соломкой', 'огне', 'крышкой', 'готовности', 'рис',
+         'гречку', 'тыкву', 'яблоки', 'творог', 'специи', 'базилик',
+         'укроп', 'петрушку', 'лимонный', 'сок', 'воду', 'бульон')
+
+
+class Command(BaseCommand):
+    help = ('generating synthetic users, recipes, favorites, carts and '
+            'follows for profiling and load testing')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--recipes', type=int, default=10000)
+        parser.add_argument('--ingredients', type=int, default=2000,
+                            help='сколько ингредиентов создать, если '
+                                 'каталог пуст')
+        parser.add_argument('--ingredients-per-recipe', type=int, nargs=2,
+                            default=(3, 12), metavar=('MIN', 'MAX'))
+        parser.add_argument('--followers', type=float, default=20,
+                            help='среднее число подписок юзера')
+        parser.add_argument('--favorites', type=float, default=30,
+                            help='среднее число избранных рецептов юзера')
+        parser.add_argument('--carts', type=float, default=5,
+                            help='среднее число рецептов в корзине юзера')
+        parser.add_argument('--zipf', type=float, default=1.1,
+                            help='показатель степени распределения '
+                                 'популярности авторов, рецептов и '
+                                 'ингредиентов')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--prefix', default='load',
+                            help='префикс имен и почт сгенерированных юзеров')
+
+    def handle(self, *args, **options):
+        self.rnd = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+        zipf = options['zipf']
+
+        ingredients = self.get_ingredients(options['ingredients'])
+        tags = self.get_tags()
+
+        password = make_password(None)
+        prefix = f'{options["prefix"]}_{options["seed"]}'
+        users = self.bulk(User, options['users'], (
+            User(username=f'{prefix}_{i}', email=f'{prefix}_{i}@load.ru',
+                 first_name='Имя', last_name='Фамилия', password=password)
+            for i in range(options['users'])))
+        popular_users = self.popularity(users, zipf)
+
+        popular_words = self.popularity(WORDS, zipf)
+        recipes = self.bulk(Recipe, options['recipes'], (
+            Recipe(name=self.recipe_name(i),
+                   author_id=self.pick(*popular_users),
+                   image='recipes/load.png',
+                   text=self.recipe_text(popular_words),
+                   cooking_time=self.rnd.randint(1, 180))
+            for i in range(options['recipes'])))
+        popular_recipes = self.popularity(recipes, zipf)
+        popular_ingredients = self.popularity(ingredients, zipf)
+
+        recipe_tags = (
+            Recipe.tags.through(recipe_id=recipe, tag_id=tag)
+            for recipe in recipes
+            for tag in self.rnd.sample(tags, self.rnd.randint(1, 2)))
+        self.bulk(Recipe.tags.through, len(recipes), recipe_tags,
+                  collect=False)
+
+        low, high = options['ingredients_per_recipe']
+        amounts = (
+            IngredientsAmount(recipe_id=recipe, ingredient_id=ingredient,
+                              amount=self.rnd.randint(1, 500))
+            for recipe in recipes
+            for ingredient in self.sample(popular_ingredients,
+                                          self.rnd.randint(low, high)))
+        self.bulk(IngredientsAmount, len(recipes) * (low + high) // 2,
+                  amounts, collect=False)
+
+        follows = (
+            Follow(user_id=user, author_id=author)
+            for user in users
+            for author in self.sample(popular_users,
+                                      self.count(options['followers']) + 1)
+            if author != user)
+        self.bulk(Follow, int(len(users) * options['followers']), follows,
+                  collect=False)
+
+        for model, mean in ((Favorite, options['favorites']),
+                            (ShoppingCart, options['carts'])):
+            objects = (
+                model(user_id=user, recipe_id=recipe)
+                for user in users
+                for recipe in self.sample(popular_recipes, self.count(mean)))
+            self.bulk(model, int(len(users) * mean), objects, collect=False)
+
+        call_command('rebuild_shopping_lists', stdout=self.stdout)
+        call_command('reconcile_counters', stdout=self.stdout)
+        # Ленты по счетчикам подписчиков, поэтому после reconcile_counters:
+        call_command('rebuild_feeds', stdout=self.stdout)
+        # Рецепты вставлены в обход сигналов, кэш страниц ленты и индекс
+        # ингредиентов узнают о них по версии:
+        ChangeStamp.bump(ChangeStamp.RECIPES)
+
+    def get_ingredients(self, count):
+        ingredients = list(Ingredient.objects.values_list('id', flat=True))
+        if ingredients:
+            return ingredients
+        ingredients = self.bulk(Ingredient, count, (
+            Ingredient(name=f'ингредиент {i}', measurement_unit='г')
+            for i in range(count)))
+        ChangeStamp.bump(ChangeStamp.INGREDIENTS)
+        return ingredients
+
+    def get_tags(self):
+        tags = list(Tag.objects.values_list('id', flat=True))
+        if tags:
+            return tags
+        tags = self.bulk(Tag, len(HexColors), (
+            Tag(name=label, color=color, slug=f'tag_{i}')
+            for i, (color, label) in enumerate(HexColors.choices)))
+        ChangeStamp.bump(ChangeStamp.TAGS)
+        return tags
+
+    def recipe_name(self, num):
+        return (f'{self.rnd.choice(DISHES).capitalize()} '
+                f'{self.rnd.choice(FILLINGS)} {num}')
+
+    def recipe_text(self, popular_words):
+        """Описание из 20-60 слов словаря."""
+
+        words, cum_weights = popular_words
+        return ' '.join(self.rnd.choices(
+            words, cum_weights=cum_weights, k=self.rnd.randint(20, 60)))
+
+    def bulk(self, model, total, objects, collect=True):
+        """Сохраняет объекты пачками по batch_size, каждую пачку в своей
+        транзакции, и печатает скорость вставки. Возвращает id созданных
+        объектов, если collect."""
+
+        name = model._meta.verbose_name_plural
+        ids = []
+        done = 0
+        start = time.perf_counter()
+        while True:
+            batch = list(islice(objects, self.batch_size))
+            if not batch:
+                break
+            with transaction.atomic():
+                created = model.objects.bulk_create(batch)
+            if collect:
+                ids.extend(obj.pk for obj in created)
+            done += len(batch)
+            elapsed = time.perf_counter() - start
+            self.stdout.write(f'{name}: {done}/~{total}, '
+                              f'{done / elapsed:.0f} строк/с')
+        self.stdout.write(self.style.SUCCESS(
+            f'{name}: создано {done} за {time.perf_counter() - start:.1f} с'))
+        return ids
+
+    def popularity(self, ids, exponent):
+        """Перемешивает id и назначает им веса по закону Ципфа."""
+
+        ids = list(ids)
+        self.rnd.shuffle(ids)
+        weights = accumulate(1 / rank ** exponent
+                             for rank in range(1, len(ids) + 1))
+        return ids, list(weights)
+
+    def pick(self, ids, cum_weights):
+        return self.rnd.choices(ids, cum_weights=cum_weights)[0]
+
+    def sample(self, popular, k):
+        """Выбирает k разных id с учетом популярности."""
+
+        ids, cum_weights = popular
+        k = min(k, len(ids))
+        if k * 2 > len(ids):
+            return self.rnd.sample(ids, k)
+        chosen = set()
+        while len(chosen) < k:
+            chosen.update(self.rnd.choices(ids, cum_weights=cum_weights,
+                                           k=k - len(chosen)))
+        return chosen
+
+    def count(self, mean):
+        """Случайное количество связей с экспоненциальным распределением."""
+
+        return int(self.rnd.expovariate(1 / mean)) if mean else 0
@@ -0,0 +1,16 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from recipes.feed import trim
+
+
+class Command(BaseCommand):
+    help = 'deleting feed entries beyond FEED_LENGTH latest recipes per user'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        deleted = trim(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Удалено из лент подписок: {deleted}, в ленте остается не '
+            f'больше {settings.FEED_LENGTH} рецептов'))
@@ -0,0 +1,45 @@
+from django.db import migrations
+
+PREFIX_INDEX = 'recipes_ingredient_lower_name_prefix'
+TRIGRAM_INDEX = 'recipes_ingredient_lower_name_trgm'
+
+
+def create_indexes(apps, schema_editor):
+    """Индексы для автодополнения ингредиентов: по началу названия и, если
+    в базе есть pg_trgm, по вхождению. Индекс по началу названия в
+    побайтовом порядке (COLLATE "C") обслуживает и LIKE 'x%', и сортировку,
+    поэтому первые результаты читаются прямо из индекса. Нужны только на
+    Postgres."""
+
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        f'CREATE INDEX IF NOT EXISTS {PREFIX_INDEX} '
+        'ON recipes_ingredient ((lower(name) COLLATE "C"))')
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_available_extensions "
+                       "WHERE name = 'pg_trgm'")
+        if cursor.fetchone() is None:
+            return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    schema_editor.execute(
+        f'CREATE INDEX IF NOT EXISTS {TRIGRAM_INDEX} '
+        'ON recipes_ingredient USING gin (lower(name) gin_trgm_ops)')
+
+
+def drop_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(f'DROP INDEX IF EXISTS {PREFIX_INDEX}')
+    schema_editor.execute(f'DROP INDEX IF EXISTS {TRIGRAM_INDEX}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0004_alter_ingredientsamount_amount'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 4.2.1 on 2026-10-18 19:06
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_shopping_lists(apps, schema_editor):
+    IngredientsAmount = apps.get_model('recipes', 'IngredientsAmount')
+    ShoppingList = apps.get_model('recipes', 'ShoppingList')
+    totals = IngredientsAmount.objects.filter(
+        recipe__shopping_cart__isnull=False
+    ).order_by().values(
+        'recipe__shopping_cart__user', 'ingredient'
+    ).annotate(total=models.Sum('amount'))
+    ShoppingList.objects.bulk_create(
+        (ShoppingList(user_id=row['recipe__shopping_cart__user'],
+                      ingredient_id=row['ingredient'], amount=row['total'])
+         for row in totals.iterator()),
+        batch_size=5000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('recipes', '0005_ingredient_name_search_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShoppingList',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.IntegerField(verbose_name='Количество')),
+                ('ingredient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='recipes.ingredient', verbose_name='Ингредиент')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shopping_list', to=settings.AUTH_USER_MODEL, verbose_name='Юзер')),
+            ],
+            options={
+                'verbose_name': 'Список покупок',
+                'verbose_name_plural': 'Списки покупок',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='shoppinglist',
+            constraint=models.UniqueConstraint(fields=('user', 'ingredient'), name='unique shopping list ingredient'),
+        ),
+        migrations.RunPython(fill_shopping_lists, migrations.RunPython.noop),
+    ]
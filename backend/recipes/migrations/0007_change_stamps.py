@@ -0,0 +1,39 @@
+# Generated by Django 4.2.1 on 2026-10-18 19:12
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def create_stamps(apps, schema_editor):
+    ChangeStamp = apps.get_model('recipes', 'ChangeStamp')
+    for name in ('tags', 'ingredients'):
+        ChangeStamp.objects.get_or_create(name=name)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0006_shoppinglist'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeStamp',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True, verbose_name='Таблица')),
+                ('version', models.PositiveIntegerField(default=0, verbose_name='Версия')),
+                ('modified', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Изменена')),
+            ],
+            options={
+                'verbose_name': 'Версия таблицы',
+                'verbose_name_plural': 'Версии таблиц',
+            },
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='modified',
+            field=models.DateTimeField(auto_now=True, verbose_name='Изменен'),
+        ),
+        migrations.RunPython(create_stamps, migrations.RunPython.noop),
+    ]
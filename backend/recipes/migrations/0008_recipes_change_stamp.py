@@ -0,0 +1,17 @@
+from django.db import migrations
+
+
+def create_stamp(apps, schema_editor):
+    ChangeStamp = apps.get_model('recipes', 'ChangeStamp')
+    ChangeStamp.objects.get_or_create(name='recipes')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0007_change_stamps'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_stamp, migrations.RunPython.noop),
+    ]
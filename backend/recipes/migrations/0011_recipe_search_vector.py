@@ -0,0 +1,63 @@
+from django.db import migrations
+
+TABLE = 'recipes_recipe'
+FUNCTION = 'recipes_recipe_search_vector'
+INDEX = 'recipes_recipe_search_vector'
+# Должно совпадать с recipes.models.SEARCH_CONFIG:
+CONFIG = 'russian'
+VECTOR = (f"setweight(to_tsvector('{CONFIG}', coalesce({{row}}name, '')), 'A')"
+          f" || setweight(to_tsvector('{CONFIG}', coalesce({{row}}text, '')),"
+          f" 'B')")
+
+
+def create_search_vector(apps, schema_editor):
+    """Колонка search_vector для полнотекстового поиска рецептов и GIN
+    индекс по ней. Колонку заполняет триггер при создании рецепта и при
+    изменении названия или описания, в модели ее нет, чтобы она не
+    читалась вместе с рецептами. Нужна только на Postgres."""
+
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        f'ALTER TABLE {TABLE} ADD COLUMN IF NOT EXISTS search_vector tsvector')
+    schema_editor.execute(f'''
+        CREATE OR REPLACE FUNCTION {FUNCTION}() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'UPDATE'
+                    AND NEW.name IS NOT DISTINCT FROM OLD.name
+                    AND NEW.text IS NOT DISTINCT FROM OLD.text THEN
+                RETURN NEW;
+            END IF;
+            NEW.search_vector := {VECTOR.format(row='NEW.')};
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql''')
+    schema_editor.execute(
+        f'CREATE TRIGGER {FUNCTION} BEFORE INSERT OR UPDATE OF name, text '
+        f'ON {TABLE} FOR EACH ROW EXECUTE FUNCTION {FUNCTION}()')
+    # Индекс строится после заполнения, так быстрее:
+    schema_editor.execute(
+        f'UPDATE {TABLE} SET search_vector = {VECTOR.format(row="")}')
+    schema_editor.execute(
+        f'CREATE INDEX IF NOT EXISTS {INDEX} '
+        f'ON {TABLE} USING gin (search_vector)')
+
+
+def drop_search_vector(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(f'DROP TRIGGER IF EXISTS {FUNCTION} ON {TABLE}')
+    schema_editor.execute(f'DROP FUNCTION IF EXISTS {FUNCTION}()')
+    schema_editor.execute(
+        f'ALTER TABLE {TABLE} DROP COLUMN IF EXISTS search_vector')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0010_content_addressed_images'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_vector, drop_search_vector),
+    ]
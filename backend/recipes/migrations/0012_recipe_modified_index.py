@@ -0,0 +1,18 @@
+# Generated by Django 4.2.1 on 2026-10-18 20:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0011_recipe_search_vector'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='recipe',
+            name='modified',
+            field=models.DateTimeField(auto_now=True, db_index=True, verbose_name='Изменен'),
+        ),
+    ]
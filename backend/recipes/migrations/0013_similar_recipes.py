@@ -0,0 +1,26 @@
+# Generated by Django 4.2.1 on 2026-10-18 20:31
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0012_recipe_modified_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SimilarRecipes',
+            fields=[
+                ('recipe', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='similar', serialize=False, to='recipes.recipe', verbose_name='Рецепт')),
+                ('neighbors', models.BinaryField(verbose_name='Похожие рецепты')),
+                ('fingerprint', models.BigIntegerField(verbose_name='Отпечаток ингредиентов и тэгов')),
+            ],
+            options={
+                'verbose_name': 'Похожие рецепты',
+                'verbose_name_plural': 'Похожие рецепты',
+            },
+        ),
+    ]
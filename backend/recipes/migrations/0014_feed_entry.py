@@ -0,0 +1,89 @@
+# Generated by Django 4.2.1 on 2026-10-18 20:56
+
+import heapq
+from collections import defaultdict
+from itertools import chain, groupby, islice
+from operator import itemgetter
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models.functions import RowNumber
+import django.db.models.deletion
+
+# Сколько последних рецептов автора попадает в ленту, как BACKFILL в
+# recipes/feed.py:
+BACKFILL = 50
+
+
+def fill_feeds(apps, schema_editor):
+    Follow = apps.get_model('users', 'Follow')
+    Recipe = apps.get_model('recipes', 'Recipe')
+    FeedEntry = apps.get_model('recipes', 'FeedEntry')
+    # Счетчика подписчиков еще нет, авторы, рецепты которых подмешиваются
+    # при чтении, считаются по подпискам:
+    pulled = Follow.objects.order_by().values('author').annotate(
+        count=models.Count('pk')
+    ).filter(count__gt=settings.FEED_FANOUT_LIMIT).values('author')
+    latest = defaultdict(list)
+    for author_id, recipe_id in Recipe.objects.exclude(
+        author__in=pulled
+    ).alias(
+        position=models.Window(RowNumber(), partition_by=models.F('author'),
+                               order_by=models.F('id').desc())
+    ).filter(position__lte=BACKFILL).values_list('author', 'id'):
+        latest[author_id].append(recipe_id)
+    follows = Follow.objects.order_by('user').values_list(
+        'user', 'author').iterator()
+    entries = (
+        FeedEntry(user_id=user_id, recipe_id=recipe_id)
+        for user_id, authors in groupby(follows, itemgetter(0))
+        for recipe_id in heapq.nlargest(
+            settings.FEED_LENGTH,
+            chain.from_iterable(latest[author_id]
+                                for _, author_id in authors)))
+    while True:
+        batch = list(islice(entries, 5000))
+        if not batch:
+            break
+        FeedEntry.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('recipes', '0013_similar_recipes'),
+        ('users', '0001_squashed_0002_alter_follow_options'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeedEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+            ],
+            options={
+                'verbose_name': 'Рецепт в ленте подписок',
+                'verbose_name_plural': 'Ленты подписок',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['author', '-id'], name='recipe_author_id_desc'),
+        ),
+        migrations.AddField(
+            model_name='feedentry',
+            name='recipe',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='feed_entries', to='recipes.recipe', verbose_name='Рецепт'),
+        ),
+        migrations.AddField(
+            model_name='feedentry',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='feed', to=settings.AUTH_USER_MODEL, verbose_name='Подписчик'),
+        ),
+        migrations.AddConstraint(
+            model_name='feedentry',
+            constraint=models.UniqueConstraint(fields=('user', 'recipe'), name='unique feed recipe'),
+        ),
+        migrations.RunPython(fill_feeds, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 4.2.1 on 2026-10-18 21:00
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+# Счетчики: модель, поле, считаемая модель и ее поле связи.
+COUNTERS = (
+    ('recipes.Recipe', 'favorites_count', 'recipes.Favorite', 'recipe'),
+    ('recipes.Recipe', 'in_carts_count', 'recipes.ShoppingCart', 'recipe'),
+    ('users.User', 'recipes_count', 'recipes.Recipe', 'author'),
+    ('users.User', 'followers_count', 'users.Follow', 'author'),
+)
+
+
+def fill_counters(apps, schema_editor):
+    for model, counter, related, field in COUNTERS:
+        count = apps.get_model(related).objects.filter(
+            **{field: models.OuterRef('pk')}
+        ).order_by().values(field).annotate(
+            count=models.Count('pk')
+        ).values('count')
+        apps.get_model(model).objects.update(**{
+            counter: Coalesce(models.Subquery(count), 0)})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0014_feed_entry'),
+        ('users', '0003_user_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='favorites_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='В избранном'),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='in_carts_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='В корзинах'),
+        ),
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['-favorites_count', '-id'], name='recipe_popularity'),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
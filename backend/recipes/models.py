@@ -1,8 +1,23 @@
+import struct
+from functools import partial
+
+from django.contrib.postgres.search import (SearchQuery, SearchRank,
+                                            SearchVectorField)
 from django.core import validators
-from django.db import models
-from users.models import User
+from django.db import connections, models, transaction
+from django.db.models import (Case, Count, Exists, F, OuterRef, Prefetch,
+                              Q, Subquery, Value, When)
+from django.db.models.functions import Coalesce
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
+from users.models import CountersMixin, Follow, User
 
 from .colors import HexColors
+from .storage import ContentAddressedStorage
+
+
+# Конфигурация полнотекстового поиска рецептов на Postgres.
+SEARCH_CONFIG = 'russian'
 
 
 class Ingredient(models.Model):
@@ -44,7 +59,166 @@ class Tag(models.Model):
         return self.name
 
 
-class Recipe(models.Model):
+class RecipeQuerySet(models.QuerySet):
+    """Кверисет рецептов."""
+
+    @staticmethod
+    def user_flags(user, author='author'):
+        """Выражения флагов избранного, корзины и подписки на автора для
+        юзера; author - путь к автору рецепта из аннотируемой модели."""
+
+        if user.is_anonymous:
+            false = Value(False, output_field=models.BooleanField())
+            return {'is_favorited': false, 'is_in_shopping_cart': false,
+                    'is_subscribed': false}
+        return {
+            'is_favorited': Exists(Favorite.objects.filter(
+                user=user, recipe=OuterRef('pk'))),
+            'is_in_shopping_cart': Exists(ShoppingCart.objects.filter(
+                user=user, recipe=OuterRef('pk'))),
+            'is_subscribed': Exists(Follow.objects.filter(
+                user=user, author=OuterRef(author))),
+        }
+
+    def with_user_flags(self, user):
+        """Аннотирует рецепты флагами избранного и корзины для юзера и
+        подгружает автора с флагом подписки."""
+
+        flags = self.user_flags(user, author='pk')
+        return self.annotate(
+            is_favorited=flags['is_favorited'],
+            is_in_shopping_cart=flags['is_in_shopping_cart'],
+        ).prefetch_related(
+            Prefetch('author', queryset=User.objects.annotate(
+                is_subscribed=flags['is_subscribed'])),
+        )
+
+    def with_versions(self):
+        """Аннотирует рецепты версиями таблиц тэгов и ингредиентов: вместе
+        с modified они задают версию сериализованного рецепта."""
+
+        stamps = ChangeStamp.objects.values('version')
+        return self.annotate(
+            tags_version=Subquery(stamps.filter(name=ChangeStamp.TAGS)),
+            ingredients_version=Subquery(
+                stamps.filter(name=ChangeStamp.INGREDIENTS)),
+        )
+
+    def search(self, query):
+        """Рецепты, подходящие под поисковый запрос, от самых релевантных.
+        На Postgres - полнотекстовый поиск с русской морфологией по колонке
+        search_vector, которую ведет триггер (см. миграцию 0011), название
+        весит больше описания. На SQLite каждое слово ищется вхождением в
+        название или описание, совпадения в названии выше."""
+
+        words = query.split()
+        if not words:
+            return self
+        if connections[self.db].vendor == 'postgresql':
+            query = SearchQuery(' '.join(words), config=SEARCH_CONFIG,
+                                search_type='websearch')
+            return self.alias(
+                search_vector=RawSQL(
+                    f'{Recipe._meta.db_table}.search_vector', [],
+                    output_field=SearchVectorField()),
+            ).filter(
+                search_vector=query
+            ).alias(
+                search_rank=SearchRank(F('search_vector'), query,
+                                       normalization=Value(1)),
+            ).order_by('-search_rank', '-id')
+        matches = Q()
+        rank = Value(0)
+        for word in words:
+            matches &= Q(name__icontains=word) | Q(text__icontains=word)
+            rank += (Case(When(name__icontains=word, then=2), default=0)
+                     + Case(When(text__icontains=word, then=1), default=0))
+        return self.filter(matches).alias(
+            search_rank=rank).order_by('-search_rank', '-id')
+
+    def with_ingredients(self, all_ids=(), any_ids=(), exclude_ids=(),
+                         max_missing=None):
+        """Фильтр по ингредиентам запросами к базе, с тем же порядком, что
+        у recipes.ingredient_index. Работает, пока индекс строится."""
+
+        amounts = IngredientsAmount.objects.filter(recipe=OuterRef('pk'))
+        queryset = self
+        for ingredient_id in all_ids:
+            queryset = queryset.filter(
+                Exists(amounts.filter(ingredient_id=ingredient_id)))
+        if any_ids:
+            queryset = queryset.filter(
+                Exists(amounts.filter(ingredient_id__in=any_ids)))
+        if exclude_ids:
+            queryset = queryset.exclude(
+                Exists(amounts.filter(ingredient_id__in=exclude_ids)))
+        counts = amounts.order_by().values('recipe').annotate(
+            count=Count('id')).values('count')
+        if max_missing is not None:
+            missing = Coalesce(Subquery(counts.exclude(
+                ingredient_id__in=[*all_ids, *any_ids])), 0)
+            return queryset.alias(missing=missing).filter(
+                missing__lte=max_missing
+            ).order_by('missing', *self.current_ordering())
+        if len(any_ids) > 1:
+            matched = Subquery(counts.filter(ingredient_id__in=any_ids))
+            return queryset.alias(matched=matched).order_by(
+                '-matched', *self.current_ordering())
+        return queryset
+
+    def ranked(self, groups):
+        """Рецепты из групп id в порядке групп, см. IngredientIndex.match.
+        Внутри группы сохраняется прежний порядок кверисета."""
+
+        groups = [group for group in groups if group]
+        queryset = self.filter(pk__in=[pk for group in groups for pk in group])
+        if len(groups) < 2:
+            return queryset
+        return queryset.order_by(Case(
+            *(When(pk__in=group, then=Value(rank))
+              for rank, group in enumerate(groups)),
+        ), *self.current_ordering())
+
+    def current_ordering(self):
+        return self.query.order_by or self.model._meta.ordering
+
+    @staticmethod
+    def related_lookups():
+        """Связи рецепта для prefetch_related: тэги и ингредиенты."""
+
+        return (
+            Prefetch('tags', queryset=Tag.objects.order_by('id')),
+            Prefetch('recipes_ingredients',
+                     queryset=IngredientsAmount.objects.select_related(
+                         'ingredient')),
+        )
+
+
+class RankedRecipes:
+    """Рецепты кверисета в порядке Ranking индекса ингредиентов для
+    пагинаторов, когда совпадений слишком много для фильтра по списку id:
+    число рецептов берется из индекса, страница читается одним запросом по
+    id страницы. Рецепты, удаленные в других процессах, индекс видит только
+    после перестройки, такие страницы выходят короче."""
+
+    def __init__(self, queryset, ranking):
+        self.queryset = queryset
+        self.ranking = ranking
+
+    def count(self):
+        return len(self.ranking)
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            return self[key:key + 1][0]
+        return self.queryset.ranked(self.ranking.slice(key.start or 0,
+                                                       key.stop))
+
+    def __iter__(self):
+        return iter(self[:self.count()])
+
+
+class Recipe(CountersMixin, models.Model):
     """Модель рецепта."""
 
     name = models.CharField('Рецепт', max_length=200)
@@ -52,7 +226,10 @@ class Recipe(models.Model):
                                on_delete=models.CASCADE,
                                related_name='recipes',
                                verbose_name='Автор рецепта')
-    image = models.ImageField('Фото блюда', upload_to='recipes/')
+    image = models.ImageField('Фото блюда', upload_to='recipes/',
+                              storage=ContentAddressedStorage())
+    renditions = models.JSONField('Уменьшенные копии фото', default=dict,
+                                  blank=True, editable=False)
     text = models.TextField('Описание рецепта')
     ingredients = models.ManyToManyField(Ingredient,
                                          related_name='recipes',
@@ -67,11 +244,27 @@ class Recipe(models.Model):
             validators.MinValueValidator(
                 1, 'Минимальное время готовки - 1 минута'),),
     )
+    modified = models.DateTimeField('Изменен', auto_now=True, db_index=True)
+    favorites_count = models.PositiveIntegerField('В избранном', default=0,
+                                                  editable=False)
+    in_carts_count = models.PositiveIntegerField('В корзинах', default=0,
+                                                 editable=False)
+
+    objects = RecipeQuerySet.as_manager()
+    counter_fields = ('favorites_count', 'in_carts_count')
 
     class Meta:
         ordering = ['-id']
         verbose_name = 'Рецепт'
         verbose_name_plural = 'Рецепты'
+        indexes = [
+            # Последние рецепты автора: лента подписок и подписки.
+            models.Index(fields=['author', '-id'],
+                         name='recipe_author_id_desc'),
+            # Популярные рецепты: сортировка по счетчику избранного.
+            models.Index(fields=['-favorites_count', '-id'],
+                         name='recipe_popularity'),
+        ]
 
     def __str__(self):
         return self.name
@@ -162,3 +355,194 @@ class ShoppingCart(models.Model):
 
     def __str__(self):
         return f'{self.recipe} - в корзине юзера {self.user}'
+
+
+class ShoppingListQuerySet(models.QuerySet):
+    """Кверисет списков покупок."""
+
+    def change(self, user_ids, deltas):
+        """Прибавляет к спискам покупок юзеров количества ингредиентов из
+        словаря {id ингредиента: изменение}. Отсутствующие строки создаются,
+        обнулившиеся удаляются. Не больше трех запросов независимо от числа
+        юзеров."""
+
+        deltas = {ingredient: delta
+                  for ingredient, delta in deltas.items() if delta}
+        if not deltas:
+            return
+        user_ids = list(user_ids)
+        if not user_ids:
+            return
+        added = [ingredient
+                 for ingredient, delta in deltas.items() if delta > 0]
+        if added:
+            self.bulk_create(
+                (self.model(user_id=user, ingredient_id=ingredient, amount=0)
+                 for user in user_ids for ingredient in added),
+                ignore_conflicts=True)
+        items = self.filter(user_id__in=user_ids, ingredient_id__in=deltas)
+        items.update(amount=F('amount') + Case(
+            *(When(ingredient_id=ingredient, then=Value(delta))
+              for ingredient, delta in deltas.items()),
+            default=Value(0)))
+        if len(added) < len(deltas):
+            items.filter(amount__lte=0).delete()
+
+    def change_recipe(self, recipe_id, deltas):
+        """change для всех юзеров, у которых рецепт recipe_id в корзине."""
+
+        self.change(ShoppingCart.objects.filter(
+            recipe_id=recipe_id).values_list('user_id', flat=True), deltas)
+
+    def add_recipe(self, user_ids, recipe_id, sign=1):
+        """Добавляет ингредиенты рецепта в списки покупок юзеров, при
+        sign=-1 вычитает."""
+
+        amounts = IngredientsAmount.objects.filter(
+            recipe_id=recipe_id).values_list('ingredient_id', 'amount')
+        self.change(user_ids, {ingredient: sign * amount
+                               for ingredient, amount in amounts})
+
+
+class ShoppingList(models.Model):
+    """Сумма ингредиентов из рецептов в корзине юзера. Обновляется
+    сигналами корзины, ингредиентов рецептов и удаления рецепта, в том числе
+    из админки и каскадом от автора, см. recipes/signals.py. Сверяется и
+    пересобирается командой rebuild_shopping_lists."""
+
+    user = models.ForeignKey(User,
+                             on_delete=models.CASCADE,
+                             verbose_name='Юзер',
+                             related_name='shopping_list')
+    ingredient = models.ForeignKey(Ingredient,
+                                   on_delete=models.CASCADE,
+                                   verbose_name='Ингредиент')
+    amount = models.IntegerField('Количество')
+
+    objects = ShoppingListQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = 'Список покупок'
+        verbose_name_plural = 'Списки покупок'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'ingredient'],
+                name='unique shopping list ingredient'
+            )
+        ]
+
+    def __str__(self):
+        return f'{self.ingredient} - {self.amount} в списке юзера {self.user}'
+
+
+class FeedEntry(models.Model):
+    """Рецепт в ленте подписок юзера. Строки добавляются при создании
+    рецепта всем подписчикам автора и при подписке, удаляются при отписке,
+    а сверх FEED_LENGTH - в фоне после добавления и командой trim_feeds, см.
+    recipes/feed.py."""
+
+    user = models.ForeignKey(User,
+                             on_delete=models.CASCADE,
+                             related_name='feed',
+                             verbose_name='Подписчик')
+    recipe = models.ForeignKey(Recipe,
+                               on_delete=models.CASCADE,
+                               related_name='feed_entries',
+                               verbose_name='Рецепт')
+
+    class Meta:
+        verbose_name = 'Рецепт в ленте подписок'
+        verbose_name_plural = 'Ленты подписок'
+        constraints = [
+            # Индекс для постраничного вывода ленты юзера по id рецепта:
+            models.UniqueConstraint(
+                fields=['user', 'recipe'],
+                name='unique feed recipe'
+            )
+        ]
+
+    def __str__(self):
+        return f'{self.recipe_id} в ленте юзера {self.user_id}'
+
+
+class SimilarRecipes(models.Model):
+    """Рецепты, похожие на рецепт по ингредиентам и тэгам, по убыванию
+    сходства. Считаются командой build_similar_recipes, см.
+    recipes/similarity.py. Список хранится одной строкой на рецепт: id
+    похожих и сходство упакованы в neighbors, так таблица в несколько раз
+    меньше, чем со строкой на пару рецептов. fingerprint - отпечаток
+    ингредиентов и тэгов, по которым список посчитан."""
+
+    recipe = models.OneToOneField(Recipe,
+                                  on_delete=models.CASCADE,
+                                  primary_key=True,
+                                  related_name='similar',
+                                  verbose_name='Рецепт')
+    neighbors = models.BinaryField('Похожие рецепты')
+    fingerprint = models.BigIntegerField('Отпечаток ингредиентов и тэгов')
+
+    class Meta:
+        verbose_name = 'Похожие рецепты'
+        verbose_name_plural = 'Похожие рецепты'
+
+    def __str__(self):
+        return f'Похожие на {self.recipe_id}: {len(self.neighbors) // 6}'
+
+    @staticmethod
+    def pack(ids, scores):
+        """id похожих рецептов uint32 и сходство float16 в байты."""
+
+        return struct.pack(f'<{len(ids)}I{len(scores)}e', *ids, *scores)
+
+    def unpack(self):
+        """id похожих рецептов и сходство."""
+
+        count = len(self.neighbors) // 6
+        values = struct.unpack(f'<{count}I{count}e', self.neighbors)
+        return values[:count], values[count:]
+
+
+class ChangeStamp(models.Model):
+    """Версия таблицы для условных GET-запросов. Увеличивается при любом
+    изменении таблицы, см. recipes/signals.py."""
+
+    RECIPES = 'recipes'
+    TAGS = 'tags'
+    INGREDIENTS = 'ingredients'
+
+    name = models.CharField('Таблица', max_length=50, unique=True)
+    version = models.PositiveIntegerField('Версия', default=0)
+    modified = models.DateTimeField('Изменена', default=timezone.now)
+
+    class Meta:
+        verbose_name = 'Версия таблицы'
+        verbose_name_plural = 'Версии таблиц'
+
+    def __str__(self):
+        return f'{self.name} - {self.version}'
+
+    @classmethod
+    def bump(cls, name):
+        """Увеличивает версию после коммита текущей транзакции. Строка
+        версии одна на таблицу, и обновленная внутри транзакции она была бы
+        заблокирована до коммита: записи рецептов, тэгов, ингредиентов и
+        профилей выстраивались бы за ней в очередь. Вне транзакции версия
+        увеличивается сразу."""
+
+        transaction.on_commit(partial(cls.increment, name))
+
+    @classmethod
+    def increment(cls, name):
+        updated = cls.objects.filter(name=name).update(
+            version=F('version') + 1, modified=timezone.now())
+        if not updated:
+            cls.objects.get_or_create(name=name,
+                                      defaults={'version': 1})
+
+    @classmethod
+    def current(cls, name):
+        """Версия и время последнего изменения таблицы."""
+
+        stamp = cls.objects.filter(name=name).values_list(
+            'version', 'modified').first()
+        return stamp or (0, None)
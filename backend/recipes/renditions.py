@@ -0,0 +1,100 @@
+import io
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connection, transaction
+from django.utils import timezone
+from PIL import Image, ImageOps
+
+from .models import ChangeStamp, Recipe
+
+logger = logging.getLogger(__name__)
+
+# Уменьшенные копии фото рецепта: максимальные ширина и высота.
+SIZES = {
+    'thumbnail': (160, 160),
+    'card': (600, 600),
+    'full': (1280, 1280),
+}
+FORMATS = {
+    'jpeg': ('JPEG', 'jpg', {'quality': 85, 'optimize': True,
+                             'progressive': True}),
+    'webp': ('WEBP', 'webp', {'quality': 80, 'method': 4}),
+}
+
+executor = ThreadPoolExecutor(max_workers=settings.IMAGE_RENDITION_WORKERS,
+                              thread_name_prefix='renditions')
+
+
+def rendition_name(recipe, size, image_format='jpeg'):
+    """Имя файла копии в хранилище или имя оригинала, пока копии для
+    текущего фото не готовы."""
+
+    renditions = recipe.renditions or {}
+    if renditions.get('source') == recipe.image.name:
+        return renditions.get(size, {}).get(image_format, recipe.image.name)
+    return recipe.image.name
+
+
+def rendition_names(renditions, source):
+    """Имена файлов всех копий фото source."""
+
+    if not renditions or renditions.get('source') != source:
+        return []
+    return [name for size in SIZES
+            for name in renditions.get(size, {}).values()]
+
+
+def render(image, size, image_format):
+    pil_format, _, options = FORMATS[image_format]
+    copy = image.copy()
+    copy.thumbnail(size, Image.LANCZOS)
+    if copy.mode not in ('RGB', 'L'):
+        copy = copy.convert('RGB')
+    buffer = io.BytesIO()
+    copy.save(buffer, pil_format, **options)
+    return buffer.getvalue()
+
+
+def build_renditions(recipe_id, source):
+    """Создает все копии фото source и записывает их в рецепт, если фото
+    рецепта за это время не поменялось."""
+
+    storage = Recipe._meta.get_field('image').storage
+    with storage.open(source) as file:
+        image = ImageOps.exif_transpose(Image.open(file))
+        image.load()
+    stem = os.path.splitext(os.path.basename(source))[0]
+    renditions = {'source': source}
+    for size, dimensions in SIZES.items():
+        for image_format, (_, extension, _) in FORMATS.items():
+            renditions.setdefault(size, {})[image_format] = storage.save(
+                f'recipes/renditions/{stem}_{size}.{extension}',
+                ContentFile(render(image, dimensions, image_format)))
+    updated = Recipe.objects.filter(pk=recipe_id, image=source).update(
+        renditions=renditions, modified=timezone.now())
+    if updated:
+        ChangeStamp.bump(ChangeStamp.RECIPES)
+    return renditions
+
+
+def build_in_background(recipe_id, source):
+    try:
+        build_renditions(recipe_id, source)
+    except Exception:
+        logger.exception('Не удалось создать копии фото рецепта %s',
+                         recipe_id)
+    finally:
+        connection.close()
+
+
+def schedule_renditions(recipe):
+    """Ставит создание копий в фоновый поток после коммита транзакции, в
+    которой сохранен рецепт."""
+
+    recipe_id, source = recipe.pk, recipe.image.name
+    transaction.on_commit(
+        lambda: executor.submit(build_in_background, recipe_id, source))
@@ -0,0 +1,179 @@
+from functools import partial
+
+from django.db import transaction
+from django.db.models import QuerySet
+from django.db.models.signals import (m2m_changed, post_delete, post_save,
+                                      pre_delete, pre_save)
+from django.dispatch import receiver
+from django.utils import timezone
+
+from users.models import Follow, User
+
+from .feed import backfill, forget
+from .ingredient_index import ingredient_index
+from .models import (ChangeStamp, Ingredient, IngredientsAmount, Recipe,
+                     ShoppingCart, ShoppingList, Tag)
+from .renditions import schedule_renditions
+
+
+@receiver((post_save, post_delete), sender=Tag)
+def bump_tags(**kwargs):
+    ChangeStamp.bump(ChangeStamp.TAGS)
+
+
+@receiver((post_save, post_delete), sender=Ingredient)
+def bump_ingredients(**kwargs):
+    ChangeStamp.bump(ChangeStamp.INGREDIENTS)
+
+
+@receiver((post_save, post_delete), sender=Recipe)
+def bump_recipes(**kwargs):
+    ChangeStamp.bump(ChangeStamp.RECIPES)
+
+
+@receiver(post_save, sender=Recipe)
+def build_image_renditions(instance, raw, **kwargs):
+    """Новое фото рецепта уменьшается в фоне, до этого отдается
+    оригинал."""
+
+    if raw or not instance.image:
+        return
+    if (instance.renditions or {}).get('source') != instance.image.name:
+        schedule_renditions(instance)
+
+
+@receiver(post_delete, sender=Recipe)
+def forget_deleted_recipe(instance, **kwargs):
+    transaction.on_commit(partial(ingredient_index.discard, instance.pk))
+
+
+@receiver(post_save, sender=User)
+def bump_authors(created, update_fields, **kwargs):
+    """Профили авторов входят в закэшированные страницы ленты. Вход юзера
+    обновляет только last_login и ленту не меняет."""
+
+    if created or (update_fields and set(update_fields) <= {'last_login'}):
+        return
+    ChangeStamp.bump(ChangeStamp.RECIPES)
+
+
+def touch_recipes(recipe_ids):
+    """Обновляет время изменения рецептов, меняя их ETag и ключ в кэше
+    сериализованных рецептов, и версию ленты."""
+
+    Recipe.objects.filter(pk__in=recipe_ids).update(modified=timezone.now())
+    ChangeStamp.bump(ChangeStamp.RECIPES)
+
+
+@receiver(post_save, sender=IngredientsAmount)
+def touch_recipe_ingredients(instance, **kwargs):
+    touch_recipes([instance.recipe_id])
+
+
+@receiver(m2m_changed, sender=Recipe.tags.through)
+def touch_recipe_tags(instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        touch_recipes([instance.pk])
+    elif pk_set:
+        touch_recipes(pk_set)
+    else:
+        # Тэг отвязан от всех рецептов, их id уже неизвестны:
+        ChangeStamp.bump(ChangeStamp.TAGS)
+
+
+@receiver(post_save, sender=Follow)
+def backfill_feed(instance, created, raw, **kwargs):
+    if created and not raw:
+        backfill(instance.user_id, instance.author_id)
+
+
+@receiver(post_delete, sender=Follow)
+def forget_feed(instance, **kwargs):
+    forget(instance.user_id, instance.author_id)
+
+
+def deleted_directly(model, origin):
+    """Удален ли объект model сам по себе, а не каскадом от рецепта, юзера
+    или ингредиента. origin - объект или кверисет, у которого вызвали
+    delete()."""
+
+    return isinstance(origin, model) or (
+        isinstance(origin, QuerySet) and origin.model is model)
+
+
+@receiver(post_save, sender=ShoppingCart)
+def add_to_shopping_list(instance, created, raw, **kwargs):
+    if created and not raw:
+        ShoppingList.objects.add_recipe([instance.user_id],
+                                        instance.recipe_id)
+
+
+@receiver(pre_save, sender=ShoppingCart)
+def move_in_shopping_list(instance, raw, **kwargs):
+    """Рецепт или юзер корзины, измененные в админке."""
+
+    if raw or instance._state.adding:
+        return
+    old = ShoppingCart.objects.filter(pk=instance.pk).values_list(
+        'user_id', 'recipe_id').first()
+    if old is not None and old != (instance.user_id, instance.recipe_id):
+        ShoppingList.objects.add_recipe([old[0]], old[1], sign=-1)
+        ShoppingList.objects.add_recipe([instance.user_id],
+                                        instance.recipe_id)
+
+
+@receiver(post_delete, sender=ShoppingCart)
+def remove_from_shopping_list(instance, origin, **kwargs):
+    # Каскад от рецепта учтен в release_shopping_lists, при удалении юзера
+    # его список покупок удаляется вместе с корзиной.
+    if deleted_directly(ShoppingCart, origin):
+        ShoppingList.objects.add_recipe([instance.user_id],
+                                        instance.recipe_id, sign=-1)
+
+
+@receiver(pre_delete, sender=Recipe)
+def release_shopping_lists(instance, **kwargs):
+    """Удаленный рецепт, в том числе каскадом от автора, уходит из списков
+    покупок всех юзеров, у которых он в корзине. Пока ингредиенты и
+    корзины рецепта на месте."""
+
+    ShoppingList.objects.add_recipe(
+        instance.shopping_cart.values_list('user_id', flat=True),
+        instance.pk, sign=-1)
+
+
+@receiver(post_save, sender=IngredientsAmount)
+def add_ingredient_to_shopping_lists(instance, created, raw, **kwargs):
+    if created and not raw:
+        ShoppingList.objects.change_recipe(
+            instance.recipe_id, {instance.ingredient_id: instance.amount})
+
+
+@receiver(pre_save, sender=IngredientsAmount)
+def change_ingredient_in_shopping_lists(instance, raw, **kwargs):
+    """Ингредиент рецепта, измененный по одному, например в админке. API
+    меняет ингредиенты пачками без сигналов сохранения и пересчитывает
+    списки само, см. RecipeSerializer.update_ingredients_amount."""
+
+    if raw or instance._state.adding:
+        return
+    old = IngredientsAmount.objects.filter(pk=instance.pk).values_list(
+        'recipe_id', 'ingredient_id', 'amount').first()
+    if old is None or old == (instance.recipe_id, instance.ingredient_id,
+                              instance.amount):
+        return
+    recipe_id, ingredient_id, amount = old
+    ShoppingList.objects.change_recipe(recipe_id, {ingredient_id: -amount})
+    ShoppingList.objects.change_recipe(
+        instance.recipe_id, {instance.ingredient_id: instance.amount})
+
+
+@receiver(post_delete, sender=IngredientsAmount)
+def remove_ingredient_from_shopping_lists(instance, origin, **kwargs):
+    # Каскад от рецепта учтен в release_shopping_lists, строки списков
+    # удаленного ингредиента удаляются каскадом.
+    if deleted_directly(IngredientsAmount, origin):
+        ShoppingList.objects.change_recipe(
+            instance.recipe_id, {instance.ingredient_id: -instance.amount})
@@ -0,0 +1,285 @@
+from array import array
+from itertools import islice
+
+import numpy as np
+from scipy import sparse
+
+from .models import IngredientsAmount, Recipe, SimilarRecipes
+
+# Похожих рецептов в списке и кандидатов, для которых сходство считается
+# точно, на рецепт.
+TOP = 10
+CANDIDATES = 200
+# Сколько рецептов ингредиента или тэга просматривается при поиске
+# кандидатов, см. capped_postings:
+POSTING_CAP = 500
+# Тэг - признак грубее ингредиента, его вес в векторе меньше:
+TAG_WEIGHT = 0.5
+
+
+class RecipeVectors:
+    """Разреженные векторы рецептов по ингредиентам и тэгам. Вес признака -
+    IDF, то есть редкий ингредиент значит больше частого, строки нормированы,
+    поэтому скалярное произведение строк - косинусное сходство рецептов.
+    Строки идут по возрастанию id рецепта."""
+
+    def __init__(self, ids, rows, features, tag_columns,
+                 posting_cap=POSTING_CAP):
+        self.ids = ids
+        size = len(ids)
+        frequency = np.bincount(features, minlength=tag_columns.stop)
+        weights = np.log((1 + size) / (1 + frequency)) + 1
+        weights[tag_columns] *= TAG_WEIGHT
+        matrix = sparse.csr_matrix(
+            (weights[features].astype(np.float32), (rows, features)),
+            shape=(size, tag_columns.stop))
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)))
+        norms[norms == 0] = 1
+        self.matrix = sparse.csr_matrix(matrix.multiply(1 / norms))
+        self.fingerprints = fingerprints(rows, features, size)
+        self.postings = capped_postings(self.matrix, posting_cap).T.tocsr()
+
+    @classmethod
+    def load(cls, **kwargs):
+        ids, = columns(Recipe.objects.order_by('id').values_list('id'), 'I')
+        recipe_ids, ingredient_ids = columns(
+            IngredientsAmount.objects.values_list('recipe_id',
+                                                  'ingredient_id'))
+        tag_recipe_ids, tag_ids = columns(
+            Recipe.tags.through.objects.values_list('recipe_id', 'tag_id'))
+        offset = int(ingredient_ids.max(initial=0)) + 1
+        tag_columns = slice(offset, offset + int(tag_ids.max(initial=0)) + 1)
+        rows = find_rows(ids, np.concatenate((recipe_ids, tag_recipe_ids)))
+        features = np.concatenate((ingredient_ids.astype(np.int64),
+                                   tag_ids.astype(np.int64) + offset))
+        # Рецепт мог появиться после чтения списка рецептов:
+        return cls(ids, rows[rows >= 0], features[rows >= 0], tag_columns,
+                   **kwargs)
+
+    def neighbors(self, rows, top=TOP, candidates=CANDIDATES,
+                  chunk_size=1000):
+        """Похожие рецепты для строк rows: отдает (номер строки, номера
+        строк похожих, сходство) по убыванию сходства.
+
+        Сравнивать рецепт со всеми, у кого есть общий признак, слишком
+        долго: частые ингредиенты есть у большой доли рецептов. Поэтому
+        кандидаты ищутся по урезанным спискам рецептов признаков
+        (capped_postings), для candidates лучших по такому неполному
+        сходству оно считается точно по всем признакам, и остаются top.
+        Строки обрабатываются блоками по chunk_size матричным умножением."""
+
+        for start in range(0, len(rows), chunk_size):
+            chunk = np.asarray(rows[start:start + chunk_size])
+            partial = (self.matrix[chunk] @ self.postings).tocsr()
+            row_of = np.repeat(np.arange(len(chunk)), np.diff(partial.indptr))
+            partial.data[partial.indices == chunk[row_of]] = 0
+            partial.eliminate_zeros()
+            row_of, found, _ = top_per_row(partial, candidates)
+            exact = sparse.csr_matrix(
+                (np.asarray(self.matrix[chunk[row_of]].multiply(
+                    self.matrix[found]).sum(axis=1)).ravel(),
+                 (row_of, found)),
+                shape=partial.shape)
+            row_of, found, scores = top_per_row(exact, top)
+            bounds = np.searchsorted(row_of, np.arange(len(chunk) + 1))
+            for number, row in enumerate(chunk):
+                part = slice(bounds[number], bounds[number + 1])
+                yield row, found[part], scores[part]
+
+
+class Refresh:
+    """Пересчет таблицы похожих рецептов.
+
+    Целиком (full) списки считаются для всех рецептов. Иначе - только для
+    рецептов, у которых отпечаток ингредиентов и тэгов не совпал с
+    сохраненным, и для тех, в чьих списках есть такие или удаленные рецепты.
+    Кроме того, измененный рецепт попадает в списки рецептов из своего
+    списка, если похож на них больше, чем последний в их списке. Веса IDF со
+    временем сдвигаются, поэтому полный пересчет стоит делать время от
+    времени."""
+
+    def __init__(self, vectors, top=TOP, candidates=CANDIDATES,
+                 chunk_size=1000, batch_size=2000):
+        self.vectors = vectors
+        self.top = top
+        self.candidates = candidates
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+        self.batch = []
+        self.counts = {'changed': 0, 'affected': 0, 'merged': 0}
+
+    def run(self, full=False):
+        """Пересчитывает списки и возвращает, сколько посчитано для
+        измененных рецептов, для рецептов со ссылками на них и сколько
+        списков дополнено."""
+
+        stale = np.ones(len(self.vectors.ids), dtype=bool)
+        if not full:
+            recipe_ids, stored = columns(SimilarRecipes.objects.values_list(
+                'recipe_id', 'fingerprint'), 'Iq')
+            rows = find_rows(self.vectors.ids, recipe_ids)
+            known = rows >= 0
+            stale[rows[known]] = (
+                stored[known] != self.vectors.fingerprints[rows[known]])
+        incoming = []
+        for row, found, scores in self.compute(np.flatnonzero(stale),
+                                               'changed'):
+            kept = ~stale[found]
+            incoming.append((found[kept], np.full(kept.sum(), row),
+                             scores[kept]))
+        if stale.all():
+            return self.counts
+        rows, found, scores = (
+            np.concatenate([part[number] for part in incoming])
+            if incoming else np.array([], dtype=dtype)
+            for number, dtype in enumerate((int, int, np.float32)))
+        affected, lists = self.scan(stale, set(rows.tolist()))
+        for _ in self.compute(affected, 'affected'):
+            pass
+        self.merge(lists, rows, found, scores)
+        self.flush()
+        return self.counts
+
+    def compute(self, rows, kind):
+        for row, found, scores in self.vectors.neighbors(
+                rows, self.top, self.candidates, self.chunk_size):
+            self.save(row, found, scores)
+            self.counts[kind] += 1
+            yield row, found, scores
+        self.flush()
+
+    def scan(self, stale, received):
+        """Читает сохраненные списки рецептов, которые не пересчитаны.
+        Возвращает строки, в чьих списках есть измененные или удаленные
+        рецепты, и сохраненные списки строк из received."""
+
+        ids = self.vectors.ids
+        affected, lists = [], {}
+        stored = SimilarRecipes.objects.order_by().values_list(
+            'recipe_id', 'neighbors').iterator(chunk_size=self.batch_size)
+        while True:
+            batch = [(recipe_id, bytes(data))
+                     for recipe_id, data in islice(stored, self.batch_size)]
+            if not batch:
+                break
+            rows = find_rows(ids, [recipe_id for recipe_id, _ in batch])
+            counts = np.array([len(data) // 6 for _, data in batch])
+            neighbors = find_rows(ids, np.frombuffer(b''.join(
+                data[:count * 4] for (_, data), count in zip(batch, counts)),
+                dtype='<u4'))
+            broken = np.bincount(
+                np.repeat(np.arange(len(batch)), counts),
+                weights=(neighbors < 0) | stale[neighbors],
+                minlength=len(batch)) > 0
+            for (_, data), row, is_broken in zip(batch, rows, broken):
+                if row < 0 or stale[row]:
+                    continue
+                if is_broken:
+                    affected.append(row)
+                elif row in received:
+                    lists[row] = data
+        return np.array(affected, dtype=int), lists
+
+    def merge(self, lists, rows, found, scores):
+        """Добавляет строки found со сходством scores в сохраненные списки
+        строк rows."""
+
+        order = np.argsort(rows, kind='stable')
+        rows, found, scores = rows[order], found[order], scores[order]
+        for part in np.split(np.arange(len(rows)),
+                             np.flatnonzero(np.diff(rows)) + 1):
+            if not len(part) or rows[part[0]] not in lists:
+                continue
+            row = rows[part[0]]
+            data = lists[row]
+            count = len(data) // 6
+            neighbors = np.concatenate((
+                find_rows(self.vectors.ids,
+                          np.frombuffer(data[:count * 4], dtype='<u4')),
+                found[part]))
+            similarity = np.concatenate((
+                np.frombuffer(data[count * 4:], dtype='<f2'), scores[part]))
+            best = np.argsort(-similarity, kind='stable')[:self.top]
+            if best.max() < count:
+                continue
+            self.save(row, neighbors[best], similarity[best])
+            self.counts['merged'] += 1
+
+    def save(self, row, found, scores):
+        self.batch.append(SimilarRecipes(
+            recipe_id=int(self.vectors.ids[row]),
+            neighbors=SimilarRecipes.pack(self.vectors.ids[found].tolist(),
+                                          scores.tolist()),
+            fingerprint=int(self.vectors.fingerprints[row])))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            SimilarRecipes.objects.bulk_create(
+                self.batch, update_conflicts=True, unique_fields=['recipe'],
+                update_fields=['neighbors', 'fingerprint'])
+            self.batch = []
+
+
+def columns(queryset, typecodes='II'):
+    """Поля values_list массивами NumPy, типы - коды модуля array."""
+
+    result = [array(code) for code in typecodes]
+    for values in queryset.iterator(chunk_size=20000):
+        for column, value in zip(result, values):
+            column.append(value)
+    return [np.frombuffer(column, dtype=column.typecode)
+            for column in result]
+
+
+def find_rows(ids, recipe_ids):
+    """Номера строк рецептов recipe_ids в отсортированном ids, -1 для
+    рецептов, которых нет."""
+
+    recipe_ids = np.asarray(recipe_ids, dtype=ids.dtype)
+    rows = np.searchsorted(ids, recipe_ids)
+    found = rows < len(ids)
+    found[found] = ids[rows[found]] == recipe_ids[found]
+    rows[~found] = -1
+    return rows
+
+
+def fingerprints(rows, features, size):
+    """Отпечаток набора признаков каждой строки: сумма 64-битных хэшей
+    признаков, от порядка не зависит."""
+
+    mixed = features.astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+    with np.errstate(over='ignore'):
+        mixed = (mixed ^ (mixed >> np.uint64(30))) * np.uint64(
+            0xBF58476D1CE4E5B9)
+        mixed = (mixed ^ (mixed >> np.uint64(27))) * np.uint64(
+            0x94D049BB133111EB)
+        mixed ^= mixed >> np.uint64(31)
+        result = np.zeros(size, dtype=np.uint64)
+        np.add.at(result, rows, mixed)
+    return result.view(np.int64)
+
+
+def capped_postings(matrix, cap):
+    """Матрица, в которой у каждого признака оставлены cap рецептов с
+    наибольшим весом этого признака: для них он дает наибольший вклад в
+    сходство, обычно это рецепты с небольшим числом ингредиентов."""
+
+    features, rows, weights = top_per_row(matrix.T.tocsr(), cap)
+    return sparse.csr_matrix((weights, (rows, features)), shape=matrix.shape)
+
+
+def top_per_row(matrix, top):
+    """Не больше top наибольших значений каждой строки csr-матрицы:
+    номера строк, столбцов и значения, по строкам и по убыванию значения."""
+
+    row_of = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    # Одна сортировка по номеру строки, а внутри строки по убыванию
+    # значения, в несколько раз быстрее lexsort по двум ключам:
+    order = np.argsort(
+        row_of - matrix.data / (2 * matrix.data.max(initial=1)),
+        kind='stable')
+    rank = np.arange(len(order)) - matrix.indptr[row_of[order]]
+    order = order[rank < top]
+    return row_of[order], matrix.indices[order], matrix.data[order]
@@ -0,0 +1,35 @@
+import hashlib
+import os
+import posixpath
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """Хранилище, в котором имя файла - sha256 его содержимого в каталоге
+    из upload_to: recipes/ab/ab12...ef.png. Повторная загрузка того же
+    файла ничего не пишет на диск и возвращает имя существующего, только
+    обновляет время его изменения: файлы без рецептов удаляет gc_media, не
+    трогая свежие, а ссылка на файл может быть в еще не закоммиченной
+    транзакции."""
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        digest = hashlib.sha256()
+        for chunk in content.chunks():
+            digest.update(chunk)
+        content.seek(0)
+        digest = digest.hexdigest()
+        extension = posixpath.splitext(name)[1].lower()
+        name = posixpath.join(posixpath.dirname(name), digest[:2],
+                              digest + extension)
+        if self.exists(name):
+            os.utime(self.path(name))
+            return name
+        return super().save(name, content, max_length)
@@ -1,17 +1,24 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
+from foodgram.admin import LargeTableAdmin
 
 from .models import Follow, User
 
 
 @admin.register(User)
-class UserAdmin(UserAdmin):
-    list_display = ('id', 'username', 'email', 'first_name', 'last_name')
-    list_filter = ('username', 'email')
-    search_fields = ('username',)
+class UserAdmin(LargeTableAdmin, UserAdmin):
+    list_display = ('id', 'username', 'email', 'first_name', 'last_name',
+                    'recipes_count', 'followers_count')
+    list_filter = ('is_staff', 'is_superuser', 'is_active')
+    # Поиск без учета регистра по индексам users_user_upper_*:
+    search_fields = ('=username', '=email')
+    search_help_text = 'Ник или почта целиком'
 
 
 @admin.register(Follow)
-class FollowAdmin(admin.ModelAdmin):
+class FollowAdmin(LargeTableAdmin, admin.ModelAdmin):
     list_display = ('author', 'user')
-    list_filter = ('author', 'user')
+    list_select_related = ('author', 'user')
+    raw_id_fields = ('author', 'user')
+    search_fields = ('=author__username', '=user__username')
+    search_help_text = 'Ник автора или подписчика'
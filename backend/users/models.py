@@ -3,6 +3,7 @@ import re
 from django.contrib.auth.models import AbstractUser
 from django.core.exceptions import ValidationError
 from django.db import models
+from django.db.models.functions import Upper
 
 
 # В валидаторы не переносить, иначе круговой импорт
@@ -17,7 +18,28 @@ def validate_username(data):
     return data
 
 
-class User(AbstractUser):
+class CountersMixin:
+    """Модель со счетчиками связанных объектов. Счетчики меняются только
+    выражениями F() вместе с изменением связей, поэтому при сохранении
+    объекта целиком они не пишутся: иначе значение, прочитанное до
+    конкурентного изменения счетчика, затерло бы его."""
+
+    counter_fields = ()
+
+    def save(self, *args, **kwargs):
+        if (not self._state.adding and kwargs.get('update_fields') is None
+                and not kwargs.get('force_insert')):
+            # Незагруженные поля, как и в Model.save, тоже не пишутся:
+            deferred = self.get_deferred_fields()
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key
+                and field.name not in self.counter_fields
+                and field.attname not in deferred]
+        super().save(*args, **kwargs)
+
+
+class User(CountersMixin, AbstractUser):
     """Кастомная модель юзера."""
 
     username = models.CharField('Ник пользователя',
@@ -43,7 +65,13 @@ class User(AbstractUser):
                                 max_length=150,
                                 blank=False,
                                 null=False)
+    recipes_count = models.PositiveIntegerField('Рецептов', default=0,
+                                                editable=False)
+    followers_count = models.PositiveIntegerField('Подписчиков', default=0,
+                                                  editable=False,
+                                                  db_index=True)
     USERNAME_FIELD = 'email'
+    counter_fields = ('recipes_count', 'followers_count')
     REQUIRED_FIELDS = ['username', 'first_name', 'last_name']
 
     class Meta:
@@ -56,6 +84,11 @@ class User(AbstractUser):
                 name='unique_constraint'
             ),
         ]
+        indexes = [
+            # Поиск в админке без учета регистра, username__iexact:
+            models.Index(Upper('username'), name='users_user_upper_username'),
+            models.Index(Upper('email'), name='users_user_upper_email'),
+        ]
 
     def __str__(self):
         return f'{self.username} - {self.email}'